@@ -2,11 +2,674 @@
 
 from collections import defaultdict, Counter
 import re
+import csv
+import json
+import sqlite3
+import math
+import time
+import random
+import heapq
+import hashlib
+import zlib
+import queue
+import threading
+import functools
+import inspect
+import itertools
+import copy
+from collections import OrderedDict
+import argparse
+import asyncio
+import multiprocessing
+from urllib.parse import urlsplit, parse_qsl, unquote
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import requests
 from bs4 import BeautifulSoup
 import pytest
 import os
+import sys
+import io
+import gzip
+import zipfile
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pa_csv = pq = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+DATASETS_DIR = '../datasets'
+MOVIE_CSV_FILE = '../datasets/movies.csv'
+BUFFER_SIZE = 1 << 20
+
+
+class Instrumentation:
+    """
+    Opt-in metrics of the analysis methods. For every instrumented method it records the number of calls,
+    wall time, rows scanned, cache hits and misses, bytes read and HTTP requests.
+    Loaders count every data line they read as a scanned row, including the lines skipped by a sample,
+    a filter or as rejects; the analyses count the rows of the dataset they scan.
+    Counters of nested calls are added to the calling method as well.
+    While disabled, an instrumented call costs one attribute check.
+    """
+    COUNTERS = ('rows_scanned', 'cache_hits', 'cache_misses', 'bytes_read', 'http_requests')
+
+    def __init__(self, enabled:bool = False):
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__stats = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.__lock:
+            self.__stats = {}
+
+    def count(self, counter:str, amount:int = 1):
+        """
+        The method adds amount to the counter of the method running in the current thread.
+        """
+        if self.enabled:
+            stack = getattr(self.__local, 'stack', None)
+            if stack:
+                stack[-1][counter] += amount
+                if counter == 'rows_scanned':
+                    stack[-1]['rows_counted'] = True
+
+    def served_from_cache(self):
+        """
+        The method marks the call of the method running in the current thread as answered by the result cache,
+        so it scans no rows.
+        """
+        if self.enabled:
+            stack = getattr(self.__local, 'stack', None)
+            if stack:
+                stack[-1]['rows_counted'] = True
+
+    def measure(self, method):
+        """
+        Decorator which records the metrics of the method. Rows scanned are taken from
+        the _rows_scanned() method of the instance after the call, if it has one, unless the method
+        (or a nested instrumented call) counted its rows itself or the result came from the result cache.
+        """
+        name = method.__qualname__
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return method(*args, **kwargs)
+            stack = getattr(self.__local, 'stack', None)
+            if stack is None:
+                stack = self.__local.stack = []
+            frame = dict.fromkeys(self.COUNTERS, 0)
+            stack.append(frame)
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                stack.pop()
+                counted = frame.pop('rows_counted', False)
+                rows = getattr(args[0], '_rows_scanned', None) if args else None
+                if rows is not None and not counted:
+                    frame['rows_scanned'] += rows()
+                    counted = True
+                if stack:
+                    for counter, value in frame.items():
+                        stack[-1][counter] += value
+                    if counted:
+                        stack[-1]['rows_counted'] = True
+                self.__record(name, elapsed, frame)
+        return wrapper
+
+    def __record(self, name:str, elapsed:float, frame:dict):
+        with self.__lock:
+            stats = self.__stats.get(name)
+            if stats is None:
+                stats = self.__stats[name] = {'calls': 0, 'wall_time': 0.0, 'wall_time_max': 0.0,
+                                              **dict.fromkeys(self.COUNTERS, 0)}
+            stats['calls'] += 1
+            stats['wall_time'] += elapsed
+            stats['wall_time_max'] = max(stats['wall_time_max'], elapsed)
+            for counter, value in frame.items():
+                stats[counter] += value
+
+    def snapshot(self):
+        """
+        The method returns a dict where the keys are method names and the values are dicts with
+        calls, wall_time, wall_time_max (seconds) and the counters. Sorted by method names.
+        """
+        with self.__lock:
+            return {name: dict(stats) for name, stats in sorted(self.__stats.items())}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix:str = 'movielens'):
+        """
+        The method returns the snapshot in the Prometheus text exposition format.
+        """
+        metrics = [('calls', 'calls_total', 'counter', 'Number of calls.'),
+                   ('wall_time', 'wall_seconds_total', 'counter', 'Wall time spent in the method.'),
+                   ('wall_time_max', 'wall_seconds_max', 'gauge', 'Longest call of the method.'),
+                   ('rows_scanned', 'rows_scanned_total', 'counter', 'Rows scanned by the method.'),
+                   ('cache_hits', 'cache_hits_total', 'counter', 'Cache hits.'),
+                   ('cache_misses', 'cache_misses_total', 'counter', 'Cache misses.'),
+                   ('bytes_read', 'bytes_read_total', 'counter', 'Bytes read from files and HTTP responses.'),
+                   ('http_requests', 'http_requests_total', 'counter', 'HTTP requests made.')]
+        snapshot = self.snapshot()
+        lines = []
+        for key, metric, kind, help_text in metrics:
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, stats in snapshot.items():
+                lines.append(f'{prefix}_{metric}{{method="{name}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+class ResultCache:
+    """
+    Opt-in bounded LRU cache of analysis results keyed by (method, dataset version, arguments).
+    The dataset version changes when an instance loads, refreshes or merges data, but not when its rows
+    are changed in place (e.g. data_joined[0]['rating'] = 1.0), so enable the cache only over data
+    which is not edited by hand, as the query server does. Calls with unhashable arguments are not cached.
+    Cached results are stored and returned as deep copies, so callers cannot change the cached entry.
+    """
+
+    def __init__(self, maxsize:int = 256, enabled:bool = False):
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self.__results = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def memoize(self, method):
+        """
+        Decorator caching the results of a method of an instance which has data_version(). Arguments which
+        have data_version() too (e.g. movies=) are keyed on their version, not on the instance.
+        """
+        name = method.__qualname__
+
+        def versioned(value):
+            return ('data_version', value.data_version()) if hasattr(value, 'data_version') else value
+
+        @functools.wraps(method)
+        def wrapper(instance, *args, **kwargs):
+            if not self.enabled:
+                return method(instance, *args, **kwargs)
+            key = (name, instance.data_version(), tuple(versioned(arg) for arg in args),
+                   tuple(sorted((keyword, versioned(value)) for keyword, value in kwargs.items())))
+            try:
+                with self.__lock:
+                    result = self.__results[key]
+                    self.__results.move_to_end(key)
+                    self.__hits += 1
+            except KeyError:
+                pass
+            except TypeError:
+                return method(instance, *args, **kwargs)
+            else:
+                INSTRUMENTATION.count('cache_hits')
+                INSTRUMENTATION.served_from_cache()
+                return copy.deepcopy(result)
+            INSTRUMENTATION.count('cache_misses')
+            result = method(instance, *args, **kwargs)
+            # lazily loaded datasets change their version during the first call
+            key = (name, instance.data_version(), key[2], key[3])
+            with self.__lock:
+                self.__misses += 1
+                self.__results[key] = copy.deepcopy(result)
+                while len(self.__results) > self.maxsize:
+                    self.__results.popitem(last=False)
+                    self.__evictions += 1
+            return result
+        wrapper.memoized = True
+        return wrapper
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stats(self):
+        """
+        The method returns a dict with hits, misses, evictions, size and maxsize of the cache.
+        """
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__evictions,
+                    'size': len(self.__results), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self.__lock:
+            self.__results.clear()
+            self.__hits = self.__misses = self.__evictions = 0
+
+
+RESULT_CACHE = ResultCache()
+_DATASET_IDS = itertools.count(1)
+
+
+ARROW_COLUMNS = {
+    'movies': [('movieId', 'int64'), ('title', 'string'), ('genres', 'string')],
+    'tags': [('userId', 'int64'), ('movieId', 'int64'), ('tag', 'string'), ('timestamp', 'int64')],
+    'ratings': [('userId', 'int64'), ('movieId', 'int64'), ('rating', 'float64'), ('timestamp', 'int64'),
+                ('title', 'string')],
+    'links': [('movieId', 'int64'), ('imdbId', 'string'), ('tmdbId', 'int64'), ('parsed', 'bool'),
+              ('Director', 'string'), ('Budget', 'float64'), ('Cumulative Worldwide Gross', 'float64'),
+              ('Runtime', 'int64'), ('Title', 'string'), ('Rating', 'string')],
+}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for the Arrow/Parquet support: pip install pyarrow")
+
+
+def arrow_schema(dataset:str):
+    """
+    The function returns the pyarrow schema of the dataset ('movies', 'tags', 'ratings' or 'links').
+    """
+    _require_pyarrow()
+    return pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in ARROW_COLUMNS[dataset]])
+
+
+def _arrow_table(dataset:str, columns:dict):
+    schema = arrow_schema(dataset)
+    return pa.table([pa.array(columns[field.name], field.type) for field in schema], schema=schema)
+
+
+def write_table(table, path_to_the_file:str):
+    """
+    The function writes a pyarrow table as Parquet (.parquet) or as an uncompressed Arrow IPC file (.arrow, .feather).
+    """
+    _require_pyarrow()
+    if path_to_the_file.endswith('.parquet'):
+        pq.write_table(table, path_to_the_file)
+    elif path_to_the_file.endswith(('.arrow', '.feather')):
+        with pa.OSFile(path_to_the_file, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unknown columnar format of {path_to_the_file}, expected .parquet, .arrow or .feather")
+
+
+def read_table(path_to_the_file:str, columns:list = None):
+    """
+    The function reads a Parquet or Arrow IPC file as a pyarrow table, only with the given columns.
+    Arrow IPC files are memory-mapped, so the columns are read without copying; Parquet decodes only
+    the requested columns. The table can be handed to pandas with table.to_pandas().
+    """
+    _require_pyarrow()
+    if path_to_the_file.endswith('.parquet'):
+        return pq.read_table(path_to_the_file, columns=columns, memory_map=True)
+    if path_to_the_file.endswith(('.arrow', '.feather')):
+        table = pa.ipc.open_file(pa.memory_map(path_to_the_file, 'r')).read_all()
+        return table.select(columns) if columns is not None else table
+    raise ValueError(f"Unknown columnar format of {path_to_the_file}, expected .parquet, .arrow or .feather")
+
+
+def convert_csv(path_to_csv:str, path_to_the_file:str, dataset:str):
+    """
+    The function converts a whole ratings.csv, tags.csv or links.csv into a typed Parquet or Arrow file
+    with the multithreaded pyarrow CSV reader. Ratings are written without titles.
+    Returns the number of rows.
+    """
+    _require_pyarrow()
+    if dataset not in ('ratings', 'tags', 'links'):
+        raise ValueError(f"dataset must be 'ratings', 'tags' or 'links', got {dataset!r}")
+    names = {'ratings': ['userId', 'movieId', 'rating', 'timestamp'],
+             'tags': ['userId', 'movieId', 'tag', 'timestamp'],
+             'links': ['movieId', 'imdbId', 'tmdbId']}[dataset]
+    schema = arrow_schema(dataset)
+    table = pa_csv.read_csv(path_to_csv, convert_options=pa_csv.ConvertOptions(
+        column_types={name: schema.field(name).type for name in names}, include_columns=names))
+    write_table(table, path_to_the_file)
+    return table.num_rows
+
+
+def _split_zip(path_to_the_file:str):
+    """
+    The function returns (archive, member) for a path inside a zip archive like 'ml-25m.zip/ml-25m/ratings.csv',
+    or None for other paths.
+    """
+    parts = path_to_the_file.replace(os.sep, '/').split('/')
+    for i, part in enumerate(parts[:-1]):
+        if part.lower().endswith('.zip') and os.path.isfile('/'.join(parts[:i + 1])):
+            return '/'.join(parts[:i + 1]), '/'.join(parts[i + 1:])
+    return None
+
+
+def is_compressed(path_to_the_file:str):
+    return path_to_the_file.endswith(('.gz', '.zst')) or _split_zip(path_to_the_file) is not None
+
+
+def open_text(path_to_the_file:str, newline:str = None, buffer_size:int = BUFFER_SIZE):
+    """
+    The function opens a CSV or JSON lines file for reading as utf-8 text with a read buffer of buffer_size bytes.
+    Compressed files are streamed without extracting them: .gz, .zst (with the zstandard package) and
+    members of zip archives, given as 'ml-25m.zip/ml-25m/ratings.csv' or as 'ml-25m.zip/ratings.csv'
+    when the file name is unique in the archive.
+    """
+    in_zip = _split_zip(path_to_the_file)
+    if in_zip is not None:
+        archive_path, member = in_zip
+        with zipfile.ZipFile(archive_path) as archive:
+            names = archive.namelist()
+            if member not in names:
+                matches = [name for name in names if name.endswith('/' + member)]
+                if len(matches) != 1:
+                    raise FileNotFoundError(f"No single member {member} in {archive_path}, found {matches}")
+                member = matches[0]
+            raw = archive.open(member)
+    elif path_to_the_file.endswith('.gz'):
+        raw = gzip.open(path_to_the_file, 'rb')
+    elif path_to_the_file.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read .zst files: pip install zstandard")
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path_to_the_file, 'rb'), read_size=buffer_size)
+    else:
+        return open(path_to_the_file, 'r', encoding='utf-8', newline=newline, buffering=buffer_size)
+    return io.TextIOWrapper(io.BufferedReader(raw, buffer_size), encoding='utf-8', newline=newline)
+
+
+def _metered_lines(file):
+    """
+    The function returns the lines of the open text file. When the instrumentation is enabled, the utf-8 bytes
+    of every line taken from it are counted as bytes_read and every line after the header as rows_scanned,
+    so a load which stops early counts what it consumed, not what the read buffer holds.
+    """
+    if not INSTRUMENTATION.enabled:
+        return file
+
+    def metered():
+        INSTRUMENTATION.count('rows_scanned', 0)
+        for line_num, line in enumerate(file):
+            INSTRUMENTATION.count('bytes_read', len(line.encode('utf-8')))
+            if line_num:
+                INSTRUMENTATION.count('rows_scanned')
+            yield line
+    return metered()
+
+
+def _read_appended(path_to_the_file:str, offset:int, file_id:tuple = None):
+    """
+    The function returns (lines, offset, file_id): the complete lines written to the file after offset,
+    the offset right after the last of them and the (st_dev, st_ino) of the file. A last line without
+    a newline yet is left for the next call. When the file is not the one of file_id any more (replaced)
+    or became shorter than offset (truncated), offset is None and no lines are read.
+    """
+    if is_compressed(path_to_the_file):
+        raise ValueError(f"Follow mode needs an uncompressed file, got {path_to_the_file}")
+    lines = []
+    with open(path_to_the_file, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        current_id = (stat.st_dev, stat.st_ino)
+        if stat.st_size < offset or (file_id is not None and file_id != current_id):
+            return [], None, current_id
+        file.seek(offset)
+        start = offset
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            lines.append(line.decode('utf-8').rstrip('\r\n'))
+            offset += len(line)
+    INSTRUMENTATION.count('bytes_read', offset - start)
+    return lines, offset, current_id
+
+
+class Rejects(list):
+    """
+    The malformed rows skipped by a loader in lenient mode (strict=False), as dicts {line, row, error}.
+    With path every reject is also appended to that JSON lines file. The error budget is max_errors rejects
+    in total and max_error_rate rejects per line read: exceeding it raises ValueError, so a load
+    that is mostly garbage still fails.
+    """
+
+    def __init__(self, path:str = None, max_errors:int = None, max_error_rate:float = None):
+        super().__init__()
+        self.path = path
+        self.max_errors = max_errors
+        self.max_error_rate = max_error_rate
+        if path is not None:
+            open(path, 'w').close()
+
+    def append(self, reject:dict):
+        super().append(reject)
+        if self.path is not None:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(reject, ensure_ascii=False) + '\n')
+        if self.max_errors is not None and len(self) > self.max_errors:
+            raise ValueError(f"Error budget exceeded: more than {self.max_errors} malformed rows, "
+                             f"the last one in line {reject['line']}")
+
+    def check(self, lines_read:int):
+        """
+        The method raises ValueError if the rejects exceed max_error_rate of lines_read.
+        """
+        if self.max_error_rate is not None and lines_read and len(self) / lines_read > self.max_error_rate:
+            raise ValueError(f"Error budget exceeded: {len(self)} of {lines_read} rows are malformed, "
+                             f"more than {self.max_error_rate:.2%}")
+
+
+class Sampler:
+    """
+    Which data lines of ratings.csv or tags.csv a loader keeps:
+    'first' - the first size lines (all of them if size is None), fast but biased toward early users and ids;
+    'reservoir' - a uniform random sample of size lines of the whole file;
+    'fraction' - every line with probability fraction;
+    'users' - cluster sampling by user: all lines of a fraction of the users, chosen by a hash of userId,
+    so the same users are kept in ratings.csv and tags.csv and per-user statistics stay whole;
+    'stratified' - the lines stratified by key ('userId' or 'movieId'): every stratum keeps fraction of
+    its lines, or fractions[stratum] for the strata given there, spread evenly over the stratum from
+    a random start, so every user (or movie) is represented in proportion to its number of lines.
+    The random methods are reproducible with seed. The kept lines stay in file order.
+    """
+    METHODS = ('first', 'reservoir', 'fraction', 'users', 'stratified')
+    KEYS = ('userId', 'movieId')
+
+    def __init__(self, method:str = 'first', size:int = 1000, fraction:float = 0.01, seed:int = 0,
+                 key:str = 'userId', fractions:dict = None):
+        if method not in self.METHODS:
+            raise ValueError(f"method must be one of {self.METHODS}, got {method!r}")
+        if method == 'reservoir' and (size is None or size < 1):
+            raise ValueError(f"size must be positive, got {size}")
+        for value in [fraction, *(fractions or {}).values()]:
+            if method in ('fraction', 'users', 'stratified') and not 0 < value <= 1:
+                raise ValueError(f"fraction must be in (0, 1], got {value}")
+        if key not in self.KEYS:
+            raise ValueError(f"key must be one of {self.KEYS}, got {key!r}")
+        self.method = method
+        self.size = size
+        self.fraction = fraction
+        self.seed = seed
+        self.key = key
+        self.fractions = {str(stratum): value for stratum, value in (fractions or {}).items()}
+
+    def __repr__(self):
+        if self.method == 'stratified':
+            return (f"Sampler('stratified', fraction={self.fraction}, seed={self.seed}, key={self.key!r}, "
+                    f"fractions={self.fractions})")
+        return f"Sampler({self.method!r}, size={self.size}, fraction={self.fraction}, seed={self.seed})"
+
+    def sample(self, lines, line_num:int = 2):
+        """
+        The method yields (line number, line) for the kept lines, numbered from line_num.
+        """
+        numbered = enumerate(lines, line_num)
+        if self.method == 'first':
+            yield from numbered if self.size is None else itertools.islice(numbered, self.size)
+        elif self.method == 'reservoir':
+            yield from sorted(self.__reservoir(numbered))
+        else:
+            keep = self.keeper()
+            yield from ((num, line) for num, line in numbered if keep(line))
+
+    def keeper(self):
+        """
+        The method returns keep(line), which tells line by line if the line is kept, for the methods which
+        do not need the whole file: 'fraction', 'users', 'stratified' and 'first' without size. Follow mode
+        uses it for the lines appended later. The other methods raise ValueError.
+        """
+        if self.method == 'fraction':
+            rng = random.Random(self.seed)
+            return lambda line: rng.random() < self.fraction
+        if self.method == 'users':
+            return lambda line: self.keeps_user(line.split(',', 1)[0])
+        if self.method == 'stratified':
+            return self.__stratum_keeper()
+        if self.method == 'first' and self.size is None:
+            return lambda line: True
+        raise ValueError(f"{self!r} needs the whole file and cannot sample appended lines")
+
+    def keeps_user(self, user_id):
+        """
+        The method tells if the 'users' method keeps the user (userId as int or str).
+        """
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return True
+        return _hash64(user_id ^ self.seed) < self.fraction * 2 ** 64
+
+    def __stratum_keeper(self):
+        # systematic sampling within every stratum: the k-th line of a stratum is kept when
+        # start + k * fraction crosses an integer, start being a hash of the stratum in [0, 1)
+        column = self.KEYS.index(self.key)
+        positions = {}
+
+        def keep(line):
+            stratum = line.split(',', column + 1)[column]
+            fraction = self.fractions.get(stratum, self.fraction)
+            position = positions.get(stratum)
+            if position is None:
+                position = _hash64(f"{self.seed}:{stratum}") / 2 ** 64
+            positions[stratum] = position + fraction
+            return math.floor(position + fraction) > math.floor(position)
+        return keep
+
+    def __reservoir(self, numbered):
+        # Algorithm L: skips ahead geometrically, so most lines cost a single comparison
+        rng = random.Random(self.seed)
+        reservoir = list(itertools.islice(numbered, self.size))
+        if len(reservoir) < self.size:
+            return reservoir
+        weight = math.exp(math.log(rng.random() or 1e-300) / self.size)
+        skip = math.floor(math.log(rng.random() or 1e-300) / math.log(1 - weight))
+        for item in numbered:
+            if skip:
+                skip -= 1
+                continue
+            reservoir[rng.randrange(self.size)] = item
+            weight *= math.exp(math.log(rng.random() or 1e-300) / self.size)
+            skip = math.floor(math.log(rng.random() or 1e-300) / math.log(1 - weight)) if weight < 1 else 0
+        return reservoir
+
+
+def _parse_lines(numbered_lines, parse, rejects:list = None):
+    """
+    The function yields parse(line, line number) for the (line number, line) pairs.
+    Malformed lines raise ValueError, or are appended to rejects and skipped if rejects is given.
+    """
+    for line_num, line in numbered_lines:
+        try:
+            row = parse(line, line_num)
+        except ValueError as e:
+            if rejects is None:
+                raise
+            rejects.append({'line': line_num, 'row': line.rstrip('\n'), 'error': str(e)})
+            continue
+        yield row
+
+
+def _top_per_group(triples, n:int):
+    """
+    The function returns {group: [(item, value), ...]} with the n items of the largest values in every group,
+    sorted by values descendingly (ties in the order of first appearance), from one pass over
+    (group, item, value) triples. It keeps a heap of at most n entries per group.
+    """
+    if n < 1:
+        raise ValueError(f"n must be positive, got {n}")
+    heaps = {}
+    for order, (group, item, value) in enumerate(triples):
+        entry = (value, -order, item)
+        heap = heaps.get(group)
+        if heap is None:
+            heaps[group] = [entry]
+        elif len(heap) < n:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    return {group: [(item, value) for value, _, item in sorted(heap, reverse=True)]
+            for group, heap in sorted(heaps.items(), key=lambda x: (x[0] is None, x[0]))}
+
+
+def _top_values(values:dict, n:int):
+    """
+    The function returns the n items of values with the largest values, sorted by values descendingly
+    (ties in the order of the dict). n out of 1..len(values) raises ValueError.
+    """
+    if not (1 <= n <= len(values)):
+        raise ValueError(f"n must be between 1 and {len(values)}, got {n}")
+    return dict(sorted(values.items(), key=lambda x: x[1], reverse=True)[:n])
+
+
+def _rating_histograms(rows, key):
+    """
+    The function returns {key(row): {rating: count}} for the rating rows, in the order of first appearance.
+    """
+    histograms = {}
+    for row in rows:
+        histogram = histograms.get(key(row))
+        if histogram is None:
+            histogram = histograms[key(row)] = {}
+        histogram[row['rating']] = histogram.get(row['rating'], 0) + 1
+    return histograms
+
+
+def _histogram_stat(histogram:dict, stat:str):
+    """
+    The function returns the 'average', 'median' or 'variance' (population) of the ratings counted
+    by the histogram {rating: count}, without expanding it into the ratings.
+    """
+    total = sum(histogram.values())
+    if stat == 'median':
+        # the middle rating, or the mean of the two middle ones, found by walking the cumulative counts
+        middle, seen, lower = (total - 1) // 2, 0, None
+        for rating, count in sorted(histogram.items()):
+            seen += count
+            if lower is None and seen > middle:
+                lower = rating
+            if seen > total // 2:
+                return lower if total % 2 == 1 else (lower + rating) / 2
+    mean = sum(rating * count for rating, count in histogram.items()) / total
+    if stat == 'average':
+        return mean
+    if stat == 'variance':
+        return sum(count * (rating - mean) ** 2 for rating, count in histogram.items()) / total
+    raise ValueError(f"stat must be 'average', 'median' or 'variance', got {stat!r}")
+
+
+def _movie_title(row:dict):
+    return row['title'] or f"Unknown {row['movieId']}"
 
 
 class Movies:
@@ -14,17 +677,20 @@ class Movies:
     Analyzing data from movies.csv
     """
 
+    @INSTRUMENTATION.measure
     def __init__(self, path_to_the_file):
         """
         Put here any fields that you think you will need.
         """
         self.movies = []
+        self._uid, self._revision = next(_DATASET_IDS), 0
         try:
-            with open(path_to_the_file, 'r', encoding='utf-8') as file:
-                headers = file.readline().strip().split(',')
+            with open_text(path_to_the_file) as file:
+                lines = _metered_lines(file)
+                headers = next(lines, '').strip().split(',')
                 if headers != ['movieId', 'title', 'genres']:
                     raise ValueError("Invalid file structure")
-                for line in file:
+                for line in lines:
                     row = line.strip().split(',')
                     if len(row) > 3:
                         title = ','.join(row[1:-1])
@@ -34,6 +700,55 @@ class Movies:
         except Exception as e:
             print(f"Exception: {e}")
 
+    def _rows_scanned(self):
+        return len(self.movies)
+
+    def data_version(self):
+        """
+        The method returns a value which changes whenever the data of the instance changes.
+        """
+        return (self._uid, self._revision, len(self.movies))
+
+    @classmethod
+    def from_rows(cls, rows:list):
+        """
+        The method returns a Movies instance over already parsed rows (dicts with movieId, title, genres as strings).
+        """
+        movies = cls.__new__(cls)
+        movies.movies = rows
+        movies._uid, movies._revision = next(_DATASET_IDS), 0
+        return movies
+
+    def to_arrow(self):
+        """
+        The method returns the movies as a typed pyarrow table (movieId int64, title, genres).
+        """
+        return _arrow_table('movies', {'movieId': [int(movie['movieId']) for movie in self.movies],
+                                       'title': [movie['title'] for movie in self.movies],
+                                       'genres': [movie['genres'] for movie in self.movies]})
+
+    @classmethod
+    def from_arrow(cls, table):
+        """
+        The method returns a Movies instance over a pyarrow table. It converts the table into the row dicts
+        of from_rows(), so the analyses run on rows, not on the columns.
+        """
+        movie_ids, titles, genres = (table.column(name).to_pylist() for name in ('movieId', 'title', 'genres'))
+        return cls.from_rows([{'movieId': str(movie_id), 'title': title, 'genres': genres}
+                              for movie_id, title, genres in zip(movie_ids, titles, genres)])
+
+    def save(self, path_to_the_file:str):
+        """
+        The method saves the movies as Parquet (.parquet) or Arrow (.arrow, .feather).
+        """
+        write_table(self.to_arrow(), path_to_the_file)
+
+    @classmethod
+    def load(cls, path_to_the_file:str):
+        return cls.from_arrow(read_table(path_to_the_file))
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def dist_by_release(self):
         """
         The method returns a dict or an OrderedDict where the keys are years and the values are counts. 
@@ -49,6 +764,8 @@ class Movies:
         release_years = dict(sorted(release_years.items(), key=lambda x: -x[1]))
         return release_years
 
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def dist_by_genres(self):
         """
         The method returns a dict where the keys are genres and the values are counts.
@@ -63,6 +780,8 @@ class Movies:
         genres = dict(sorted(genres.items(), key=lambda x: -x[1]))
         return genres
 
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def most_genres(self, n):
         """
         The method returns a dict with top-n movies where the keys are movie titles and 
@@ -73,6 +792,41 @@ class Movies:
         movies_genres = sorted(movies_genres, key=lambda x: -x[1])
         return dict(movies_genres[:n])
 
+    def _movie_groups(self, by:str):
+        """
+        The method returns a dict {movieId (int): list of groups} for by 'genre' or 'release_year'.
+        """
+        if by not in ('genre', 'release_year'):
+            raise ValueError(f"by must be 'genre' or 'release_year', got {by!r}")
+        groups = {}
+        for movie in self.movies:
+            if by == 'genre':
+                groups[int(movie['movieId'])] = [] if movie['genres'] == '(no genres listed)' else movie['genres'].split('|')
+            else:
+                match = re.search(r'\((\d{4})\)', movie['title'])
+                groups[int(movie['movieId'])] = [int(match.group(1))] if match else []
+        return groups
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def most_genres_per_group(self, n, by='release_year'):
+        """
+        The method returns most_genres for every group in one pass: a dict where the keys are release years
+        (by='release_year') or genres (by='genre') and the values are dicts of top-n movie titles and
+        their numbers of genres, sorted by numbers descendingly.
+        """
+        try:
+            groups = self._movie_groups(by)
+            triples = ((group, movie['title'], len(movie['genres'].split('|')))
+                       for movie in self.movies if movie['genres'] != '(no genres listed)'
+                       for group in groups[int(movie['movieId'])])
+            return {group: dict(top) for group, top in _top_per_group(triples, n).items()}
+        except Exception as e:
+            print(f"Exception in most_genres_per_group: {e}")
+            return {}
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def get_movies_by_year(self, year):
         """
         BONUS PART
@@ -93,26 +847,138 @@ class Tags:
     Analyzing data from tags.csv
     """
 
-    def __init__(self, path_to_the_file):
+    HEADERS = ['userId', 'movieId', 'tag', 'timestamp']
+
+    @INSTRUMENTATION.measure
+    def __init__(self, path_to_the_file, follow:bool = False, strict:bool = True, rejects_file:str = None,
+                 max_errors:int = None, max_error_rate:float = None, sample:Sampler = None):
         """
-        Put here any fields that you think you will need.
+        sample is the Sampler of the data lines to load, by default the first 1000.
+        With follow=True the whole file is read, or the lines kept by a 'fraction', 'users' or 'stratified' sample,
+        and refresh() later reads only the lines appended to it (other samples raise ValueError).
+        With strict=False malformed rows are skipped and reported by get_rejects() (and written to rejects_file)
+        instead of failing the load, within the error budget of max_errors and max_error_rate (see Rejects).
         """
         self.tags = []
+        self._uid, self._revision = next(_DATASET_IDS), 0
+        self._follow = None
+        keep = (sample or Sampler('first', None)).keeper() if follow else None
+        self._rejects = None if strict else Rejects(rejects_file, max_errors, max_error_rate)
         try:
-            with open(path_to_the_file, 'r') as file:
-                headers = file.readline().strip().split(',')
-                if headers != ['userId', 'movieId', 'tag', 'timestamp']:
+            if follow:
+                self._follow = {'path': path_to_the_file, 'offset': 0, 'line': 0, 'keep': keep}
+                self.refresh()
+                return
+            with open_text(path_to_the_file) as file:
+                lines = _metered_lines(file)
+                headers = next(lines, '').strip().split(',')
+                if headers != self.HEADERS:
                     raise ValueError("Invalid file structure")
-                for line_num, line in enumerate(file, 1):
-                    if line_num > 1000:
-                        break
-                    row = line.strip().split(',')
-                    if len(row) != 4:
-                        raise ValueError("Invalid representation of tag")
-                    self.tags.append(dict(zip(headers, row)))
+                tags = list(_parse_lines((sample or Sampler()).sample(lines), self._parse_row, self._rejects))
+            if self._rejects is not None:
+                self._rejects.check(len(tags) + len(self._rejects))
+            self.tags = tags
         except Exception as e:
             print(f"Exception: {e}")
 
+    def _rows_scanned(self):
+        return len(self.tags)
+
+    @classmethod
+    def _parse_row(cls, line:str, line_num:int):
+        row = line.strip().split(',')
+        if len(row) != 4:
+            raise ValueError(f"Invalid representation of tag in line {line_num}: {line}")
+        return dict(zip(cls.HEADERS, row))
+
+    def get_rejects(self):
+        """
+        The method returns the list of malformed rows skipped in lenient mode, as dicts {line, row, error}.
+        """
+        return list(getattr(self, '_rejects', None) or [])
+
+    @INSTRUMENTATION.measure
+    def refresh(self):
+        """
+        Follow mode: the method appends the rows written to the file since the last load or refresh
+        and returns their number. A truncated or replaced file is read again from the start, with new rejects.
+        In strict mode a malformed line raises ValueError and nothing is appended.
+        """
+        follow = getattr(self, '_follow', None)
+        if follow is None:
+            raise ValueError("The instance is not in follow mode")
+        lines, offset, follow['file'] = _read_appended(follow['path'], follow['offset'], follow.get('file'))
+        if offset is None:
+            self.tags = []
+            if self._rejects is not None:
+                # the rejects of the old file must not count against the budget of the new one
+                self._rejects = Rejects(self._rejects.path, self._rejects.max_errors, self._rejects.max_error_rate)
+            self._revision += 1
+            follow['offset'] = follow['line'] = 0
+            lines, offset, follow['file'] = _read_appended(follow['path'], 0)
+        line_num = follow['line']
+        if line_num == 0 and lines:
+            if lines[0].strip().split(',') != self.HEADERS:
+                raise ValueError("Invalid file structure")
+            lines, line_num = lines[1:], 1
+        INSTRUMENTATION.count('rows_scanned', len(lines))
+        rows = list(_parse_lines(((num, line) for num, line in enumerate(lines, line_num + 1) if follow['keep'](line)),
+                                 self._parse_row, self._rejects))
+        if self._rejects is not None:
+            self._rejects.check(len(self.tags) + len(rows) + len(self._rejects))
+        self.tags.extend(rows)
+        follow['offset'], follow['line'] = offset, line_num + len(lines)
+        if rows:
+            self._revision += 1
+        return len(rows)
+
+    def data_version(self):
+        """
+        The method returns a value which changes whenever the data of the instance changes.
+        """
+        return (self._uid, self._revision, len(self.tags))
+
+    @classmethod
+    def from_rows(cls, rows:list):
+        """
+        The method returns a Tags instance over already parsed rows (dicts with userId, movieId, tag, timestamp as strings).
+        """
+        tags = cls.__new__(cls)
+        tags.tags = rows
+        tags._uid, tags._revision = next(_DATASET_IDS), 0
+        return tags
+
+    def to_arrow(self):
+        """
+        The method returns the tags as a typed pyarrow table (userId, movieId, timestamp int64, tag).
+        """
+        return _arrow_table('tags', {'userId': [int(tag['userId']) for tag in self.tags],
+                                     'movieId': [int(tag['movieId']) for tag in self.tags],
+                                     'tag': [tag['tag'] for tag in self.tags],
+                                     'timestamp': [int(tag['timestamp']) for tag in self.tags]})
+
+    @classmethod
+    def from_arrow(cls, table):
+        """
+        The method returns a Tags instance over a pyarrow table, converted into the row dicts of from_rows().
+        """
+        user_ids, movie_ids, tags, timestamps = (table.column(name).to_pylist()
+                                                 for name in ('userId', 'movieId', 'tag', 'timestamp'))
+        return cls.from_rows([{'userId': str(user_id), 'movieId': str(movie_id), 'tag': tag, 'timestamp': str(timestamp)}
+                              for user_id, movie_id, tag, timestamp in zip(user_ids, movie_ids, tags, timestamps)])
+
+    def save(self, path_to_the_file:str):
+        """
+        The method saves the tags as Parquet (.parquet) or Arrow (.arrow, .feather).
+        """
+        write_table(self.to_arrow(), path_to_the_file)
+
+    @classmethod
+    def load(cls, path_to_the_file:str):
+        return cls.from_arrow(read_table(path_to_the_file))
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def most_words(self, n):
         """
         The method returns top-n tags with most words inside. It is a dict
@@ -123,6 +989,8 @@ class Tags:
         big_tags = sorted(big_tags, key=lambda x: -x[1])
         return dict(big_tags[:n])
 
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def longest(self, n):
         """
         The method returns top-n longest tags in terms of the number of characters.
@@ -132,6 +1000,8 @@ class Tags:
         big_tags = sorted(big_tags, key=lambda x: -x[1])
         return dict(big_tags[:n])
 
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def most_words_and_longest(self, n):
         """
         The method returns the intersection between top-n tags with most words inside and 
@@ -144,6 +1014,8 @@ class Tags:
         big_tags = most_words_tags & longest_tags
         return list(sorted(big_tags))
 
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def most_popular(self, n):
         """
         The method returns the most popular tags. 
@@ -154,6 +1026,45 @@ class Tags:
         popular_tags=Counter(all_tags).most_common(n)
         return dict(popular_tags)
 
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def most_popular_per_group(self, n, by='year', movies=None):
+        """
+        The method returns most_popular for every group in one pass over the tags: a dict where the keys are
+        the groups and the values are dicts of the top-n tags and their counts, sorted by counts descendingly.
+        by is 'year' (of the tag timestamp), 'movieId', 'userId', or 'release_year' or 'genre' of the movie,
+        which need the Movies instance in movies.
+        """
+        try:
+            if by in ('release_year', 'genre'):
+                if movies is None:
+                    raise ValueError(f"by={by!r} needs the Movies instance")
+                movie_groups = movies._movie_groups(by)
+                def group_of(tag):
+                    return movie_groups.get(int(tag['movieId']), [])
+            elif by == 'year':
+                def group_of(tag):
+                    return [datetime.fromtimestamp(int(tag['timestamp'])).year]
+            elif by in ('movieId', 'userId'):
+                def group_of(tag):
+                    return [int(tag[by])]
+            else:
+                raise ValueError(f"by must be 'year', 'movieId', 'userId', 'release_year' or 'genre', got {by!r}")
+            counts = Counter((group, tag['tag']) for tag in self.tags for group in group_of(tag))
+            triples = ((group, tag, count) for (group, tag), count in counts.items())
+            return {group: dict(top) for group, top in _top_per_group(triples, n).items()}
+        except Exception as e:
+            print(f"Exception in most_popular_per_group: {e}")
+            return {}
+
+    def partial_state(self):
+        """
+        The method returns the mergeable TagsState of the tags.
+        """
+        return TagsState.from_rows(self.tags)
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def tags_with(self, word):
         """
         The method returns all unique tags that include the word given as the argument.
@@ -161,6 +1072,8 @@ class Tags:
         """
         tags_with_word={tag['tag'] for tag in self.tags if word in tag['tag']}
         return sorted(tags_with_word)
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
     def movie_by_tag(self, given_tag):
         """
         BONUS PART
@@ -175,44 +1088,40 @@ class Ratings:
     """
     Analyzing data from ratings.csv
     """
-    def __init__(self, path_to_the_file="./datasets/ratings.csv", path_to_movies_file="../datasets/movies.csv"):
+    @INSTRUMENTATION.measure
+    def __init__(self, path_to_the_file="./datasets/ratings.csv", path_to_movies_file=MOVIE_CSV_FILE, movie_titles=None,
+                 follow=False, strict=True, rejects_file=None, max_errors=None, max_error_rate=None, sample=None):
+        """
+        movie_titles is an already loaded dict {movieId: title}, e.g. MovieLensCatalog.titles().
+        When it is given, movies.csv is not read again.
+        sample is the Sampler of the data lines to load, by default the first 1000.
+        With follow=True the whole file is read, or the lines kept by a 'fraction', 'users' or 'stratified' sample,
+        and refresh() later reads only the lines appended to it (other samples raise ValueError).
+        With strict=False malformed rows are skipped and reported by get_rejects() (and written to rejects_file)
+        instead of discarding the whole load, within the error budget of max_errors and max_error_rate (see Rejects).
+        """
+        self._uid, self._revision = next(_DATASET_IDS), 0
+        self._follow = None
+        keep = (sample or Sampler('first', None)).keeper() if follow else None
+        self._rejects = None if strict else Rejects(rejects_file, max_errors, max_error_rate)
         try:
             self.data_ratings = []
             self.data_joined = []
-            movieid_to_title = {}
-            try:
-                with open(path_to_movies_file, 'r', encoding='utf-8') as movies_file:
-                    movies_file.readline()  
-                    for line in movies_file:
-                        values = line.strip().split(',')
-                        if len(values) < 3:
-                            continue
-                        movie_id = int(values[0])
-                        title = ','.join(values[1:-1]).strip('"')
-                        movieid_to_title[movie_id] = title
-            except FileNotFoundError:
-                print(f"File not found: {path_to_movies_file}")
-            except Exception as e:
-                print(f"Exception while reading movies.csv: {e}")
-            with open(path_to_the_file, 'r', encoding='utf-8') as ratings:
-                headers = ratings.readline().strip().split(',')
-                for i, line in enumerate(ratings):
-                    if i >= 1000:
-                        break
-                    values = line.strip().split(',')
-                    if len(values) != 4:
-                        raise ValueError(f"Incorrect format in line {i+2}: {line}")
-                    movie_id = int(values[1])
-                    title = movieid_to_title.get(movie_id, None)
-                    row = {
-                        'userId': int(values[0]),
-                        'movieId': movie_id,
-                        'title': title,
-                        'rating': float(values[2]),
-                        'timestamp': int(values[3])
-                    }
-                    self.data_ratings.append(row)
-                    self.data_joined.append(row)
+            movieid_to_title = movie_titles if movie_titles is not None else self.read_titles(path_to_movies_file)
+            if follow:
+                self._follow = {'path': path_to_the_file, 'offset': 0, 'line': 0, 'titles': movieid_to_title,
+                                'keep': keep}
+                self.refresh()
+                return
+            with open_text(path_to_the_file) as ratings:
+                lines = _metered_lines(ratings)
+                headers = next(lines, '').strip().split(',')
+                self.data_ratings.extend(_parse_lines(
+                    (sample or Sampler()).sample(lines),
+                    lambda line, line_num: self._parse_row(line, line_num, movieid_to_title), self._rejects))
+                self.data_joined.extend(self.data_ratings)
+            if self._rejects is not None:
+                self._rejects.check(len(self.data_joined) + len(self._rejects))
         except FileNotFoundError:
             print(f"File not found: {path_to_the_file}")
             self.data_ratings = []
@@ -226,39 +1135,192 @@ class Ratings:
             self.data_ratings = []
             self.data_joined = []
 
-    class Movies:
-        def __init__(self, parent):
-            self.parent = parent  
-        def dist_by_year(self):
-            """
-            The method returns a dict where the keys are years and the values are counts. 
-            Sort it by years ascendingly. You need to extract years from timestamps.
-            """
-            try:
-                ratings_by_year = {}
-                for data in self.parent.data_joined: 
-                    year = datetime.fromtimestamp(data['timestamp']).year
-                    ratings_by_year[year] = ratings_by_year.get(year, 0) + 1
-                ratings_by_year = dict(sorted(ratings_by_year.items()))
-                return ratings_by_year
-            except Exception as e:
-                print(f"Exception in dist_by_year: {e}")
-                return  {}
-        def dist_by_rating(self):
-            """
-            The method returns a dict where the keys are ratings and the values are counts.
-         Sort it by ratings ascendingly.
-            """
-            try:
-                ratings_by_amount = {}
-                for data in self.parent.data_joined: 
-                    rating = data['rating']
-                    ratings_by_amount[rating] = ratings_by_amount.get(rating, 0) + 1
-                ratings_by_amount = dict(sorted(ratings_by_amount.items()))
-                return ratings_by_amount
-            except Exception as e:
+    def _rows_scanned(self):
+        return len(self.data_joined)
+
+    def data_version(self):
+        """
+        The method returns a value which changes whenever the data of the instance changes.
+        """
+        return (self._uid, self._revision, len(self.data_joined))
+
+    @staticmethod
+    def _parse_row(line:str, line_num:int, movieid_to_title:dict):
+        values = line.strip().split(',')
+        if len(values) != 4:
+            raise ValueError(f"Incorrect format in line {line_num}: {line}")
+        movie_id = int(values[1])
+        return {
+            'userId': int(values[0]),
+            'movieId': movie_id,
+            'title': movieid_to_title.get(movie_id, None),
+            'rating': float(values[2]),
+            'timestamp': int(values[3])
+        }
+
+    def get_rejects(self):
+        """
+        The method returns the list of malformed rows skipped in lenient mode, as dicts {line, row, error}.
+        """
+        return list(getattr(self, '_rejects', None) or [])
+
+    def partial_state(self):
+        """
+        The method returns the mergeable RatingsState of the ratings.
+        """
+        return RatingsState.from_rows(self.data_joined)
+
+    @INSTRUMENTATION.measure
+    def refresh(self):
+        """
+        Follow mode: the method appends the ratings written to the file since the last load or refresh
+        and returns their number. The memoized analyses of the instance and its Movies and Users views
+        are recomputed on the next call. A truncated or replaced file is read again from the start, with new rejects.
+        In strict mode a malformed line raises ValueError and nothing is appended.
+        """
+        follow = getattr(self, '_follow', None)
+        if follow is None:
+            raise ValueError("The instance is not in follow mode")
+        lines, offset, follow['file'] = _read_appended(follow['path'], follow['offset'], follow.get('file'))
+        if offset is None:
+            self.data_ratings, self.data_joined = [], []
+            if self._rejects is not None:
+                # the rejects of the old file must not count against the budget of the new one
+                self._rejects = Rejects(self._rejects.path, self._rejects.max_errors, self._rejects.max_error_rate)
+            self._revision += 1
+            follow['offset'] = follow['line'] = 0
+            lines, offset, follow['file'] = _read_appended(follow['path'], 0)
+        line_num = follow['line']
+        if line_num == 0 and lines:
+            if lines[0].strip().split(',') != ['userId', 'movieId', 'rating', 'timestamp']:
+                raise ValueError("Invalid file structure")
+            lines, line_num = lines[1:], 1
+        INSTRUMENTATION.count('rows_scanned', len(lines))
+        rows = list(_parse_lines(((num, line) for num, line in enumerate(lines, line_num + 1) if follow['keep'](line)),
+                                 lambda line, num: self._parse_row(line, num, follow['titles']), self._rejects))
+        if self._rejects is not None:
+            self._rejects.check(len(self.data_joined) + len(rows) + len(self._rejects))
+        self.data_ratings.extend(rows)
+        self.data_joined.extend(rows)
+        follow['offset'], follow['line'] = offset, line_num + len(lines)
+        if rows:
+            self._revision += 1
+        return len(rows)
+
+    @classmethod
+    def from_rows(cls, rows:list):
+        """
+        The method returns a Ratings instance over already parsed rows
+        (dicts with userId, movieId, title, rating, timestamp).
+        """
+        ratings = cls.__new__(cls)
+        ratings.data_ratings = rows
+        ratings.data_joined = list(rows)
+        ratings._uid, ratings._revision = next(_DATASET_IDS), 0
+        return ratings
+
+    def to_arrow(self):
+        """
+        The method returns the joined ratings as a typed pyarrow table
+        (userId, movieId, timestamp int64, rating float64, title).
+        """
+        rows = self.data_joined
+        return _arrow_table('ratings', {name: [row[name] for row in rows]
+                                        for name in ('userId', 'movieId', 'rating', 'timestamp', 'title')})
+
+    @classmethod
+    def from_arrow(cls, table, movie_titles:dict = None):
+        """
+        The method returns a Ratings instance over a pyarrow table, converted into the row dicts of from_rows().
+        Tables without a title column (e.g. written by convert_csv) are joined with movie_titles.
+        """
+        user_ids, movie_ids, ratings, timestamps = (table.column(name).to_pylist()
+                                                    for name in ('userId', 'movieId', 'rating', 'timestamp'))
+        if 'title' in table.column_names:
+            titles = table.column('title').to_pylist()
+        else:
+            titles = map((movie_titles or {}).get, movie_ids)
+        return cls.from_rows([{'userId': user_id, 'movieId': movie_id, 'title': title, 'rating': rating,
+                               'timestamp': timestamp}
+                              for user_id, movie_id, title, rating, timestamp
+                              in zip(user_ids, movie_ids, titles, ratings, timestamps)])
+
+    def save(self, path_to_the_file:str):
+        """
+        The method saves the joined ratings as Parquet (.parquet) or Arrow (.arrow, .feather).
+        """
+        write_table(self.to_arrow(), path_to_the_file)
+
+    @classmethod
+    def load(cls, path_to_the_file:str, movie_titles:dict = None):
+        return cls.from_arrow(read_table(path_to_the_file), movie_titles)
+
+    @staticmethod
+    def read_titles(path_to_movies_file):
+        """
+        The method returns a dict {movieId: title} read from movies.csv, with the quotes stripped from the titles.
+        """
+        movieid_to_title = {}
+        try:
+            with open_text(path_to_movies_file) as movies_file:
+                lines = _metered_lines(movies_file)
+                next(lines, '')
+                for line in lines:
+                    values = line.strip().split(',')
+                    if len(values) < 3:
+                        continue
+                    movie_id = int(values[0])
+                    title = ','.join(values[1:-1]).strip('"')
+                    movieid_to_title[movie_id] = title
+        except FileNotFoundError:
+            print(f"File not found: {path_to_movies_file}")
+        except Exception as e:
+            print(f"Exception while reading movies.csv: {e}")
+        return movieid_to_title
+
+    class Movies:
+        def __init__(self, parent):
+            self.parent = parent  
+        def _rows_scanned(self):
+            return len(self.parent.data_joined)
+        def data_version(self):
+            return self.parent.data_version()
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
+        def dist_by_year(self):
+            """
+            The method returns a dict where the keys are years and the values are counts. 
+            Sort it by years ascendingly. You need to extract years from timestamps.
+            """
+            try:
+                ratings_by_year = {}
+                for data in self.parent.data_joined: 
+                    year = datetime.fromtimestamp(data['timestamp']).year
+                    ratings_by_year[year] = ratings_by_year.get(year, 0) + 1
+                ratings_by_year = dict(sorted(ratings_by_year.items()))
+                return ratings_by_year
+            except Exception as e:
+                print(f"Exception in dist_by_year: {e}")
+                return  {}
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
+        def dist_by_rating(self):
+            """
+            The method returns a dict where the keys are ratings and the values are counts.
+         Sort it by ratings ascendingly.
+            """
+            try:
+                ratings_by_amount = {}
+                for data in self.parent.data_joined: 
+                    rating = data['rating']
+                    ratings_by_amount[rating] = ratings_by_amount.get(rating, 0) + 1
+                ratings_by_amount = dict(sorted(ratings_by_amount.items()))
+                return ratings_by_amount
+            except Exception as e:
                 print(f"Exception in dist_by_rating: {e}")
                 return {}
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def top_by_num_of_ratings(self, n):
             """
             The method returns top-n movies by the number of ratings. 
@@ -266,16 +1328,8 @@ class Ratings:
      Sort it by numbers descendingly.
             """
             try:
-                movie_counts = {}
-                for data in self.parent.data_joined:
-                    title = data['title'] or f"Unknown {data['movieId']}"
-                    movie_counts[title] = movie_counts.get(title, 0) + 1
-                total_movies = len(movie_counts)
-                if not (1 <= n <= total_movies):
-                    raise ValueError(f"n must be between 1 and {total_movies}, got {n}")
-                sorted_movies = sorted(movie_counts.items(), key=lambda x: x[1], reverse=True)
-                top_by_num_of_ratings = dict(sorted_movies[:n])
-                return top_by_num_of_ratings
+                movie_counts = Counter(_movie_title(data) for data in self.parent.data_joined)
+                return _top_values(dict(movie_counts), n)
             except ValueError as ve:
                 print(f"ValueError in top_by_num_of_ratings: {ve}")
                 return {}
@@ -293,6 +1347,8 @@ class Ratings:
                 return s[mid]
             else:
                 return (s[mid - 1] + s[mid]) / 2
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def top_by_ratings(self, n, metric='average'):
             """
             The method returns top-n movies by the average or median of the ratings.
@@ -301,34 +1357,19 @@ class Ratings:
             The values should be rounded to 2 decimals.
             """
             try:
-                ratings_by_movie = {}
-                for data in self.parent.data_joined:
-                    title = data['title'] or f"Unknown {data['movieId']}"
-                    rating = data['rating']
-                    if title not in ratings_by_movie:
-                        ratings_by_movie[title] = []
-                    ratings_by_movie[title].append(rating)
-                total_movies = len(ratings_by_movie)
-                if not (1 <= n <= total_movies):
-                    raise ValueError(f"n must be between 1 and {total_movies}, got {n}")
                 if metric not in ('average', 'median'):
                     raise ValueError("metric must be 'average' or 'median'")
-                movie_metric = {}
-                for title, ratings in ratings_by_movie.items():
-                    if metric == 'average':
-                        value = round(sum(ratings) / len(ratings), 2)
-                    elif metric == 'median':
-                        value = round(self.median(ratings), 2)
-                    movie_metric[title] = value
-                sorted_movies = sorted(movie_metric.items(), key=lambda x: x[1], reverse=True)
-                top_by_ratings = dict(sorted_movies[:n])
-                return top_by_ratings
+                histograms = _rating_histograms(self.parent.data_joined, _movie_title)
+                return _top_values({title: round(_histogram_stat(histogram, metric), 2)
+                                    for title, histogram in histograms.items()}, n)
             except ValueError as ve:
                 print(f"ValueError in top_by_ratings: {ve}")
                 return {}
             except Exception as e:
                 print(f"Exception in top_by_ratings: {e}")
                 return {}
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def top_controversial(self, n):
             """
             The method returns top-n movies by the variance of the ratings.
@@ -337,28 +1378,15 @@ class Ratings:
             The values should be rounded to 2 decimals.
             """
             try:
-                ratings_by_movie = {}
-                for data in self.parent.data_joined:
-                    title = data['title'] or f"Unknown {data['movieId']}"
-                    rating = data['rating']
-                    if title not in ratings_by_movie:
-                        ratings_by_movie[title] = []
-                    ratings_by_movie[title].append(rating)
-                total_movies = len(ratings_by_movie)
-                if not (1 <= n <= total_movies):
-                    raise ValueError(f"n must be between 1 and {total_movies}, got {n}")
-                movie_variance = {}
-                for title, ratings in ratings_by_movie.items():
-                    mean = sum(ratings) / len(ratings)
-                    variance = sum((r - mean) ** 2 for r in ratings) / len(ratings)
-                    movie_variance[title] = round(variance, 2)
-                sorted_movies = sorted(movie_variance.items(), key=lambda x: x[1], reverse=True)
-                top_controversial = dict(sorted_movies[:n])
-                return top_controversial
+                histograms = _rating_histograms(self.parent.data_joined, _movie_title)
+                return _top_values({title: round(_histogram_stat(histogram, 'variance'), 2)
+                                    for title, histogram in histograms.items()}, n)
             except Exception as e:
                 print(f"Exception in top_controversial: {e}")
                 return {}
 
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def most_active_user_by_coverage(self):
             """
             extra - Returns (userId, percent) — пользователя, который оценил наибольший процент фильмов из выборки,
@@ -386,39 +1414,83 @@ class Ratings:
                 print(f"Exception in most_active_user_by_coverage: {e}")
                 return (None, 0)
 
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def percent_of_max_ratings_per_movie(self, n=None):
             """
             Returns a dict {title: percent}, где percent — процент оценок 5.0 от всех оценок этого фильма (0-100, округлён до 2 знаков).
             Если n задан, возвращает только топ-n фильмов по проценту оценок 5.0.
             """
             try:
-                movie_counts = {}
-                movie_max_counts = {}
-                for data in self.parent.data_joined:
-                    title = data['title'] or f"Unknown {data['movieId']}"
-                    rating = data['rating']
-                    movie_counts[title] = movie_counts.get(title, 0) + 1
-                    if rating == 5.0:
-                        movie_max_counts[title] = movie_max_counts.get(title, 0) + 1
-                percent_dict = {}
-                for title in movie_counts:
-                    percent = (movie_max_counts.get(title, 0) / movie_counts[title] * 100) if movie_counts[title] else 0
-                    percent_dict[title] = round(percent, 2)
-                sorted_percent_dict = dict(sorted(percent_dict.items(), key=lambda x: x[1], reverse=True))
-                if n is not None:
-                    total_movies = len(sorted_percent_dict)
-                    if not (1 <= n <= total_movies):
-                        raise ValueError(f"n must be between 1 and {total_movies}, got {n}")
-                    items = list(sorted_percent_dict.items())[:n]
-                    return dict(items)
-                return sorted_percent_dict
+                histograms = _rating_histograms(self.parent.data_joined, _movie_title)
+                percents = {title: round(histogram.get(5.0, 0) / sum(histogram.values()) * 100, 2)
+                            for title, histogram in histograms.items()}
+                return _top_values(percents, len(percents) if n is None else n) if percents else {}
             except Exception as e:
                 print(f"Exception in percent_of_max_ratings_per_movie: {e}")
                 return {}
+        def _ratings_per_group(self, by, movies):
+            # {(group, title): {rating: count}}, like _rating_histograms() with a row in several groups
+            if by in ('genre', 'release_year'):
+                if movies is None:
+                    raise ValueError(f"by={by!r} needs the Movies instance")
+                movie_groups = movies._movie_groups(by)
+                def group_of(data):
+                    return movie_groups.get(data['movieId'], [])
+            elif by == 'year':
+                def group_of(data):
+                    return [datetime.fromtimestamp(data['timestamp']).year]
+            else:
+                raise ValueError(f"by must be 'genre', 'release_year' or 'year', got {by!r}")
+            histograms = {}
+            for data in self.parent.data_joined:
+                title = _movie_title(data)
+                for group in group_of(data):
+                    histogram = histograms.get((group, title))
+                    if histogram is None:
+                        histogram = histograms[(group, title)] = {}
+                    histogram[data['rating']] = histogram.get(data['rating'], 0) + 1
+            return histograms
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
+        def top_by_ratings_per_group(self, n, by='genre', metric='average', movies=None, min_ratings=1):
+            """
+            The method returns top_by_ratings for every group in one pass over the ratings, e.g. the top 5 movies
+            of every genre. It is a dict where the keys are genres or release years of the movies (these need
+            the Movies instance in movies) or years of the ratings (by='year'), and the values are dicts of
+            the top-n movie titles with at least min_ratings ratings in the group and their metric values,
+            sorted by metric descendingly. The values are rounded to 2 decimals.
+            """
+            try:
+                if metric not in ('average', 'median'):
+                    raise ValueError("metric must be 'average' or 'median'")
+                triples = ((group, title, round(_histogram_stat(histogram, metric), 2))
+                           for (group, title), histogram in self._ratings_per_group(by, movies).items()
+                           if sum(histogram.values()) >= min_ratings)
+                return {group: dict(top) for group, top in _top_per_group(triples, n).items()}
+            except Exception as e:
+                print(f"Exception in top_by_ratings_per_group: {e}")
+                return {}
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
+        def top_by_num_of_ratings_per_group(self, n, by='genre', movies=None):
+            """
+            The method returns top_by_num_of_ratings for every group in one pass over the ratings.
+            The groups are the same as in top_by_ratings_per_group.
+            """
+            try:
+                triples = ((group, title, sum(histogram.values()))
+                           for (group, title), histogram in self._ratings_per_group(by, movies).items())
+                return {group: dict(top) for group, top in _top_per_group(triples, n).items()}
+            except Exception as e:
+                print(f"Exception in top_by_num_of_ratings_per_group: {e}")
+                return {}
 
     class Users(Movies):
         def __init__(self, parent):
             super().__init__(parent)
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def users_distribution(self):
             try:
                 users_distribution = {}
@@ -429,48 +1501,24 @@ class Ratings:
             except Exception as e:
                 print(f"Exception in users_distribution: {e}")
                 return {}
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def users_rating_distribution(self, metric='average'):
             try:
-                users_rating_distribution = {}
-                for data in self.parent.data_joined: 
-                    userid = data['userId']
-                    rating = data['rating']
-                    if userid not in users_rating_distribution:
-                        users_rating_distribution[userid] = []
-                    users_rating_distribution[userid].append(rating)
                 if metric not in ('average', 'median'):
                     raise ValueError("metric must be 'average' or 'median'")
-                av_rating = {}
-                for userid, ratings in users_rating_distribution.items():
-                    if metric == 'average':
-                        value = round(sum(ratings) / len(ratings), 2)
-                    elif metric == 'median':
-                        value = round(self.median(ratings), 2)
-                    av_rating[userid] = value
-                return av_rating
+                histograms = _rating_histograms(self.parent.data_joined, lambda data: data['userId'])
+                return {userid: round(_histogram_stat(histogram, metric), 2) for userid, histogram in histograms.items()}
             except Exception as e:
                 print(f"Exception in users_rating_distribution: {e}")
                 return {}
+        @INSTRUMENTATION.measure
+        @RESULT_CACHE.memoize
         def top_n_users_by_variance(self, n):
             try:
-                users_ratings = {}
-                for data in self.parent.data_joined: 
-                    userid = data['userId']
-                    rating = data['rating']
-                    if userid not in users_ratings:
-                        users_ratings[userid] = []
-                    users_ratings[userid].append(rating)
-                total_users = len(users_ratings)
-                if not (1 <= n <= total_users):
-                    raise ValueError(f"n must be between 1 and {total_users}, got {n}")
-                user_variance = {}
-                for userid, ratings in users_ratings.items():
-                    mean = sum(ratings) / len(ratings)
-                    variance = sum((r - mean) ** 2 for r in ratings) / len(ratings)
-                    user_variance[userid] = round(variance, 2)
-                sorted_users = sorted(user_variance.items(), key=lambda x: x[1], reverse=True)
-                top_n = dict(sorted_users[:n])
-                return top_n
+                histograms = _rating_histograms(self.parent.data_joined, lambda data: data['userId'])
+                return _top_values({userid: round(_histogram_stat(histogram, 'variance'), 2)
+                                    for userid, histogram in histograms.items()}, n)
             except Exception as e:
                 print(f"Exception in top_n_users_by_variance: {e}")
                 return {}
@@ -480,238 +1528,1994 @@ class Links:
     """
     Analyzing data from links.csv
     """
-    def __init__(self, path_to_the_file:str, lenght:int = 1000):
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+    EXTRACTORS = {
+        "Director": {
+            'selector': 'a',
+            'attrs': {'href': re.compile(r'/name/nm\d+/')}
+        },
+        "Budget": {
+            'search_text': 'Budget'
+        },
+        "Cumulative Worldwide Gross": {
+            'search_text': 'Gross worldwide'
+        },
+        "Runtime": {
+            'search_text': 'Runtime'
+        },
+        "Title": {
+            'selectors': [
+                {'selector': 'h1', 'attrs': {}}
+            ]
+        },
+        "Rating": {
+            'search_text': 'IMDb RATING'
+        }
+    }
+
+    CURRENCY_RATES = {
+        '$': 1.0,      
+        'U': 1.0,
+        '¥': 0.0067,   
+        '€': 1.09,     
+        'E': 1.09,
+        'C': 0.7276,   
+        '£': 1.26,     
+        '₹': 0.012,    
+        'R': 0.18,     
+        '₽': 0.011,    
+        'R': 0.011   
+    }
+
+    @INSTRUMENTATION.measure
+    def __init__(self, path_to_the_file:str, lenght:int = 1000, retries:int = 3, backoff:float = 0.5,
+                 max_backoff:float = 30.0, breaker_threshold:int = 5, breaker_cooldown:float = 60.0,
+                 timeout:float = 10.0, fetch_workers:int = 8, parse_workers:int = None, metadata_file:str = None,
+                 strict:bool = True, id_range:tuple = None, shard:tuple = None, rejects_file:str = None,
+                 max_errors:int = None, max_error_rate:float = None):
+        """
+        Loads the first lenght rows of links.csv, or the whole file if lenght is None.
+        With strict=False malformed rows are skipped and reported by get_rejects() (and written to rejects_file)
+        instead of raising ValueError, within the error budget of max_errors and max_error_rate (see Rejects).
+        id_range=(low, high) keeps only low <= movieId < high, shard=(index, count) keeps only the movies
+        with shard_of(movieId, count) == index, so disjoint slices can be enriched by different workers and merged.
+        IMDB pages are fetched by fetch_workers threads and parsed by parse_workers processes (None for one
+        per CPU, 0 to parse them in the calling thread, see iter_imdb).
+        """
+        self.__setup(retries=retries, backoff=backoff, max_backoff=max_backoff, breaker_threshold=breaker_threshold,
+                     breaker_cooldown=breaker_cooldown, timeout=timeout, fetch_workers=fetch_workers,
+                     parse_workers=parse_workers, strict=strict, rejects_file=rejects_file, max_errors=max_errors,
+                     max_error_rate=max_error_rate)
+        lines_read = 0
+        for movie_id, imdb_id, tmdb_id in self.iter_rows(path_to_the_file, lenght, None if strict else self.__rejects):
+            lines_read += 1
+            if id_range is not None and not id_range[0] <= movie_id < id_range[1]:
+                continue
+            if shard is not None and self.shard_of(movie_id, shard[1]) != shard[0]:
+                continue
+            self.__movie_to_imdb[movie_id] = imdb_id
+            self.__movie_to_tmdb[movie_id] = tmdb_id
+        self.__rejects.check(lines_read + len(self.__rejects))
+        if metadata_file is not None:
+            self.load_metadata(metadata_file)
+
+    @classmethod
+    def empty(cls, **kwargs):
+        """
+        The method returns a Links instance without movies, e.g. to merge() the slices of other instances into.
+        kwargs are the options of the constructor, except the ones which select the rows of links.csv.
+        """
+        links = cls.__new__(cls)
+        links.__setup(**kwargs)
+        return links
+
+    def __setup(self, retries:int = 3, backoff:float = 0.5, max_backoff:float = 30.0, breaker_threshold:int = 5,
+                breaker_cooldown:float = 60.0, timeout:float = 10.0, fetch_workers:int = 8, parse_workers:int = None,
+                strict:bool = True, rejects_file:str = None, max_errors:int = None, max_error_rate:float = None):
+        if retries < 0:
+            raise ValueError(f"retries must be non-negative, got {retries}")
         self.__movie_to_imdb = {}
+        self.__movie_to_tmdb = {}
+        self._uid, self._revision = next(_DATASET_IDS), 0
         self.__fields = ["Director", "Budget", "Cumulative Worldwide Gross", "Runtime", "Title", "Rating"]
         self.__parsed_data = {}
+        self.__imdb_table = None
+        self.__failures = {}
+        self.__loaded = False
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__timeout = timeout
+        self.__breaker_threshold = breaker_threshold
+        self.__breaker_cooldown = breaker_cooldown
+        self.__consecutive_failures = 0
+        self.__breaker_open_until = 0.0
+        self.__breaker_lock = threading.Lock()
+        self.__http_requests = 0
+        self.__http_bytes = 0
+        self.__fetch_workers = fetch_workers
+        self.__parse_workers = parse_workers
         self.__session = requests.Session()
         self.__session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
             'Accept-Language': 'en-US,en;q=0.9',
             'Accept-Encoding': 'gzip, deflate, br'
         })
-        with open(path_to_the_file, 'r') as file:
-            headers = file.readline().strip().split(',')
+        self.__rejects = Rejects() if strict else Rejects(rejects_file, max_errors, max_error_rate)
+
+    @staticmethod
+    def iter_rows(path_to_the_file:str, lenght:int = None, rejects:list = None):
+        """
+        The method streams links.csv and yields (movieId, imdbId, tmdbId) for the first lenght rows
+        (all rows if lenght is None). Malformed rows raise ValueError, or are appended to rejects as dicts
+        {line, row, error} and skipped if a rejects list is given.
+        """
+        with open_text(path_to_the_file) as file:
+            lines = _metered_lines(file)
+            headers = next(lines, '').strip().split(',')
             if headers != ['movieId', 'imdbId', 'tmdbId']:
                 raise ValueError("Invalid file structure, expected headers: ['movieId', 'imdbId', 'tmdbId']")
-            i = 0
-            while i < lenght:
-                i+=1
-                parts = file.readline().strip().split(',')
-                if len(parts) != 3 or parts[0] == '' or parts[1] == '' or parts[2] == '':
-                    raise ValueError("Invalid file structure, expected 3 non-empty columns per row")
-                movie_id, imdb_id, _ = parts
-                self.__movie_to_imdb[int(movie_id)] = imdb_id
-                
+            numbered = enumerate(lines, 2)
+            if lenght is not None:
+                numbered = itertools.islice(numbered, max(lenght, 0))
+            for line_num, line in numbered:
+                parts = line.strip().split(',')
+                try:
+                    if len(parts) != 3 or parts[0] == '' or parts[1] == '' or parts[2] == '':
+                        raise ValueError("Invalid file structure, expected 3 non-empty columns per row")
+                    int(parts[1])
+                    row = (int(parts[0]), parts[1], int(parts[2]))
+                except ValueError as e:
+                    if rejects is None:
+                        raise
+                    rejects.append({'line': line_num, 'row': line.rstrip('\n'), 'error': str(e)})
+                    continue
+                yield row
+
+    @staticmethod
+    def shard_of(movie_id:int, count:int):
+        """
+        The method returns the hash partition (0 <= shard < count) of the movie. It is stable across processes and machines.
+        """
+        return (movie_id * 2654435761 & 0xFFFFFFFF) % count
+
+    @classmethod
+    def split_ranges(cls, path_to_the_file:str, count:int):
+        """
+        The method returns a list of count (low, high) movieId ranges for the id_range argument, which
+        cover the whole file and hold roughly the same number of rows each. Malformed rows are ignored.
+        """
+        if count < 1:
+            raise ValueError(f"count must be positive, got {count}")
+        ids = sorted(movie_id for movie_id, _, _ in cls.iter_rows(path_to_the_file, rejects=[]))
+        if not ids:
+            return [(0, 0)] * count
+        bounds = [ids[0]] + [ids[len(ids) * i // count] for i in range(1, count)] + [ids[-1] + 1]
+        return [(bounds[i], bounds[i + 1]) for i in range(count)]
+
+    def get_rejects(self):
+        """
+        The method returns the list of malformed rows skipped while loading, as dicts {line, row, error}.
+        """
+        return list(self.__rejects)
+
+    def get_state(self):
+        """
+        The method returns the loaded ids, the parsed IMDB data and the failures as plain dicts,
+        which can be sent between processes and passed to merge().
+        """
+        return {'imdb': dict(self.__movie_to_imdb), 'tmdb': dict(self.__movie_to_tmdb),
+                'parsed': {movie_id: dict(data) for movie_id, data in self.__parsed_data.items()},
+                'failures': self.get_failures(), 'rejects': self.get_rejects()}
+
+    @INSTRUMENTATION.measure
+    def merge(self, other):
+        """
+        The method merges the movies of another Links instance (or its get_state()) loaded from
+        a disjoint slice into this one. Returns self.
+        """
+        state = other.get_state() if isinstance(other, Links) else other
+        INSTRUMENTATION.count('rows_scanned', len(state['imdb']))
+        self.__movie_to_imdb.update(state['imdb'])
+        self.__movie_to_tmdb.update(state['tmdb'])
+        for movie_id, movie_data in state['parsed'].items():
+            self.__store(movie_id, dict(movie_data))
+            self.__failures.pop(movie_id, None)
+        for movie_id, failure in state['failures'].items():
+            if movie_id not in self.__parsed_data:
+                self.__failures[movie_id] = dict(failure)
+        self.__rejects.extend(state['rejects'])
+        self._revision += 1
+        self.__loaded = self.__loaded and all(movie_id in self.__parsed_data or movie_id in self.__failures
+                                              for movie_id in self.__movie_to_imdb)
+        return self
+
     def get_ids_dict(self):
         return self.__movie_to_imdb
+
+    def _rows_scanned(self):
+        # the rankings scan the parsed IMDB data; the loaders, merge() and get_imdb() count their own rows
+        return len(self.__parsed_data)
+
+    def data_version(self):
+        """
+        The method returns a value which changes whenever the ids or the parsed IMDB data change.
+        """
+        return (self._uid, self._revision, len(self.__movie_to_imdb))
+
+    def to_arrow(self):
+        """
+        The method returns the ids and the parsed IMDB data as a typed pyarrow table, one row per movie.
+        The parsed column tells if the IMDB fields were parsed.
+        """
+        movie_ids = sorted(self.__movie_to_imdb)
+        columns = {'movieId': movie_ids, 'imdbId': [self.__movie_to_imdb[movie_id] for movie_id in movie_ids],
+                   'tmdbId': [self.__movie_to_tmdb.get(movie_id) for movie_id in movie_ids],
+                   'parsed': [movie_id in self.__parsed_data for movie_id in movie_ids]}
+        for field in self.__fields:
+            columns[field] = [self.__parsed_data.get(movie_id, {}).get(field) for movie_id in movie_ids]
+        return _arrow_table('links', columns)
+
+    @classmethod
+    def from_arrow(cls, table, **kwargs):
+        """
+        The method returns a Links instance over a pyarrow table written by to_arrow() or convert_csv(),
+        converted into the id dicts and the parsed IMDB data of the instance. kwargs are passed to empty().
+        """
+        columns = table.to_pydict()
+        links = cls.empty(**kwargs)
+        parsed = {}
+        if 'parsed' in columns:
+            fields = links.__fields
+            for movie_id, is_parsed, *values in zip(columns['movieId'], columns['parsed'],
+                                                    *(columns[field] for field in fields)):
+                if is_parsed:
+                    parsed[movie_id] = dict(zip(fields, values))
+        return links.merge({'imdb': dict(zip(columns['movieId'], columns['imdbId'])),
+                            'tmdb': dict(zip(columns['movieId'], columns['tmdbId'])),
+                            'parsed': parsed, 'failures': {}, 'rejects': []})
+
+    def save(self, path_to_the_file:str):
+        """
+        The method saves the ids and the parsed IMDB data as Parquet (.parquet) or Arrow (.arrow, .feather).
+        """
+        write_table(self.to_arrow(), path_to_the_file)
+
+    @classmethod
+    def load(cls, path_to_the_file:str, **kwargs):
+        return cls.from_arrow(read_table(path_to_the_file), **kwargs)
+
+    def get_tmdb_dict(self):
+        return self.__movie_to_tmdb
+
+    @INSTRUMENTATION.measure
+    def load_metadata(self, path_to_the_file:str):
+        """
+        The method fills the IMDB data of the loaded movies from a local bulk metadata dump, so that
+        only the movies missing from the dump have to be scraped. The dump is JSON lines (.jsonl, .json, .ndjson)
+        or CSV with an imdbId and/or tmdbId column and any of the columns Director, Budget,
+        Cumulative Worldwide Gross (or Gross), Runtime, Title, Rating.
+        Only the rows of the loaded movies are indexed. Returns the number of movies filled from the dump.
+        """
+        by_imdb = {int(imdb_id): movie_id for movie_id, imdb_id in self.__movie_to_imdb.items()}
+        by_tmdb = {tmdb_id: movie_id for movie_id, tmdb_id in self.__movie_to_tmdb.items()}
+        found = {}
+        for record in self.__read_metadata(path_to_the_file):
+            movie_id = None
+            imdb_id = self.__metadata_id(record.get('imdbId'))
+            if imdb_id is not None:
+                movie_id = by_imdb.get(imdb_id)
+            if movie_id is None:
+                tmdb_id = self.__metadata_id(record.get('tmdbId'))
+                if tmdb_id is not None:
+                    movie_id = by_tmdb.get(tmdb_id)
+            if movie_id is not None:
+                found[movie_id] = self.__metadata_row(record)
+        for movie_id, movie_data in found.items():
+            self.__store(movie_id, movie_data)
+            self.__failures.pop(movie_id, None)
+        return len(found)
+
+    @staticmethod
+    def __read_metadata(path_to_the_file:str):
+        with open_text(path_to_the_file, newline='') as file:
+            lines = _metered_lines(file)
+            if re.sub(r'\.(gz|zst)$', '', path_to_the_file).endswith(('.jsonl', '.json', '.ndjson')):
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                yield from csv.DictReader(lines)
+
+    @staticmethod
+    def __metadata_id(value):
+        if value is None or value == '':
+            return None
+        try:
+            return int(str(value).strip().lstrip('t'))
+        except ValueError:
+            return None
+
+    def __metadata_row(self, record:dict):
+        # a malformed number (e.g. "$30,000,000") is missing data of that movie, not a reason to drop the dump
+        gross = 'Cumulative Worldwide Gross' if 'Cumulative Worldwide Gross' in record else 'Gross'
+        movie_data = {}
+        for field in self.__fields:
+            value = record.get(gross if field == 'Cumulative Worldwide Gross' else field)
+            if value is None or value == '':
+                value = None
+            elif field in ('Budget', 'Cumulative Worldwide Gross', 'Runtime'):
+                try:
+                    value = int(float(value)) if field == 'Runtime' else float(value)
+                except (TypeError, ValueError, OverflowError):
+                    value = None
+            else:
+                value = str(value)
+            movie_data[field] = value
+        return movie_data
     
+    @INSTRUMENTATION.measure
     def get_imdb(self, list_of_movies:list, list_of_fields:list):
         """
-        The method returns a list of lists [movieId, field1, field2, field3, ...] for the list of movies given as the argument (movieId).
-        For example, [movieId, Director, Budget, Cumulative Worldwide Gross, Runtime].
-        The values should be parsed from the IMDB webpages of the movies.
-        Sort it by movieId descendingly.
+        The method returns a list of lists [movieId, field1, field2, field3, ...] for the list of movies given as the argument (movieId).
+        For example, [movieId, Director, Budget, Cumulative Worldwide Gross, Runtime].
+        The values should be parsed from the IMDB webpages of the movies.
+        Sort it by movieId descendingly.
+        """
+        imdb_info = []
+        if INSTRUMENTATION.enabled:
+            INSTRUMENTATION.count('rows_scanned', len(list_of_movies))
+            hits = sum(1 for movie_id in list_of_movies if movie_id in self.__parsed_data)
+            INSTRUMENTATION.count('cache_hits', hits)
+            INSTRUMENTATION.count('cache_misses', len(list_of_movies) - hits)
+        if not self.__loaded:
+            self.__load_and_parse_all_data()
+        for movie_id in list_of_movies:
+            if movie_id in self.get_ids_dict().keys() and movie_id not in self.__failures:
+                movie_data = [movie_id]
+                for field in list_of_fields:
+                    movie_data.append(self.__parsed_data.get(movie_id, {}).get(field))
+                imdb_info.append(movie_data)
+            
+        imdb_info.sort(key=lambda x: x[0], reverse=True)
+        return imdb_info
+ 
+
+    def get_failures(self):
+        """
+        The method returns a dict with the movies that could not be fetched, where the keys are movieIds and
+        the values are dicts {imdbId, status, error, attempts}. Sorted by movieId ascendingly.
+        A status of None means that no HTTP response was received. A movie whose Retry-After was longer than
+        max_backoff also has retry_after (seconds); the circuit breaker stays open for that long.
+        """
+        return {movie_id: dict(failure) for movie_id, failure in sorted(self.__failures.items())}
+
+    def iter_imdb(self, fetch_workers:int = None, parse_workers:int = None, queue_size:int = 64):
+        """
+        The method fetches and parses the IMDB pages of the movies which are not parsed yet and
+        yields (movieId, {field: value}) as soon as each movie is ready. The results are stored as well,
+        so the rankings see everything consumed so far.
+        Pages are downloaded by a pool of threads into a bounded queue and parsed by a pool of processes
+        (one per CPU unless parse_workers says otherwise), so network and CPU work overlap. A single page,
+        parse_workers=0, or a platform where the pool can not be started, is parsed in the calling thread.
+        """
+        fetch_workers = fetch_workers or self.__fetch_workers
+        if parse_workers is None:
+            parse_workers = self.__parse_workers
+        pending = [(movie_id, imdb_id) for movie_id, imdb_id in self.__movie_to_imdb.items()
+                   if movie_id not in self.__parsed_data]
+        if not pending:
+            self.__loaded = True
+            return
+        pages = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def fetch(movie_id, imdb_id):
+            if stop.is_set():
+                return
+            content = self.__fetch_page(movie_id, imdb_id)
+            while content is not None and not stop.is_set():
+                try:
+                    pages.put((movie_id, content), timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def finish(futures):
+            wait(futures)
+            while not stop.is_set():
+                try:
+                    pages.put(done, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        http_requests, http_bytes = self.__http_requests, self.__http_bytes
+        fetchers = ThreadPoolExecutor(max_workers=fetch_workers)
+        parser = None
+        if parse_workers != 0 and len(pending) > 1:
+            # parsing costs ~3000 times more than pickling the page to a worker, so the pool pays off from two pages
+            try:
+                parser = ProcessPoolExecutor(max_workers=min(parse_workers or os.cpu_count() or 1, len(pending)))
+            except (OSError, NotImplementedError):
+                parser = None
+        futures = [fetchers.submit(fetch, movie_id, imdb_id) for movie_id, imdb_id in pending]
+        threading.Thread(target=finish, args=(futures,), daemon=True).start()
+        try:
+            in_flight = {}
+            fetching = True
+            while fetching or in_flight:
+                while fetching and len(in_flight) < queue_size:
+                    try:
+                        item = pages.get(timeout=None if not in_flight else 0.01)
+                    except queue.Empty:
+                        break
+                    if item is done:
+                        fetching = False
+                        break
+                    movie_id, content = item
+                    if parser is not None:
+                        try:
+                            in_flight[parser.submit(self.parse_page, content, self.__fields)] = movie_id, content
+                            continue
+                        except (OSError, NotImplementedError, BrokenProcessPool):
+                            # no worker process could be started: the rest is parsed here
+                            parser.shutdown(wait=False, cancel_futures=True)
+                            parser = None
+                    yield self.__store(movie_id, self.parse_page(content, self.__fields))
+                if in_flight:
+                    finished, _ = wait(in_flight, timeout=0.05 if fetching else None, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        movie_id, content = in_flight.pop(future)
+                        try:
+                            movie_data = future.result()
+                        except BrokenProcessPool:
+                            movie_data = self.parse_page(content, self.__fields)
+                        yield self.__store(movie_id, movie_data)
+            self.__loaded = True
+        finally:
+            stop.set()
+            fetchers.shutdown(wait=True, cancel_futures=True)
+            if parser is not None:
+                parser.shutdown(wait=True, cancel_futures=True)
+            INSTRUMENTATION.count('http_requests', self.__http_requests - http_requests)
+            INSTRUMENTATION.count('bytes_read', self.__http_bytes - http_bytes)
+
+    def __store(self, movie_id:int, movie_data:dict):
+        self.__parsed_data[movie_id] = movie_data
+        self.__imdb_table = None
+        self._revision += 1
+        return movie_id, movie_data
+
+    def __load_and_parse_all_data(self):
+        if not self.__loaded:
+            for _ in self.iter_imdb():
+                pass
+
+    @classmethod
+    def parse_page(cls, content, fields:list):
+        """
+        The method parses the content of an IMDB page and returns a dict {field: value} for the given fields.
+        It does not need an instance, so it can run in a worker process.
+        """
+        soup = BeautifulSoup(content, 'html.parser')
+        return {field: cls.__extract_data(soup, field) for field in fields}
+
+    def __fetch_page(self, movie_id:int, imdb_id:str):
+        """
+        Downloads the IMDB page of the movie, retrying transient errors (connection errors, 429 and 5xx)
+        with exponential backoff and jitter. Returns the page content, or None after recording the failure.
+        """
+        status = None
+        attempts = 0
+        while attempts <= self.__retries:
+            if self.__breaker_is_open():
+                self.__failures[movie_id] = {'imdbId': imdb_id, 'status': status,
+                                             'error': 'circuit breaker open', 'attempts': attempts}
+                return None
+            attempts += 1
+            retry_after = None
+            try:
+                response = self.__session.get(f"https://www.imdb.com/title/tt{imdb_id}/", timeout=self.__timeout)
+                status = response.status_code
+                with self.__breaker_lock:
+                    self.__http_requests += 1
+                    self.__http_bytes += len(response.content or b'')
+                if status < 300:
+                    with self.__breaker_lock:
+                        self.__consecutive_failures = 0
+                    self.__failures.pop(movie_id, None)
+                    return response.content
+                error = f"HTTP {status}"
+                if status not in self.RETRYABLE_STATUSES:
+                    with self.__breaker_lock:
+                        self.__consecutive_failures = 0
+                    break
+                retry_after = self.__parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None and retry_after > self.__max_backoff:
+                    # the server throttles for longer than we wait: give up now and hold every fetch until then
+                    with self.__breaker_lock:
+                        self.__consecutive_failures = max(self.__consecutive_failures, self.__breaker_threshold)
+                        self.__breaker_open_until = max(self.__breaker_open_until, time.monotonic() + retry_after)
+                    self.__failures[movie_id] = {'imdbId': imdb_id, 'status': status, 'error': error,
+                                                 'attempts': attempts, 'retry_after': retry_after}
+                    return None
+            except requests.RequestException as e:
+                status = None
+                error = str(e)
+            with self.__breaker_lock:
+                self.__consecutive_failures += 1
+                if self.__consecutive_failures >= self.__breaker_threshold:
+                    self.__breaker_open_until = time.monotonic() + self.__breaker_cooldown
+            if attempts <= self.__retries:
+                time.sleep(self.__backoff_delay(attempts, retry_after))
+        self.__failures[movie_id] = {'imdbId': imdb_id, 'status': status, 'error': error, 'attempts': attempts}
+        return None
+
+    def __breaker_is_open(self):
+        return self.__consecutive_failures >= self.__breaker_threshold and time.monotonic() < self.__breaker_open_until
+
+    def __backoff_delay(self, attempt:int, retry_after=None):
+        delay = random.uniform(0, min(self.__max_backoff, self.__backoff * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    @staticmethod
+    def __parse_retry_after(value):
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def __extract_data(cls, soup, field:str):
+        config = cls.EXTRACTORS.get(field, {})
+        if 'search_text' in config:
+            element = soup.find(string=config['search_text'])
+            if element:
+                value = element.find_next().text.strip()
+                if field == "Runtime":
+                    return cls.__parse_runtime(value)
+                elif field == 'Budget':
+                    return float(re.sub(r'[^\d.]', '', value)) * cls.CURRENCY_RATES[value[0]] if value[0] in cls.CURRENCY_RATES else None
+                elif field == 'Cumulative Worldwide Gross':
+                    return float(re.sub(r'[^\d.]', '', value)) if value else None
+                return value[:6]
+        elif 'selectors' in config:
+            for selector in config['selectors']:
+                element = soup.find(selector['selector'], selector['attrs'])
+                if element:
+                    return element.get_text(strip=True)
+        elif 'selector' in config:
+            element = soup.find(config['selector'], config['attrs'])
+            if element:
+                return element.get_text(strip=True)
+        return None
+
+    @staticmethod
+    def __parse_runtime(runtime_str:str):
+        parts = runtime_str.split()
+        if len(parts) == 4:
+            return int(parts[0]) * 60 + int(parts[2])
+        elif len(parts) == 2 and 'hour' in parts[1].lower():
+            return int(parts[0]) * 60
+        else:
+            return int(parts[0])
+
+    @INSTRUMENTATION.measure
+    def get_imdb_table(self):
+        """
+        The method returns the ImdbTable with the parsed IMDB data of all loaded movies.
+        The table is built once and rebuilt only when the parsed data changes.
+        """
+        if not self.__loaded:
+            self.__load_and_parse_all_data()
+        if self.__imdb_table is None:
+            self.__imdb_table = ImdbTable(self.__parsed_data)
+        return self.__imdb_table
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def top_directors(self, n:int):
+        """
+        The method returns a dict with top-n directors where the keys are directors and 
+        the values are numbers of movies created by them. Sort it by numbers descendingly.
+        """
+        return self.get_imdb_table().top('directors', n)
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def most_expensive(self, n:int):
+        """
+        The method returns a dict with top-n movies where the keys are movie titles and
+        the values are their budgets. Sort it by budgets descendingly.
+        """
+        return self.get_imdb_table().top('budgets', n)
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def most_profitable(self, n:int):
+        """
+        The method returns a dict with top-n movies where the keys are movie titles and
+        the values are the difference between cumulative worldwide gross and budget.
+        Sort it by the difference descendingly.
+        """
+        return self.get_imdb_table().top('profits', n)
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def longest(self, n:int):
+        """
+        The method returns a dict with top-n movies where the keys are movie titles and
+        the values are their runtime. If there are more than one version – choose any.
+        Sort it by runtime descendingly.
+        """
+        return self.get_imdb_table().top('runtimes', n)
+
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def top_cost_per_minute(self, n:int):
+        """
+        The method returns a dict with top-n movies where the keys are movie titles and
+        the values are the budgets divided by their runtime. The budgets can be in different currencies – do not pay attention to it. #YET I PAID
+        The values should be rounded to 2 decimals. Sort it by the division descendingly.
+        """
+        return self.get_imdb_table().top('cost_per_minute', n)
+    
+    @INSTRUMENTATION.measure
+    @RESULT_CACHE.memoize
+    def get_imdb_rating(self, list_of_movie_ids:list): #bonus part
+        """"
+        Huntin bonus exp I invented this method, which returns dict with imdb ratings for given movie_ids where the keys are movie_ids and
+        the values are the ratings
+        Dict sorted by movie_id asc
+        """
+        return {movie_id: rating for movie_id, rating in reversed(self.get_imdb(list_of_movie_ids, ['Rating']))}
+
+
+class ImdbTable:
+    """
+    Columnar table of the parsed IMDB data with the derived metrics computed once.
+    Rows are ordered by movieId descendingly, missing numbers are stored as nan (0 for runtimes).
+    Budgets are already converted to dollars while parsing.
+    """
+
+    def __init__(self, parsed_data:dict):
+        movie_ids = sorted(parsed_data, reverse=True)
+        rows = [parsed_data[movie_id] for movie_id in movie_ids]
+        self.movie_ids = array('q', movie_ids)
+        self.titles = [row.get('Title') for row in rows]
+        self.directors = [row.get('Director') for row in rows]
+        self.ratings = [row.get('Rating') for row in rows]
+        self.budgets = array('d', [self.__number(row.get('Budget')) for row in rows])
+        self.grosses = array('d', [self.__number(row.get('Cumulative Worldwide Gross')) for row in rows])
+        self.runtimes = array('q', [row.get('Runtime') or 0 for row in rows])
+        self.profits = array('d', [gross - budget if budget else math.nan
+                                   for budget, gross in zip(self.budgets, self.grosses)])
+        self.cost_per_minute = array('d', [round(budget / runtime, 2) if budget > 0 and runtime > 0 else math.nan
+                                           for budget, runtime in zip(self.budgets, self.runtimes)])
+        self.__rankings = {}
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    @staticmethod
+    def __number(value):
+        return math.nan if value is None else float(value)
+
+    def top(self, column:str, n:int):
+        """
+        The method returns a dict with top-n values of the column, sorted by values descendingly.
+        For 'directors' the keys are directors and the values are numbers of their movies,
+        for the other columns the keys are movie titles. The ranking is computed on the first call only.
+        """
+        if column not in self.__rankings:
+            INSTRUMENTATION.count('cache_misses')
+            self.__rankings[column] = self.__rank(column)
+        else:
+            INSTRUMENTATION.count('cache_hits')
+        return dict(self.__rankings[column][:n])
+
+    def __rank(self, column:str):
+        if column == 'directors':
+            return Counter(director for director in self.directors if director).most_common()
+        values = {}
+        for title, value in zip(self.titles, getattr(self, column)):
+            if title and value and not math.isnan(value):
+                values[title] = value
+        return sorted(values.items(), key=lambda x: x[1], reverse=True)
+
+
+class SQLiteBackend:
+    """
+    Optional storage of the MovieLens files in a SQLite database, with indexes on movieId, userId,
+    timestamp and tag. The queries run as SQL aggregations, so the data does not have to fit in memory,
+    and several processes can share one database file. Unlike the in-memory classes, whole files are loaded.
+    The query methods return the same results as the methods of Movies, Tags and Ratings.Movies with the same names.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS movies (movieId INTEGER PRIMARY KEY, title TEXT, genres TEXT, year INTEGER);
+        CREATE TABLE IF NOT EXISTS ratings (userId INTEGER, movieId INTEGER, rating REAL, timestamp INTEGER);
+        CREATE TABLE IF NOT EXISTS tags (userId INTEGER, movieId INTEGER, tag TEXT, timestamp INTEGER);
+        CREATE TABLE IF NOT EXISTS links (movieId INTEGER PRIMARY KEY, imdbId TEXT, tmdbId INTEGER);
+        CREATE INDEX IF NOT EXISTS movies_year ON movies (year);
+        CREATE INDEX IF NOT EXISTS ratings_movie ON ratings (movieId);
+        CREATE INDEX IF NOT EXISTS ratings_user ON ratings (userId);
+        CREATE INDEX IF NOT EXISTS ratings_timestamp ON ratings (timestamp);
+        CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+        CREATE INDEX IF NOT EXISTS tags_movie ON tags (movieId);
+    """
+    BATCH = 50000
+
+    def __init__(self, path_to_the_db:str = ':memory:'):
+        self.path = path_to_the_db
+        self.__connection = sqlite3.connect(path_to_the_db, check_same_thread=False)
+        self.__lock = threading.Lock()
+        if path_to_the_db != ':memory:':
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.__connection.close()
+
+    def __query(self, sql:str, parameters=()):
+        with self.__lock:
+            return self.__connection.execute(sql, parameters).fetchall()
+
+    def __load(self, table:str, rows, columns:int):
+        placeholders = ','.join('?' * columns)
+        count = 0
+        with self.__lock, self.__connection:
+            self.__connection.execute(f"DELETE FROM {table}")
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= self.BATCH:
+                    self.__connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", batch)
+                    count += len(batch)
+                    batch = []
+            self.__connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", batch)
+            count += len(batch)
+            self.__connection.execute(f"ANALYZE {table}")
+        return count
+
+    @staticmethod
+    def __lines(path_to_the_file:str, headers:list, limit:int = None):
+        with open_text(path_to_the_file) as file:
+            if file.readline().strip().split(',') != headers:
+                raise ValueError(f"Invalid file structure, expected headers: {headers}")
+            for i, line in enumerate(file):
+                if limit is not None and i >= limit:
+                    break
+                yield i + 2, line.strip().split(',')
+
+    def load_movies(self, path_to_the_file:str):
+        """
+        The method loads movies.csv, parsed like Movies, with the release year extracted from the title.
+        Returns the number of rows.
+        """
+        def rows():
+            for _, row in self.__lines(path_to_the_file, ['movieId', 'title', 'genres']):
+                title = ','.join(row[1:-1]) if len(row) > 3 else row[1]
+                match = re.search(r'\((\d{4})\)', title)
+                yield int(row[0]), title, row[-1], int(match.group(1)) if match else None
+        return self.__load('movies', rows(), 4)
+
+    def load_ratings(self, path_to_the_file:str, limit:int = None):
+        def rows():
+            for line_num, row in self.__lines(path_to_the_file, ['userId', 'movieId', 'rating', 'timestamp'], limit):
+                if len(row) != 4:
+                    raise ValueError(f"Incorrect format in line {line_num}: {row}")
+                yield int(row[0]), int(row[1]), float(row[2]), int(row[3])
+        return self.__load('ratings', rows(), 4)
+
+    def load_tags(self, path_to_the_file:str, limit:int = None):
+        def rows():
+            for line_num, row in self.__lines(path_to_the_file, ['userId', 'movieId', 'tag', 'timestamp'], limit):
+                if len(row) != 4:
+                    raise ValueError(f"Invalid representation of tag in line {line_num}")
+                yield int(row[0]), int(row[1]), row[2], int(row[3])
+        return self.__load('tags', rows(), 4)
+
+    def load_links(self, path_to_the_file:str):
+        return self.__load('links', Links.iter_rows(path_to_the_file, rejects=[]), 3)
+
+    def load_dir(self, path_to_the_dir:str = DATASETS_DIR, **paths):
+        """
+        The method loads the MovieLens files of the directory (paths can override single files, like in
+        MovieLensCatalog). Missing files are skipped. Returns a dict with the numbers of loaded rows.
+        """
+        loaders = {'movies': self.load_movies, 'ratings': self.load_ratings, 'tags': self.load_tags,
+                   'links': self.load_links}
+        counts = {}
+        for name, file_name in MovieLensCatalog.FILES.items():
+            path = paths.get(name) or os.path.join(path_to_the_dir, file_name)
+            if os.path.exists(path):
+                counts[name] = loaders[name](path)
+        return counts
+
+    def get_movies_by_year(self, year:int):
+        return [title for title, in self.__query(
+            "SELECT DISTINCT title FROM movies WHERE year = ? ORDER BY title", (year,))]
+
+    def movie_by_tag(self, given_tag:str):
+        return [movie_id for movie_id, in self.__query(
+            "SELECT DISTINCT CAST(movieId AS TEXT) AS id FROM tags WHERE instr(tag, ?) > 0 ORDER BY id", (given_tag,))]
+
+    def most_popular(self, n:int):
+        return dict(self.__query(
+            "SELECT tag, COUNT(*) FROM tags GROUP BY tag ORDER BY COUNT(*) DESC, MIN(rowid) LIMIT ?", (n,)))
+
+    RATED_TITLES = """
+        SELECT COALESCE(TRIM(m.title, '"'), 'Unknown ' || r.movieId) AS title, r.rating, r.rowid AS position
+        FROM ratings r LEFT JOIN movies m ON m.movieId = r.movieId
+    """
+
+    def top_by_num_of_ratings(self, n:int):
+        rows = self.__query(f"""
+            SELECT title, COUNT(*) FROM ({self.RATED_TITLES}) GROUP BY title ORDER BY COUNT(*) DESC, MIN(position)""")
+        if not (1 <= n <= len(rows)):
+            print(f"ValueError in top_by_num_of_ratings: n must be between 1 and {len(rows)}, got {n}")
+            return {}
+        return dict(rows[:n])
+
+    def top_by_ratings(self, n:int, metric:str = 'average'):
+        """
+        Average and median are computed per title in SQL; only one row per title is returned to Python
+        to be rounded and ranked like Ratings.Movies.top_by_ratings.
+        """
+        if metric == 'average':
+            rows = self.__query(f"SELECT title, AVG(rating), MIN(position) FROM ({self.RATED_TITLES}) GROUP BY title")
+        elif metric == 'median':
+            rows = self.__query(f"""
+                SELECT title, AVG(rating), MIN(first) FROM (
+                    SELECT title, rating, MIN(position) OVER (PARTITION BY title) AS first,
+                           ROW_NUMBER() OVER (PARTITION BY title ORDER BY rating) AS row,
+                           COUNT(*) OVER (PARTITION BY title) AS total
+                    FROM ({self.RATED_TITLES}))
+                WHERE row IN ((total + 1) / 2, (total + 2) / 2) GROUP BY title""")
+        else:
+            print("ValueError in top_by_ratings: metric must be 'average' or 'median'")
+            return {}
+        if not (1 <= n <= len(rows)):
+            print(f"ValueError in top_by_ratings: n must be between 1 and {len(rows)}, got {n}")
+            return {}
+        ranked = sorted(((title, round(value, 2), first) for title, value, first in rows), key=lambda x: (-x[1], x[2]))
+        return {title: value for title, value, _ in ranked[:n]}
+
+
+class RatingsCube:
+    """
+    OLAP cube of the ratings over genre x release year x rating year x rating, built once from Movies and Ratings.
+    Every roll-up (each subset of the dimensions) is precomputed as a dict of cells [count, sum of ratings],
+    so a query only reads the cells of the smallest roll-up which has its dimensions, and a fully specified
+    slice is a single dict lookup. A rating counts once in each genre of its movie, and once in the roll-ups
+    without genre. The cube is a snapshot: build a new one after the ratings change.
+    """
+    DIMENSIONS = ('genre', 'release_year', 'rating_year', 'rating')
+    MEASURES = ('count', 'sum', 'average')
+
+    @INSTRUMENTATION.measure
+    def __init__(self, movies, ratings):
+        movie_info = {}
+        for movie in movies.movies:
+            match = re.search(r'\((\d{4})\)', movie['title'])
+            genres = [] if movie['genres'] == '(no genres listed)' else movie['genres'].split('|')
+            movie_info[int(movie['movieId'])] = (genres, int(match.group(1)) if match else None)
+        base = Counter((row['movieId'], datetime.fromtimestamp(row['timestamp']).year, row['rating'])
+                       for row in ratings.data_joined)
+        self.cuboids = {dims: {} for size in range(len(self.DIMENSIONS) + 1)
+                        for dims in itertools.combinations(self.DIMENSIONS, size)}
+        for (movie_id, rating_year, rating), count in base.items():
+            genres, release_year = movie_info.get(movie_id, ([], None))
+            values = {'release_year': release_year, 'rating_year': rating_year, 'rating': rating}
+            for dims, cells in self.cuboids.items():
+                if 'genre' in dims:
+                    keys = [tuple(genre if dim == 'genre' else values[dim] for dim in dims) for genre in genres]
+                else:
+                    keys = [tuple(values[dim] for dim in dims)]
+                for key in keys:
+                    cell = cells.get(key)
+                    if cell is None:
+                        cells[key] = [count, count * rating]
+                    else:
+                        cell[0] += count
+                        cell[1] += count * rating
+        self._rows = len(ratings.data_joined)
+
+    def _rows_scanned(self):
+        return self._rows
+
+    @staticmethod
+    def __matches(value, condition):
+        if isinstance(condition, tuple):
+            return value is not None and condition[0] <= value <= condition[1]
+        if isinstance(condition, (list, set, frozenset)):
+            return value in condition
+        return value == condition
+
+    @staticmethod
+    def __measure(count, total, measure):
+        if measure == 'count':
+            return count
+        if measure == 'sum':
+            return round(total, 2)
+        return round(total / count, 2) if count else None
+
+    def query(self, by=(), measure:str = 'average', bins:dict = None, **slices):
+        """
+        The method returns a dict of the measure ('count', 'sum' or 'average' of the ratings) grouped by
+        the dimensions in by and restricted to the slices, sorted by keys. The keys are values of the
+        dimension for one dimension in by and tuples for several. A slice is a value, an inclusive
+        (low, high) range or a list or set of values, e.g. query(by='genre', release_year=(1990, 1999)).
+        bins={'release_year': 10} rolls a dimension up into bins of that width keyed by their start, e.g. decades.
+        """
+        by = (by,) if isinstance(by, str) else tuple(by)
+        bins = bins or {}
+        unknown = (set(by) | set(slices) | set(bins)) - set(self.DIMENSIONS)
+        if unknown:
+            print(f"ValueError in query: unknown dimensions {sorted(unknown)}, expected some of {self.DIMENSIONS}")
+            return {}
+        if measure not in self.MEASURES:
+            print(f"ValueError in query: measure must be one of {self.MEASURES}, got {measure!r}")
+            return {}
+        dims = tuple(dim for dim in self.DIMENSIONS if dim in by or dim in slices)
+        cells = self.cuboids[dims]
+        positions = [dims.index(dim) for dim in by]
+        filters = [(dims.index(dim), condition) for dim, condition in slices.items()]
+        exact = all(not isinstance(condition, (tuple, list, set, frozenset)) for condition in slices.values())
+        if exact and not by:
+            cell = cells.get(tuple(slices[dim] for dim in dims))
+            return {(): self.__measure(cell[0], cell[1], measure)} if cell else {}
+        groups = {}
+        for key, (count, total) in cells.items():
+            if not all(self.__matches(key[i], condition) for i, condition in filters):
+                continue
+            group = []
+            for dim, i in zip(by, positions):
+                value = key[i]
+                if dim in bins and value is not None:
+                    value = value - value % bins[dim]
+                group.append(value)
+            group = group[0] if len(group) == 1 else tuple(group)
+            cell = groups.setdefault(group, [0, 0])
+            cell[0] += count
+            cell[1] += total
+        return {group: self.__measure(count, total, measure)
+                for group, (count, total) in sorted(groups.items(), key=lambda x: self.__order(x[0]))}
+
+    @staticmethod
+    def __order(group):
+        return tuple((value is not None, value) for value in (group if isinstance(group, tuple) else (group,)))
+
+    def cell(self, measure:str = 'average', **slices):
+        """
+        The method returns the measure of one slice as a number, e.g. cell(genre='Thriller', release_year=(1990, 1999)),
+        or None if the slice has no ratings.
+        """
+        return self.query((), measure, **slices).get(())
+
+    def rollup(self, dimension:str, measure:str = 'average', **slices):
+        """
+        The method returns the measure along one dimension with every other dimension rolled up.
+        """
+        return self.query((dimension,), measure, **slices)
+
+
+class TagRatingIndex:
+    """
+    Join index of tags -> movies -> rating aggregates, built once from Tags and Ratings. Queries like
+    "top 10 highest-rated movies tagged 'atmospheric' with at least 50 ratings" are a lookup of the tag,
+    lookups of the per-movie [count, sum] and a bounded top-n, without scanning the ratings.
+    The index is a snapshot: build a new one after the tags or ratings change.
+    """
+
+    @INSTRUMENTATION.measure
+    def __init__(self, tags, ratings):
+        self.tag_movies = defaultdict(set)
+        for tag in tags.tags:
+            self.tag_movies[tag['tag']].add(int(tag['movieId']))
+        self.tag_movies = dict(self.tag_movies)
+        self.movie_stats = {}
+        self.titles = {}
+        for row in ratings.data_joined:
+            stats = self.movie_stats.get(row['movieId'])
+            if stats is None:
+                self.movie_stats[row['movieId']] = [1, row['rating']]
+                self.titles[row['movieId']] = row['title']
+            else:
+                stats[0] += 1
+                stats[1] += row['rating']
+        self._rows = len(tags.tags) + len(ratings.data_joined)
+
+    def _rows_scanned(self):
+        return self._rows
+
+    def movies(self, tag:str, contains:bool = False):
+        """
+        The method returns the sorted list of movieIds tagged with the tag, or with any tag that includes it
+        if contains is True (like Tags.movie_by_tag, but only the tag names are scanned).
+        """
+        if not contains:
+            return sorted(self.tag_movies.get(tag, ()))
+        return sorted(set().union(*(movies for name, movies in self.tag_movies.items() if tag in name)))
+
+    def top_rated(self, tag:str, n:int = 10, min_ratings:int = 1, contains:bool = False):
+        """
+        The method returns top-n movies tagged with the tag by the average rating, among the movies
+        with at least min_ratings ratings. It is a dict where the keys are movie titles and the values
+        are the averages rounded to 2 decimals. Sort it by averages descendingly, ties by the number of ratings.
+        """
+        candidates = []
+        for movie_id in self.movies(tag, contains):
+            stats = self.movie_stats.get(movie_id)
+            if stats is not None and stats[0] >= min_ratings:
+                candidates.append((stats[1] / stats[0], stats[0], -movie_id))
+        return {self.titles[-movie_id] or f"Unknown {-movie_id}": round(average, 2)
+                for average, _, movie_id in heapq.nlargest(n, candidates)}
+
+    def most_rated(self, tag:str, n:int = 10, contains:bool = False):
+        """
+        The method returns top-n movies tagged with the tag by the number of ratings.
+        It is a dict where the keys are movie titles and the values are numbers. Sort it by numbers descendingly.
+        """
+        candidates = [(self.movie_stats[movie_id][0], -movie_id) for movie_id in self.movies(tag, contains)
+                      if movie_id in self.movie_stats]
+        return {self.titles[-movie_id] or f"Unknown {-movie_id}": count
+                for count, movie_id in heapq.nlargest(n, candidates)}
+
+
+def _hash64(item):
+    """
+    Stable 64-bit hash (the same in every process): splitmix64 for ints, blake2b for everything else.
+    """
+    if isinstance(item, int):
+        z = (item + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return z ^ (z >> 31)
+    return int.from_bytes(hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HyperLogLog:
+    """
+    Distinct count sketch. The relative standard error is about error, memory is 2^p bytes
+    with p chosen from error.
+    """
+
+    def __init__(self, error:float = 0.01):
+        self.p = min(18, max(4, math.ceil(math.log2((1.04 / error) ** 2))))
+        self.m = 1 << self.p
+        self.registers = bytearray(self.m)
+
+    @property
+    def error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, item):
+        h = _hash64(item)
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("Only sketches with the same precision can be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return round(estimate)
+
+
+class CountMinSketch:
+    """
+    Frequency sketch. An estimate never undercounts and overcounts by at most epsilon * total
+    with probability 1 - delta.
+    """
+
+    def __init__(self, epsilon:float = 0.001, delta:float = 0.01):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.rows = [array('q', bytes(8 * self.width)) for _ in range(self.depth)]
+        self.total = 0
+
+    def __cells(self, item):
+        h = _hash64(item)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, item, count:int = 1):
+        """
+        The method counts the item and returns its new estimate.
+        """
+        self.total += count
+        estimate = None
+        for row, cell in zip(self.rows, self.__cells(item)):
+            row[cell] += count
+            estimate = row[cell] if estimate is None else min(estimate, row[cell])
+        return estimate
+
+    def estimate(self, item):
+        return min(row[cell] for row, cell in zip(self.rows, self.__cells(item)))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Only sketches with the same dimensions can be merged")
+        for row, other_row in zip(self.rows, other.rows):
+            for cell in range(self.width):
+                row[cell] += other_row[cell]
+        self.total += other.total
+        return self
+
+
+class HeavyHitters:
+    """
+    Top-k frequent items: a count-min sketch plus a bounded set of candidates with the largest estimates.
+    """
+
+    def __init__(self, capacity:int = 100, epsilon:float = 0.001, delta:float = 0.01):
+        self.capacity = capacity
+        self.sketch = CountMinSketch(epsilon, delta)
+        self.candidates = {}
+        self.__heap = []
+
+    def add(self, item, count:int = 1):
+        estimate = self.sketch.add(item, count)
+        if item in self.candidates or len(self.candidates) < self.capacity:
+            self.candidates[item] = estimate
+            heapq.heappush(self.__heap, (estimate, id(item), item))
+        elif estimate > self.__smallest():
+            _, _, smallest = heapq.heappop(self.__heap)
+            del self.candidates[smallest]
+            self.candidates[item] = estimate
+            heapq.heappush(self.__heap, (estimate, id(item), item))
+        if len(self.__heap) > 4 * self.capacity:
+            self.__heap = [(count, id(item), item) for item, count in self.candidates.items()]
+            heapq.heapify(self.__heap)
+
+    def __smallest(self):
+        while self.__heap[0][2] not in self.candidates or self.candidates[self.__heap[0][2]] != self.__heap[0][0]:
+            heapq.heappop(self.__heap)
+        return self.__heap[0][0]
+
+    def top(self, n:int):
+        """
+        The method returns a list of (item, estimated count) of the n most frequent items, sorted by counts descendingly.
+        """
+        return heapq.nlargest(n, self.candidates.items(), key=lambda x: x[1])
+
+
+class KLLSketch:
+    """
+    Quantile sketch (KLL). The rank error of a quantile is about 1.7 / k, memory is O(k) items.
+    """
+
+    def __init__(self, k:int = 200, seed:int = 0):
+        self.k = k
+        self.count = 0
+        self.compactors = [[]]
+        self.__random = random.Random(seed)
+
+    @property
+    def error(self):
+        return 1.7 / self.k
+
+    def __capacity(self, level:int):
+        return max(2, math.ceil(self.k * (2 / 3) ** (len(self.compactors) - level - 1)))
+
+    def add(self, value:float):
+        self.compactors[0].append(value)
+        self.count += 1
+        if len(self.compactors[0]) >= self.__capacity(0):
+            self.__compress()
+
+    def __compress(self):
+        for level, compactor in enumerate(self.compactors):
+            if len(compactor) >= self.__capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append([])
+                compactor.sort()
+                offset = self.__random.randint(0, 1)
+                self.compactors[level + 1].extend(compactor[offset::2])
+                del compactor[:]
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.count += other.count
+        while any(len(c) >= self.__capacity(level) for level, c in enumerate(self.compactors)):
+            self.__compress()
+        return self
+
+    def quantile(self, q:float):
+        if not 0 <= q <= 1:
+            raise ValueError(f"q must be between 0 and 1, got {q}")
+        weighted = sorted((value, 1 << level) for level, compactor in enumerate(self.compactors) for value in compactor)
+        if not weighted:
+            return None
+        total = sum(weight for _, weight in weighted)
+        rank = q * total
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen >= rank:
+                return value
+        return weighted[-1][0]
+
+
+class ApproximateRatings:
+    """
+    Approximate analytics over a whole ratings.csv in one pass with fixed memory: HyperLogLog for distinct
+    users and movies, count-min sketch with heavy hitters for the number of ratings per movie and KLL for
+    the rating quantiles. error_bounds() reports the configured error of every answer.
+    """
+
+    def __init__(self, path_to_the_file:str, path_to_movies_file:str = MOVIE_CSV_FILE, movie_titles:dict = None,
+                 distinct_error:float = 0.01, epsilon:float = 0.0005, delta:float = 0.01, k:int = 200,
+                 heavy_hitters:int = 200, seed:int = 0):
+        self.movie_titles = movie_titles if movie_titles is not None else Ratings.read_titles(path_to_movies_file)
+        self.users = HyperLogLog(distinct_error)
+        self.movies = HyperLogLog(distinct_error)
+        self.popular = HeavyHitters(heavy_hitters, epsilon, delta)
+        self.ratings = KLLSketch(k, seed)
+        self.count = 0
+        self.skipped = 0
+        with open_text(path_to_the_file) as file:
+            lines = _metered_lines(file)
+            if next(lines, '').strip().split(',') != ['userId', 'movieId', 'rating', 'timestamp']:
+                raise ValueError("Invalid file structure")
+            for line in lines:
+                values = line.strip().split(',')
+                try:
+                    user_id, movie_id, rating = int(values[0]), int(values[1]), float(values[2])
+                except (ValueError, IndexError):
+                    self.skipped += 1
+                    continue
+                self.users.add(user_id)
+                self.movies.add(movie_id)
+                self.popular.add(movie_id)
+                self.ratings.add(rating)
+                self.count += 1
+
+    def distinct_users(self):
+        return self.users.count()
+
+    def distinct_movies(self):
+        return self.movies.count()
+
+    def top_by_num_of_ratings(self, n:int):
+        """
+        The method returns an approximate dict of top-n movie titles by the number of ratings,
+        sorted by numbers descendingly. The counts are overestimated by at most error_bounds()['counts'].
+        """
+        return {self.movie_titles.get(movie_id) or f"Unknown {movie_id}": count
+                for movie_id, count in self.popular.top(n)}
+
+    def quantile(self, q:float):
+        return self.ratings.quantile(q)
+
+    def error_bounds(self):
+        return {'distinct_relative_error': self.users.error,
+                'counts': self.popular.sketch.epsilon * self.popular.sketch.total,
+                'counts_confidence': 1 - self.popular.sketch.delta,
+                'quantile_rank_error': self.ratings.error}
+
+
+class ApproximateTags:
+    """
+    Approximate analytics over a whole tags.csv in one pass with fixed memory: HyperLogLog for distinct tags
+    and users, count-min sketch with heavy hitters for the most popular tags.
+    """
+
+    def __init__(self, path_to_the_file:str, distinct_error:float = 0.01, epsilon:float = 0.0005,
+                 delta:float = 0.01, heavy_hitters:int = 200):
+        self.tags = HyperLogLog(distinct_error)
+        self.users = HyperLogLog(distinct_error)
+        self.popular = HeavyHitters(heavy_hitters, epsilon, delta)
+        self.count = 0
+        self.skipped = 0
+        with open_text(path_to_the_file) as file:
+            lines = _metered_lines(file)
+            if next(lines, '').strip().split(',') != ['userId', 'movieId', 'tag', 'timestamp']:
+                raise ValueError("Invalid file structure")
+            for line in lines:
+                row = line.strip().split(',')
+                if len(row) != 4:
+                    self.skipped += 1
+                    continue
+                self.tags.add(row[2])
+                self.users.add(row[0])
+                self.popular.add(row[2])
+                self.count += 1
+
+    def distinct_tags(self):
+        return self.tags.count()
+
+    def distinct_users(self):
+        return self.users.count()
+
+    def most_popular(self, n:int):
+        """
+        The method returns an approximate dict of the top-n tags and their counts, sorted by counts descendingly.
+        """
+        return dict(self.popular.top(n))
+
+    def error_bounds(self):
+        return {'distinct_relative_error': self.tags.error,
+                'counts': self.popular.sketch.epsilon * self.popular.sketch.total,
+                'counts_confidence': 1 - self.popular.sketch.delta}
+
+
+class RatingsState:
+    """
+    Mergeable partial aggregates of ratings: a rating histogram and the title of every movie, a rating histogram
+    and the number of rated movies of every user, and the counts per year, all in the order of first appearance.
+    A state is built per shard (Ratings.partial_state()), serialized with to_bytes() and merged with merge():
+    the states of consecutive shards merged in shard order give exactly the results of Ratings.Movies and
+    Ratings.Users over the whole data, which compute the same statistics from the same histograms.
+    The numbers of rated movies of a user are summed across shards, so the shards must not share
+    a (userId, movieId) pair: MovieLens has at most one rating per pair, but for other data (e.g. re-ratings
+    in a later log) split the rows by userId, or most_active_user_by_coverage counts those movies twice.
+    """
+
+    def __init__(self):
+        self.movies = {}
+        self.users = {}
+        self.years = {}
+
+    @classmethod
+    def from_rows(cls, rows:list):
+        state = cls()
+        user_movies = defaultdict(set)
+        for row in rows:
+            movie = state.movies.get(row['movieId'])
+            if movie is None:
+                movie = state.movies[row['movieId']] = [row['title'], {}]
+            movie[1][row['rating']] = movie[1].get(row['rating'], 0) + 1
+            user = state.users.get(row['userId'])
+            if user is None:
+                user = state.users[row['userId']] = [{}, 0]
+            user[0][row['rating']] = user[0].get(row['rating'], 0) + 1
+            user_movies[row['userId']].add(row['movieId'])
+            year = datetime.fromtimestamp(row['timestamp']).year
+            state.years[year] = state.years.get(year, 0) + 1
+        for user_id, movies in user_movies.items():
+            state.users[user_id][1] = len(movies)
+        return state
+
+    def merge(self, other):
+        """
+        The method adds the state of the next shard to this one and returns it.
+        The shards must not share (userId, movieId) pairs (see the class docstring).
+        """
+        for movie_id, (title, histogram) in other.movies.items():
+            movie = self.movies.setdefault(movie_id, [title, {}])
+            self.__add(movie[1], histogram)
+        for user_id, (histogram, movies) in other.users.items():
+            user = self.users.setdefault(user_id, [{}, 0])
+            self.__add(user[0], histogram)
+            user[1] += movies
+        self.__add(self.years, other.years)
+        return self
+
+    @classmethod
+    def merge_all(cls, states):
+        return functools.reduce(lambda merged, state: merged.merge(state), states, cls())
+
+    @staticmethod
+    def __add(counts:dict, other:dict):
+        for key, count in other.items():
+            counts[key] = counts.get(key, 0) + count
+
+    def to_bytes(self):
+        """
+        The method serializes the state as compressed JSON.
+        """
+        return zlib.compress(json.dumps({
+            'movies': [[movie_id, title, list(histogram.items())] for movie_id, (title, histogram) in self.movies.items()],
+            'users': [[user_id, list(histogram.items()), movies] for user_id, (histogram, movies) in self.users.items()],
+            'years': list(self.years.items())}, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data:bytes):
+        raw = json.loads(zlib.decompress(data))
+        state = cls()
+        state.movies = {movie_id: [title, dict(histogram)] for movie_id, title, histogram in raw['movies']}
+        state.users = {user_id: [dict(histogram), movies] for user_id, histogram, movies in raw['users']}
+        state.years = dict(raw['years'])
+        return state
+
+    def __by_title(self):
+        histograms = {}
+        for movie_id, (title, histogram) in self.movies.items():
+            self.__add(histograms.setdefault(title or f"Unknown {movie_id}", {}), histogram)
+        return histograms
+
+    @staticmethod
+    def __top(values:dict, n:int):
+        try:
+            return _top_values(values, n)
+        except ValueError as ve:
+            print(f"ValueError: {ve}")
+            return {}
+
+    def dist_by_year(self):
+        return dict(sorted(self.years.items()))
+
+    def dist_by_rating(self):
+        counts = {}
+        for _, histogram in self.movies.values():
+            self.__add(counts, histogram)
+        return dict(sorted(counts.items()))
+
+    def top_by_num_of_ratings(self, n):
+        return self.__top({title: sum(histogram.values()) for title, histogram in self.__by_title().items()}, n)
+
+    def top_by_ratings(self, n, metric='average'):
+        if metric not in ('average', 'median'):
+            print("ValueError: metric must be 'average' or 'median'")
+            return {}
+        return self.__top({title: round(_histogram_stat(histogram, metric), 2)
+                           for title, histogram in self.__by_title().items()}, n)
+
+    def top_controversial(self, n):
+        return self.__top({title: round(_histogram_stat(histogram, 'variance'), 2)
+                           for title, histogram in self.__by_title().items()}, n)
+
+    def percent_of_max_ratings_per_movie(self, n=None):
+        percents = {title: round(histogram.get(5.0, 0) / sum(histogram.values()) * 100, 2)
+                    for title, histogram in self.__by_title().items()}
+        return self.__top(percents, len(percents) if n is None else n) if percents else {}
+
+    def most_active_user_by_coverage(self):
+        max_user, max_percent = None, 0
+        for user_id, (_, movies) in self.users.items():
+            percent = movies / len(self.movies) * 100 if self.movies else 0
+            if percent > max_percent:
+                max_user, max_percent = user_id, percent
+        return (max_user, round(max_percent, 2))
+
+    def users_distribution(self):
+        return {user_id: sum(histogram.values()) for user_id, (histogram, _) in self.users.items()}
+
+    def users_rating_distribution(self, metric='average'):
+        if metric not in ('average', 'median'):
+            print("ValueError: metric must be 'average' or 'median'")
+            return {}
+        return {user_id: round(_histogram_stat(histogram, metric), 2) for user_id, (histogram, _) in self.users.items()}
+
+    def top_n_users_by_variance(self, n):
+        return self.__top({user_id: round(_histogram_stat(histogram, 'variance'), 2)
+                           for user_id, (histogram, _) in self.users.items()}, n)
+
+
+class TagsState:
+    """
+    Mergeable partial aggregates of tags: the count and the movies of every tag in the order of first appearance.
+    Merged in shard order, the states give exactly the most_popular, tags_with and movie_by_tag of Tags
+    over the whole data.
+    """
+
+    def __init__(self):
+        self.tags = {}
+
+    @classmethod
+    def from_rows(cls, rows:list):
+        state = cls()
+        for row in rows:
+            tag = state.tags.get(row['tag'])
+            if tag is None:
+                tag = state.tags[row['tag']] = [0, set()]
+            tag[0] += 1
+            tag[1].add(row['movieId'])
+        return state
+
+    def merge(self, other):
+        for name, (count, movies) in other.tags.items():
+            tag = self.tags.setdefault(name, [0, set()])
+            tag[0] += count
+            tag[1] |= movies
+        return self
+
+    @classmethod
+    def merge_all(cls, states):
+        return functools.reduce(lambda merged, state: merged.merge(state), states, cls())
+
+    def to_bytes(self):
+        return zlib.compress(json.dumps([[name, count, sorted(movies)] for name, (count, movies) in self.tags.items()],
+                                        ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data:bytes):
+        state = cls()
+        state.tags = {name: [count, set(movies)] for name, count, movies in json.loads(zlib.decompress(data))}
+        return state
+
+    def most_popular(self, n):
+        return dict(Counter({name: count for name, (count, _) in self.tags.items()}).most_common(n))
+
+    def tags_with(self, word):
+        return sorted(name for name in self.tags if word in name)
+
+    def movie_by_tag(self, given_tag):
+        return sorted(set().union(*(movies for name, (_, movies) in self.tags.items() if given_tag in name)))
+
+
+def partial_state(dataset:str, path_to_the_file:str, path_to_movies_file:str = MOVIE_CSV_FILE):
+    """
+    The function loads one shard file of 'ratings' or 'tags' whole and returns its serialized partial state,
+    the job of one node of a distributed run (it can run in a worker process).
+    """
+    if dataset == 'ratings':
+        return Ratings(path_to_the_file, path_to_movies_file, sample=Sampler('first', None)).partial_state().to_bytes()
+    if dataset == 'tags':
+        return Tags(path_to_the_file, sample=Sampler('first', None)).partial_state().to_bytes()
+    raise ValueError(f"dataset must be 'ratings' or 'tags', got {dataset!r}")
+
+
+class MovieLensCatalog:
+    """
+    One MovieLens dataset directory. Every file is loaded at most once, and the movie dimension table
+    {movieId: title} is built from the Movies data and shared with Ratings, so movies.csv is parsed once
+    and the title strings are not duplicated. Tags and Links are joined to the titles with title().
+    """
+    FILES = {'movies': 'movies.csv', 'ratings': 'ratings.csv', 'tags': 'tags.csv', 'links': 'links.csv'}
+
+    def __init__(self, path_to_the_dir:str = DATASETS_DIR, links_lenght:int = 1000, sample:Sampler = None, **paths):
+        """
+        paths can override the location of single files, e.g. ratings='/data/ratings.csv'.
+        sample is the Sampler of the ratings and tags, by default the first 1000 lines of each.
         """
-        imdb_info = []
-        if len(self.__parsed_data) == 0:
-            self.__load_and_parse_all_data()
-        for movie_id in list_of_movies:
-            if movie_id in self.get_ids_dict().keys():
-                movie_data = [movie_id]
-                for field in list_of_fields:
-                    movie_data.append(self.__parsed_data.get(movie_id, {}).get(field))
-                imdb_info.append(movie_data)
-            
-        imdb_info.sort(key=lambda x: x[0], reverse=True)
-        return imdb_info
- 
+        unknown = set(paths) - set(self.FILES)
+        if unknown:
+            raise ValueError(f"Unknown datasets: {sorted(unknown)}")
+        self.paths = {name: paths.get(name) or os.path.join(path_to_the_dir, file_name)
+                      for name, file_name in self.FILES.items()}
+        self.links_lenght = links_lenght
+        self.sample = sample
+        self.__datasets = {}
+        self.__titles = None
+        self.__lock = threading.RLock()
 
-    def __load_and_parse_all_data(self):
-        if len(self.__parsed_data) == 0:
-            bad_ids = []
-            for movie_id, imdb_id in self.__movie_to_imdb.items():
-                try:
-                    response = self.__session.get(f"https://www.imdb.com/title/tt{imdb_id}/")
-                    if response.status_code >= 300:
-                        bad_ids.append(movie_id)
-                        continue
-                    soup = BeautifulSoup(response.content, 'html.parser')
-                    movie_data = {field: self.__extract_data(soup, field) for field in self.__fields}
-                    self.__parsed_data[movie_id] = movie_data
-                except requests.RequestException as e:
-                    raise requests.RequestException(f"Error fetching data for movie ID {movie_id}: {e}")
-            if len(bad_ids) > 0:
-                for id in bad_ids:
-                    self.__movie_to_imdb.pop(id)
-
-    def __extract_data(self, soup, field:str):
-        extractors = {
-            "Director": {
-                'selector': 'a',
-                'attrs': {'href': re.compile(r'/name/nm\d+/')}
-            },
-            "Budget": {
-                'search_text': 'Budget'
-            },
-            "Cumulative Worldwide Gross": {
-                'search_text': 'Gross worldwide'
-            },
-            "Runtime": {
-                'search_text': 'Runtime'
-            },
-            "Title": {
-                'selectors': [
-                    {'selector': 'h1', 'attrs': {}}
-                ]
-            },
-            "Rating": {
-                'search_text': 'IMDb RATING'
-            }
-        }
-        
-        currency_rates = { 
-            '$': 1.0,      
-            'U': 1.0,
-            '¥': 0.0067,   
-            '€': 1.09,     
-            'E': 1.09,
-            'C': 0.7276,   
-            '£': 1.26,     
-            '₹': 0.012,    
-            'R': 0.18,     
-            '₽': 0.011,    
-            'R': 0.011   
-        }
+    def __dataset(self, name:str, load):
+        with self.__lock:
+            if name not in self.__datasets:
+                self.__datasets[name] = load()
+            return self.__datasets[name]
 
-        config = extractors.get(field, {})
-        if 'search_text' in config:
-            element = soup.find(string=config['search_text'])
-            if element:
-                value = element.find_next().text.strip()
-                if field == "Runtime":
-                    return self.__parse_runtime(value)
-                elif field == 'Budget':
-                    return float(re.sub(r'[^\d.]', '', value)) * currency_rates[value[0]] if value[0] in currency_rates.keys() else None
-                elif field == 'Cumulative Worldwide Gross':
-                    return float(re.sub(r'[^\d.]', '', value)) if value else None
-                return value[:6]
-        elif 'selectors' in config:
-            for selector in config['selectors']:
-                element = soup.find(selector['selector'], selector['attrs'])
-                if element:
-                    return element.get_text(strip=True)
-        elif 'selector' in config:
-            element = soup.find(config['selector'], config['attrs'])
-            if element:
-                return element.get_text(strip=True)
-        return None
+    def movies(self):
+        return self.__dataset('movies', lambda: Movies(self.paths['movies']))
 
-    def __parse_runtime(self, runtime_str:str):
-        parts = runtime_str.split()
-        if len(parts) == 4:
-            return int(parts[0]) * 60 + int(parts[2])
-        elif len(parts) == 2 and 'hour' in parts[1].lower():
-            return int(parts[0]) * 60
-        else:
-            return int(parts[0])
+    def titles(self):
+        """
+        The method returns the shared dict {movieId: title}. The title strings are the ones of the Movies rows
+        with the quotes stripped.
+        """
+        with self.__lock:
+            if self.__titles is None:
+                self.__titles = {int(movie['movieId']): movie['title'].strip('"') for movie in self.movies().movies}
+            return self.__titles
 
-    def top_directors(self, n:int):
+    def title(self, movie_id):
         """
-        The method returns a dict with top-n directors where the keys are directors and 
-        the values are numbers of movies created by them. Sort it by numbers descendingly.
+        The method returns the title of the movie (movieId as int or str), or None if it is unknown.
         """
-        directors = defaultdict(int)
-        movies = self.get_imdb([key for key, _ in self.get_ids_dict().items()], ['Director'])
-        
-        for movie in movies:
-            director = movie[1]
+        return self.titles().get(int(movie_id))
 
-            if director:
-                directors[director] += 1
-                
-        return dict(sorted(directors.items(), key=lambda x: x[1], reverse=True)[:n])
+    def ratings(self):
+        return self.__dataset('ratings', lambda: Ratings(self.paths['ratings'], movie_titles=self.titles(),
+                                                         sample=self.sample))
 
-    def most_expensive(self, n:int):
+    def tags(self):
+        return self.__dataset('tags', lambda: Tags(self.paths['tags'], sample=self.sample))
+
+    def links(self):
+        return self.__dataset('links', lambda: Links(self.paths['links'], self.links_lenght))
+
+    def sqlite(self, path_to_the_db:str = ':memory:'):
         """
-        The method returns a dict with top-n movies where the keys are movie titles and
-        the values are their budgets. Sort it by budgets descendingly.
+        The method returns a SQLiteBackend with the files of the catalog loaded, once.
         """
-        movies = {}
-        data = self.get_imdb([key for key, _ in self.get_ids_dict().items()], ['Title', 'Budget'])
-        for movie in data:
-            title = movie[1]
-            budget = movie[2]
+        def load():
+            backend = SQLiteBackend(path_to_the_db)
+            backend.load_dir(**self.paths)
+            return backend
+        return self.__dataset('sqlite', load)
 
-            if title and budget:
-                movies[title] = budget
+    def cube(self):
+        """
+        The method returns the RatingsCube of the movies and ratings of the catalog, built once.
+        """
+        return self.__dataset('cube', lambda: RatingsCube(self.movies(), self.ratings()))
 
-        return dict(sorted(movies.items(), key=lambda x: x[1], reverse=True)[:n])
+    def tag_index(self):
+        """
+        The method returns the TagRatingIndex of the tags and ratings of the catalog, built once.
+        """
+        return self.__dataset('tag_index', lambda: TagRatingIndex(self.tags(), self.ratings()))
 
-    def most_profitable(self, n:int):
+    def loaded(self):
         """
-        The method returns a dict with top-n movies where the keys are movie titles and
-        the values are the difference between cumulative worldwide gross and budget.
-        Sort it by the difference descendingly.
+        The method returns the names of the datasets loaded so far.
         """
-        profits = {}
-        data = self.get_imdb([key for key, _ in self.get_ids_dict().items()], ['Title', 'Budget', 'Cumulative Worldwide Gross'])
-        for movie in data:
-            title = movie[1]
-            budget = movie[2]
-            gross = movie[3]
-            
-            if title and budget and gross:
-                profits[title] = gross - budget
+        with self.__lock:
+            return sorted(self.__datasets)
 
-        return dict(sorted(profits.items(), key=lambda x: x[1], reverse=True)[:n])
 
-    def longest(self, n:int):
+REPORT_TARGETS = ('movies', 'tags', 'ratings.movies', 'ratings.users', 'links')
+
+_REPORT = {}
+
+
+def load_report_spec(path_to_the_file:str):
+    """
+    The function reads a report spec, a JSON file like
+    {"datasets": "../datasets", "links_lenght": 50, "analyses": [
+        {"name": "top rated", "dataset": "ratings.movies", "method": "top_by_ratings", "args": [10], "kwargs": {"metric": "median"}},
+        {"dataset": "movies", "method": "dist_by_release"}]}
+    and returns it with the defaults filled in. Raises ValueError for unknown datasets or methods.
+    """
+    with open(path_to_the_file, 'r', encoding='utf-8') as file:
+        spec = json.load(file)
+    analyses = spec.get('analyses')
+    if not isinstance(analyses, list) or not analyses:
+        raise ValueError("The report spec must have a non-empty list of analyses")
+    classes = _target_classes()
+    for i, analysis in enumerate(analyses):
+        dataset, method = analysis.get('dataset'), analysis.get('method')
+        if dataset not in classes:
+            raise ValueError(f"Analysis {i}: dataset must be one of {REPORT_TARGETS}, got {dataset!r}")
+        if not isinstance(method, str) or method.startswith('_') or not callable(getattr(classes[dataset], method, None)):
+            raise ValueError(f"Analysis {i}: unknown method {dataset}.{method}")
+        analysis.setdefault('name', f"{dataset}.{method}")
+        analysis.setdefault('args', [])
+        analysis.setdefault('kwargs', {})
+    return spec
+
+
+def _target_classes():
+    return {'movies': Movies, 'tags': Tags, 'ratings.movies': Ratings.Movies,
+            'ratings.users': Ratings.Users, 'links': Links}
+
+
+def _report_target(catalog, dataset:str):
+    if dataset == 'ratings.movies':
+        return catalog.ratings().Movies(catalog.ratings())
+    if dataset == 'ratings.users':
+        return catalog.ratings().Users(catalog.ratings())
+    return getattr(catalog, dataset)()
+
+
+def _run_analysis(index:int):
+    analysis = _REPORT['spec']['analyses'][index]
+    target = _report_target(_REPORT['catalog'], analysis['dataset'])
+    started = time.perf_counter()
+    try:
+        result = getattr(target, analysis['method'])(*analysis['args'], **analysis['kwargs'])
+        error = None
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    return {'name': analysis['name'], 'dataset': analysis['dataset'], 'method': analysis['method'],
+            'args': analysis['args'], 'kwargs': analysis['kwargs'], 'seconds': time.perf_counter() - started,
+            'result': _jsonable(result), 'error': error}
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def run_report(spec:dict, catalog=None, workers:int = None, executor:str = 'process'):
+    """
+    The function loads the datasets used by the spec once, then runs the analyses in parallel on a pool
+    of worker processes (forked, so they share the loaded data) or threads.
+    Returns the result bundle: a dict with the load timings and a list of results in spec order.
+    """
+    started = time.perf_counter()
+    catalog = catalog or MovieLensCatalog(spec.get('datasets', DATASETS_DIR), spec.get('links_lenght', 1000))
+    load_seconds = {}
+    for dataset in dict.fromkeys(analysis['dataset'].split('.')[0] for analysis in spec['analyses']):
+        loading = time.perf_counter()
+        loaded = getattr(catalog, dataset)()
+        if dataset == 'links':
+            loaded.get_imdb_table()
+        load_seconds[dataset] = time.perf_counter() - loading
+    if executor == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+        executor = 'thread'
+    _REPORT.update(spec=spec, catalog=catalog)
+    try:
+        indexes = range(len(spec['analyses']))
+        if executor == 'process':
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(_run_analysis, indexes))
+        elif executor == 'thread':
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_run_analysis, indexes))
+        else:
+            raise ValueError(f"executor must be 'process' or 'thread', got {executor!r}")
+    finally:
+        _REPORT.clear()
+    return {'created': datetime.now().isoformat(timespec='seconds'), 'executor': executor,
+            'load_seconds': load_seconds, 'total_seconds': time.perf_counter() - started, 'analyses': results}
+
+
+def write_report(bundle:dict, path_to_the_file:str, output_format:str = 'json'):
+    """
+    The function writes the result bundle as JSON, or as CSV with one row per result item
+    (name, dataset, method, seconds, error, key, value). Scalar results are one row without a key,
+    and failed or empty results one row without a key and a value, so every analysis is in the file.
+    """
+    if output_format == 'json':
+        with open(path_to_the_file, 'w', encoding='utf-8') as file:
+            json.dump(bundle, file, indent=2, ensure_ascii=False)
+        return
+    with open(path_to_the_file, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['name', 'dataset', 'method', 'seconds', 'error', 'key', 'value'])
+        for analysis in bundle['analyses']:
+            common = [analysis['name'], analysis['dataset'], analysis['method'], f"{analysis['seconds']:.6f}",
+                      analysis['error'] or '']
+            result = analysis['result']
+            if isinstance(result, dict):
+                items = list(result.items())
+            elif isinstance(result, list):
+                items = list(enumerate(result))
+            else:
+                items = [('', '' if result is None else result)]
+            for key, value in items or [('', '')]:
+                writer.writerow(common + [key, json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value])
+
+
+class QueryServer:
+    """
+    Local asyncio HTTP/1.1 server which keeps one MovieLensCatalog loaded in memory and answers the analytics
+    methods (the memoized ones) of the report datasets, so repeated queries hit warm data and, with serve(),
+    the result cache:
+        GET /ratings.movies/top_by_ratings?n=10&metric=median   (values are parsed as JSON when they can be)
+        POST /ratings.movies/top_by_ratings   {"args": [10], "kwargs": {"metric": "median"}}
+        GET /datasets, GET /health, GET /metrics (Instrumentation in the Prometheus format)
+    Responses are JSON {dataset, method, result, seconds} or {error} with status 400, 404, 413 or 500.
+    The movies= argument of the per-group methods is the Movies of the catalog and is not taken from requests.
+    Request bodies are limited to max_body bytes.
+    The methods run on a thread pool of workers, so slow queries do not block the other connections.
+    """
+
+    def __init__(self, catalog, workers:int = None, max_body:int = 1 << 20):
+        self.catalog = catalog
+        self.max_body = max_body
+        self.methods = {dataset: sorted(name for name in dir(cls) if not name.startswith('_')
+                                        and getattr(getattr(cls, name), 'memoized', False))
+                        for dataset, cls in _target_classes().items()}
+        self.__pool = ThreadPoolExecutor(max_workers=workers)
+        self.__server = None
+
+    def preload(self, datasets=('movies', 'ratings', 'tags')):
         """
-        The method returns a dict with top-n movies where the keys are movie titles and
-        the values are their runtime. If there are more than one version – choose any.
-        Sort it by runtime descendingly.
+        The method loads the datasets (catalog names) so the first queries do not pay the load.
         """
-        runtimes = {}
-        data = self.get_imdb([key for key, _ in self.get_ids_dict().items()], ['Title', 'Runtime'])
-        
-        for movie in data:
-            title = movie[1]
-            runtime = movie[2]
-            
-            if title and runtime:
-                runtimes[title] = runtime
-                    
-        return dict(sorted(runtimes.items(), key=lambda x: x[1], reverse=True)[:n])
+        for dataset in datasets:
+            getattr(self.catalog, dataset)()
 
-    def top_cost_per_minute(self, n:int):
+    def query(self, dataset:str, method:str, args:list = (), kwargs:dict = None):
         """
-        The method returns a dict with top-n movies where the keys are movie titles and
-        the values are the budgets divided by their runtime. The budgets can be in different currencies – do not pay attention to it. #YET I PAID
-        The values should be rounded to 2 decimals. Sort it by the division descendingly.
+        The method runs one analytics method and returns (HTTP status, JSON-ready response).
         """
-        costs = {}
-        data = self.get_imdb([key for key, _ in self.get_ids_dict().items()], ['Title', 'Budget', 'Runtime'])
-        
-        for movie in data:
-            title = movie[1]
-            budget = movie[2]
-            runtime = movie[3]
-            if title and budget and runtime and runtime > 0 and budget > 0:
-                cost_per_minute = round(budget / runtime, 2)
-                costs[title] = cost_per_minute
-        return dict(sorted(costs.items(), key=lambda x: x[1], reverse=True)[:n])
-    
-    def get_imdb_rating(self, list_of_movie_ids:list): #bonus part
-        """"
-        Huntin bonus exp I invented this method, which returns dict with imdb ratings for given movie_ids where the keys are movie_ids and
-        the values are the ratings
-        Dict sorted by movie_id asc
+        if dataset not in self.methods:
+            return 404, {'error': f"Unknown dataset {dataset!r}, expected one of {REPORT_TARGETS}"}
+        if method not in self.methods[dataset]:
+            return 404, {'error': f"Unknown method {dataset}.{method}"}
+        started = time.perf_counter()
+        try:
+            function = getattr(_report_target(self.catalog, dataset), method)
+            kwargs = dict(kwargs or {})
+            signature = inspect.signature(function)
+            if 'movies' in signature.parameters:
+                if 'movies' in kwargs:
+                    return 400, {'error': "movies is the Movies of the catalog and cannot be passed"}
+                kwargs['movies'] = self.catalog.movies()
+            try:
+                signature.bind(*args, **kwargs)
+            except TypeError as e:
+                return 400, {'error': f"Invalid arguments: {e}"}
+            result = function(*args, **kwargs)
+        except Exception as e:
+            return 500, {'error': f"{type(e).__name__}: {e}"}
+        return 200, {'dataset': dataset, 'method': method, 'result': _jsonable(result),
+                     'seconds': time.perf_counter() - started}
+
+    async def start(self, host:str = '127.0.0.1', port:int = 8000, unix_socket:str = None):
         """
-        return {movie_id: rating for movie_id, rating in reversed(self.get_imdb(list_of_movie_ids, ['Rating']))}
+        The method starts listening on host:port, or on the Unix socket path, and returns the asyncio server.
+        """
+        if unix_socket is not None:
+            self.__server = await asyncio.start_unix_server(self.__connection, unix_socket)
+        else:
+            self.__server = await asyncio.start_server(self.__connection, host, port)
+        return self.__server
 
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+        self.__pool.shutdown(wait=False)
 
-MOVIE_CSV_FILE = '../datasets/movies.csv'
+    async def __connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = headers.get('content-length', '0').strip() or '0'
+                if not length.isdigit():
+                    # the body cannot be framed, so the connection is answered and closed
+                    await self.__send(writer, *self.__json(400, {'error': f"Invalid Content-Length {length!r}"}), False)
+                    break
+                if int(length) > self.max_body:
+                    await self.__send(writer, *self.__json(413, {'error': f"Body over {self.max_body} bytes"}), False)
+                    break
+                body = await reader.readexactly(int(length))
+                status, content_type, payload = await self.__respond(request_line.decode('latin-1'), body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.__send(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def __send(self, writer, status:int, content_type:str, payload:bytes, keep_alive:bool):
+        writer.write(f"HTTP/1.1 {status} {self.REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                     f"\r\n\r\n".encode('latin-1') + payload)
+        await writer.drain()
+
+    REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Content Too Large', 500: 'Internal Server Error'}
+
+    async def __respond(self, request_line:str, body:bytes):
+        try:
+            verb, target, _ = request_line.split(' ', 2)
+        except ValueError:
+            return self.__json(400, {'error': "Malformed request line"})
+        url = urlsplit(target)
+        path = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        if verb not in ('GET', 'POST'):
+            return self.__json(405, {'error': f"Method {verb} is not allowed"})
+        if path == ['health']:
+            return self.__json(200, {'status': 'ok', 'loaded': self.catalog.loaded()})
+        if path == ['datasets']:
+            return self.__json(200, self.methods)
+        if path == ['metrics']:
+            return 200, 'text/plain; version=0.0.4', INSTRUMENTATION.to_prometheus().encode('utf-8')
+        if len(path) != 2:
+            return self.__json(404, {'error': f"Unknown path {url.path}"})
+        try:
+            if verb == 'POST' and body:
+                call = json.loads(body)
+                args, kwargs = call.get('args', []), call.get('kwargs', {})
+            else:
+                args, kwargs = [], {name: self.__value(value) for name, value in parse_qsl(url.query)}
+            if not isinstance(args, list) or not isinstance(kwargs, dict):
+                raise ValueError("args must be a list and kwargs an object")
+        except (ValueError, AttributeError) as e:
+            return self.__json(400, {'error': f"Invalid arguments: {e}"})
+        loop = asyncio.get_running_loop()
+        status, response = await loop.run_in_executor(self.__pool, self.query, path[0], path[1], args, kwargs)
+        return self.__json(status, response)
+
+    @staticmethod
+    def __value(text:str):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+
+    @staticmethod
+    def __json(status:int, response):
+        return status, 'application/json', json.dumps(response, ensure_ascii=False).encode('utf-8')
+
+
+def serve(catalog, host:str = '127.0.0.1', port:int = 8000, unix_socket:str = None, workers:int = None,
+          preload=('movies', 'ratings', 'tags')):
+    """
+    The function loads the preload datasets of the catalog and serves queries until interrupted.
+    """
+    server = QueryServer(catalog, workers)
+    server.preload(preload)
+    RESULT_CACHE.enable()
+
+    async def run():
+        listening = await server.start(host, port, unix_socket)
+        print(f"Serving {catalog.paths} on {unix_socket or f'http://{host}:{port}'}", file=sys.stderr)
+        try:
+            await listening.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+    """
+    Command line entry point: python movielens_analysis.py report spec.json --out report.json
+    or python movielens_analysis.py serve --datasets ../datasets --port 8000
+    """
+    parser = argparse.ArgumentParser(prog='movielens_analysis', description="MovieLens analytics")
+    commands = parser.add_subparsers(dest='command', required=True)
+    report = commands.add_parser('report', help="run the analyses of a report spec and write a result bundle")
+    report.add_argument('spec', help="JSON report spec")
+    report.add_argument('--datasets', default=None, help="dataset directory, overrides the spec")
+    report.add_argument('--out', default='-', help="output file, - for stdout")
+    report.add_argument('--format', choices=('json', 'csv'), default=None,
+                        help="output format, by default taken from the --out extension")
+    report.add_argument('--workers', type=int, default=None)
+    report.add_argument('--executor', choices=('process', 'thread'), default='process')
+    server = commands.add_parser('serve', help="keep the datasets in memory and answer queries over HTTP")
+    server.add_argument('--datasets', default=DATASETS_DIR, help="dataset directory or zip archive")
+    server.add_argument('--host', default='127.0.0.1')
+    server.add_argument('--port', type=int, default=8000)
+    server.add_argument('--unix', default=None, help="listen on this Unix socket instead of host:port")
+    server.add_argument('--workers', type=int, default=None)
+    server.add_argument('--preload', default='movies,ratings,tags',
+                        help="comma separated datasets to load before serving")
+    server.add_argument('--links-lenght', type=int, default=1000)
+    server.add_argument('--metrics', action='store_true', help="enable the instrumentation served on /metrics")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        if args.metrics:
+            INSTRUMENTATION.enable()
+        catalog = MovieLensCatalog(args.datasets, args.links_lenght)
+        return serve(catalog, args.host, args.port, args.unix, args.workers,
+                     [name for name in args.preload.split(',') if name])
+    spec = load_report_spec(args.spec)
+    if args.datasets:
+        spec['datasets'] = args.datasets
+    bundle = run_report(spec, workers=args.workers, executor=args.executor)
+    output_format = args.format or ('csv' if args.out.endswith('.csv') else 'json')
+    if args.out == '-':
+        if output_format == 'csv':
+            raise SystemExit("CSV output needs --out")
+        json.dump(bundle, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    else:
+        write_report(bundle, args.out, output_format)
+    return 1 if any(analysis['error'] for analysis in bundle['analyses']) else 0
 
 
 class Tests:
@@ -1189,4 +3993,991 @@ class Tests:
                     10: '7.2/10'}
         result = links_instance.get_imdb_rating(links_instance.get_ids_dict().keys())
         assert isinstance(result, dict)
-        assert result == expected
\ No newline at end of file
+        assert result == expected
+
+    # Links fetching tests (offline)
+    class FakeResponse:
+        def __init__(self, status_code, content=b'', headers=None):
+            self.status_code = status_code
+            self.content = content
+            self.headers = headers or {}
+
+    class FakeSession:
+        def __init__(self, responses):
+            self.responses = responses
+            self.calls = []
+
+        def get(self, url, timeout=None):
+            self.calls.append(url)
+            response = self.responses[url.split('/tt')[1].strip('/')].pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+    IMDB_PAGE = (b'<html><h1>Toy Story</h1><a href="/name/nm0005124/">John Lasseter</a>'
+                 b'<li>Runtime<span>1 hour 21 minutes</span></li>'
+                 b'<li>Budget<span>$30,000,000 (estimated)</span></li></html>')
+
+    @pytest.fixture
+    def offline_links(self):
+        filename = "test_links.csv"
+        content = """movieId,imdbId,tmdbId
+1,0114709,862
+2,0113497,8844
+3,0113228,15602
+"""
+        with open(filename, 'w') as f:
+            f.write(content)
+        yield filename
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def test_fetch_retries_transient_errors(self, offline_links):
+        links = Links(offline_links, 3, backoff=0)
+        session = self.FakeSession({
+            '0114709': [requests.ConnectionError("reset"), self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113497': [self.FakeResponse(429, headers={'Retry-After': '0'}), self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113228': [self.FakeResponse(404)],
+        })
+        links._Links__session = session
+        result = links.get_imdb([1, 2, 3], ['Title', 'Runtime', 'Budget'])
+        assert result == [[2, 'Toy Story', 81, 30000000.0], [1, 'Toy Story', 81, 30000000.0]]
+        assert len(session.calls) == 5
+        failures = links.get_failures()
+        assert list(failures) == [3]
+        assert failures[3]['status'] == 404
+        assert failures[3]['attempts'] == 1
+
+    def test_fetch_honors_retry_after(self, offline_links, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(time, 'sleep', sleeps.append)
+        links = Links(offline_links, 3, backoff=0, max_backoff=2.0, fetch_workers=1)
+        links._Links__session = self.FakeSession({
+            '0114709': [self.FakeResponse(503, headers={'Retry-After': '1.5'}), self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113497': [self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113228': [self.FakeResponse(404)],
+        })
+        assert len(links.get_imdb([1, 2, 3], ['Title'])) == 2
+        assert sleeps == [1.5]
+        throttled = Links(offline_links, 3, backoff=0, max_backoff=2.0, fetch_workers=1)
+        session = self.FakeSession({
+            '0114709': [self.FakeResponse(429, headers={'Retry-After': '3600'}), self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113497': [self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113228': [self.FakeResponse(200, self.IMDB_PAGE)],
+        })
+        throttled._Links__session = session
+        assert throttled.get_imdb([1, 2, 3], ['Title']) == []
+        assert len(session.calls) == 1 and sleeps == [1.5]
+        failures = throttled.get_failures()
+        assert failures[1] == {'imdbId': '0114709', 'status': 429, 'error': 'HTTP 429', 'attempts': 1, 'retry_after': 3600.0}
+        assert failures[2]['error'] == failures[3]['error'] == 'circuit breaker open'
+        with pytest.raises(ValueError):
+            Links(offline_links, 3, retries=-1)
+
+    def test_fetch_circuit_breaker(self, offline_links):
+        links = Links(offline_links, 3, retries=2, backoff=0, breaker_threshold=3, fetch_workers=1)
+        session = self.FakeSession({imdb_id: [self.FakeResponse(503)] * 3 for imdb_id in ('0114709', '0113497', '0113228')})
+        links._Links__session = session
+        assert links.get_imdb([1, 2, 3], ['Title']) == []
+        assert len(session.calls) == 3
+        failures = links.get_failures()
+        assert failures[1] == {'imdbId': '0114709', 'status': 503, 'error': 'HTTP 503', 'attempts': 3}
+        assert failures[2]['error'] == failures[3]['error'] == 'circuit breaker open'
+        assert failures[2]['attempts'] == 0
+
+    def test_imdb_table_rankings(self):
+        table = ImdbTable({
+            1: {'Title': 'Toy Story', 'Director': 'John Lasseter', 'Budget': 30000000.0,
+                'Cumulative Worldwide Gross': 394436586.0, 'Runtime': 81},
+            2: {'Title': 'Jumanji', 'Director': 'Joe Johnston', 'Budget': 65000000.0,
+                'Cumulative Worldwide Gross': 262821940.0, 'Runtime': 104},
+            3: {'Title': 'Tom and Huck', 'Director': 'Peter Hewitt', 'Budget': None,
+                'Cumulative Worldwide Gross': 23920048.0, 'Runtime': 97},
+            4: {'Title': 'Toy Story', 'Director': 'John Lasseter', 'Budget': None,
+                'Cumulative Worldwide Gross': None, 'Runtime': None},
+        })
+        assert len(table) == 4
+        assert list(table.movie_ids) == [4, 3, 2, 1]
+        assert table.top('directors', 2) == {'John Lasseter': 2, 'Peter Hewitt': 1}
+        assert table.top('budgets', 5) == {'Jumanji': 65000000.0, 'Toy Story': 30000000.0}
+        assert table.top('profits', 1) == {'Toy Story': 364436586.0}
+        assert table.top('runtimes', 3) == {'Jumanji': 104, 'Tom and Huck': 97, 'Toy Story': 81}
+        assert all(isinstance(v, int) for v in table.top('runtimes', 3).values())
+        assert table.top('cost_per_minute', 2) == {'Jumanji': 625000.0, 'Toy Story': 370370.37}
+
+    def test_iter_imdb_streams_results(self, offline_links):
+        links = Links(offline_links, 3, backoff=0)
+        links._Links__session = self.FakeSession({
+            '0114709': [self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113497': [self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113228': [self.FakeResponse(404)],
+        })
+        stream = links.iter_imdb(fetch_workers=2, parse_workers=1, queue_size=1)
+        first_id, first_data = next(stream)
+        assert first_id in (1, 2)
+        assert first_data['Director'] == 'John Lasseter'
+        assert first_data['Runtime'] == 81
+        rest = dict(stream)
+        assert sorted([first_id, *rest]) == [1, 2]
+        assert list(links.get_failures()) == [3]
+        assert links.longest(5) == {'Toy Story': 81}
+
+    def test_iter_imdb_inline_parsing(self, offline_links):
+        links = Links(offline_links, 3, backoff=0, parse_workers=0)
+        session = self.FakeSession({imdb_id: [self.FakeResponse(200, self.IMDB_PAGE)]
+                                    for imdb_id in ('0114709', '0113497', '0113228')})
+        links._Links__session = session
+        assert [row[0] for row in links.get_imdb([1, 2, 3], ['Title'])] == [3, 2, 1]
+        assert list(links.iter_imdb()) == []
+        assert len(session.calls) == 3
+
+    def test_iter_imdb_parses_inline_without_a_pool(self, offline_links, monkeypatch):
+        class NoPool:
+            def __init__(self, max_workers):
+                raise OSError("no semaphores")
+        monkeypatch.setattr(sys.modules[__name__], 'ProcessPoolExecutor', NoPool)
+        links = Links(offline_links, 3, backoff=0)
+        links._Links__session = self.FakeSession({imdb_id: [self.FakeResponse(200, self.IMDB_PAGE)]
+                                                  for imdb_id in ('0114709', '0113497', '0113228')})
+        assert sorted(movie_id for movie_id, _ in links.iter_imdb()) == [1, 2, 3]
+        assert links.longest(1) == {'Toy Story': 81}
+
+    @pytest.fixture
+    def metadata_jsonl(self):
+        filename = "test_metadata.jsonl"
+        rows = [
+            {'imdbId': 'tt0114709', 'Title': 'Toy Story', 'Director': 'John Lasseter', 'Budget': 30000000,
+             'Gross': 394436586, 'Runtime': 81, 'Rating': '8.3/10'},
+            {'imdbId': 'tt9999999', 'Title': 'Not in links', 'Runtime': 200},
+            {'tmdbId': 8844, 'Title': 'Jumanji', 'Director': 'Joe Johnston', 'Budget': '65000000',
+             'Runtime': '104'},
+        ]
+        with open(filename, 'w') as f:
+            f.write("\n".join(json.dumps(row) for row in rows) + "\n")
+        yield filename
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def test_load_metadata_jsonl(self, offline_links, metadata_jsonl):
+        links = Links(offline_links, 3, backoff=0, metadata_file=metadata_jsonl)
+        assert links.get_tmdb_dict() == {1: 862, 2: 8844, 3: 15602}
+        session = self.FakeSession({'0113228': [self.FakeResponse(404)]})
+        links._Links__session = session
+        assert links.get_imdb([1, 2, 3], ['Title', 'Budget', 'Cumulative Worldwide Gross', 'Runtime']) == [
+            [2, 'Jumanji', 65000000.0, None, 104],
+            [1, 'Toy Story', 30000000.0, 394436586.0, 81],
+        ]
+        assert len(session.calls) == 1
+        assert links.longest(5) == {'Jumanji': 104, 'Toy Story': 81}
+
+    def test_load_metadata_csv(self, offline_links):
+        filename = "test_metadata.csv"
+        with open(filename, 'w') as f:
+            f.write("imdbId,tmdbId,Title,Director,Budget,Cumulative Worldwide Gross,Runtime,Rating\n"
+                    "0113228,15602,Grumpier Old Men,Howard Deutch,25000000,71518503,101,6.7/10\n"
+                    "0113497,,Jumanji,Joe Johnston,\"$65,000,000\",,1h 44m,7.0/10\n"
+                    ",,Broken,,,,,\n")
+        try:
+            links = Links(offline_links, 3)
+            assert links.load_metadata(filename) == 2
+            assert links._Links__parsed_data[3] == {
+                'Director': 'Howard Deutch', 'Budget': 25000000.0, 'Cumulative Worldwide Gross': 71518503.0,
+                'Runtime': 101, 'Title': 'Grumpier Old Men', 'Rating': '6.7/10'}
+            assert links._Links__parsed_data[2] == {
+                'Director': 'Joe Johnston', 'Budget': None, 'Cumulative Worldwide Gross': None,
+                'Runtime': None, 'Title': 'Jumanji', 'Rating': '7.0/10'}
+            record = {'Title': 'Heat', 'Gross': '187436818'}
+            assert links._Links__metadata_row(record)['Cumulative Worldwide Gross'] == 187436818.0
+            assert record == {'Title': 'Heat', 'Gross': '187436818'}
+        finally:
+            os.remove(filename)
+
+    def test_links_streaming_lenient(self):
+        filename = "test_links_full.csv"
+        with open(filename, 'w') as f:
+            f.write("movieId,imdbId,tmdbId\n1,0114709,862\nbroken line\n2,0113497,8844\n3,,15602\n4,0114885,31357\n")
+        try:
+            with pytest.raises(ValueError):
+                Links(filename, None)
+            links = Links(filename, None, strict=False)
+            assert links.get_ids_dict() == {1: '0114709', 2: '0113497', 4: '0114885'}
+            assert [reject['line'] for reject in links.get_rejects()] == [3, 5]
+            assert Links(filename, 2, strict=False).get_ids_dict() == {1: '0114709'}
+        finally:
+            os.remove(filename)
+
+    def test_links_partitions_merge(self, offline_links, metadata_jsonl):
+        ranges = Links.split_ranges(offline_links, 2)
+        assert ranges == [(1, 2), (2, 4)]
+        parts = [Links(offline_links, None, id_range=r, metadata_file=metadata_jsonl) for r in ranges]
+        assert sorted(parts[0].get_ids_dict()) == [1]
+        assert sorted(parts[1].get_ids_dict()) == [2, 3]
+        merged = parts[0].merge(parts[1].get_state())
+        assert merged.get_ids_dict() == Links(offline_links, None).get_ids_dict()
+        merged._Links__session = self.FakeSession({'0113228': [self.FakeResponse(404)]})
+        assert merged.longest(5) == {'Jumanji': 104, 'Toy Story': 81}
+        shards = [Links(offline_links, None, shard=(i, 3)) for i in range(3)]
+        assert sorted(movie_id for part in shards for movie_id in part.get_ids_dict()) == [1, 2, 3]
+        empty = Links.empty(backoff=0)
+        assert empty.get_ids_dict() == {} and empty.get_imdb([1], ['Title']) == []
+        assert functools.reduce(Links.merge, shards, empty).get_ids_dict() == Links(offline_links, None).get_ids_dict()
+
+    # Instrumentation tests
+    @pytest.fixture
+    def instrumentation(self):
+        INSTRUMENTATION.reset()
+        INSTRUMENTATION.enable()
+        yield INSTRUMENTATION
+        INSTRUMENTATION.disable()
+        INSTRUMENTATION.reset()
+
+    def test_instrumentation_disabled_by_default(self, movies_instance):
+        INSTRUMENTATION.reset()
+        movies_instance.dist_by_year()
+        assert INSTRUMENTATION.snapshot() == {}
+
+    def test_instrumentation_records_calls(self, instrumentation, sample_csv_file):
+        ratings = Ratings(sample_csv_file)
+        movies = ratings.Movies(ratings)
+        movies.top_by_ratings(2)
+        movies.top_by_ratings(3)
+        snapshot = instrumentation.snapshot()
+        assert snapshot['Ratings.__init__']['calls'] == 1
+        assert snapshot['Ratings.__init__']['rows_scanned'] == 7
+        assert snapshot['Ratings.__init__']['bytes_read'] == os.path.getsize(sample_csv_file)
+        assert snapshot['Ratings.Movies.top_by_ratings']['calls'] == 2
+        assert snapshot['Ratings.Movies.top_by_ratings']['rows_scanned'] == 14
+        assert snapshot['Ratings.Movies.top_by_ratings']['wall_time'] > 0
+        assert json.loads(instrumentation.to_json()) == snapshot
+        prometheus = instrumentation.to_prometheus()
+        assert '# TYPE movielens_calls_total counter' in prometheus
+        assert 'movielens_calls_total{method="Ratings.Movies.top_by_ratings"} 2' in prometheus
+
+    def test_instrumentation_counts_consumed_bytes(self, instrumentation, tmp_path):
+        path = tmp_path / 'tags.csv'
+        lines = ['userId,movieId,tag,timestamp\n'] + [f"{i},{i},tag {i},0\n" for i in range(1, 3001)]
+        path.write_text(''.join(lines))
+        assert len(Tags(str(path)).tags) == 1000
+        assert instrumentation.snapshot()['Tags.__init__']['bytes_read'] == len(''.join(lines[:1001]).encode())
+        assert instrumentation.snapshot()['Tags.__init__']['rows_scanned'] == 1000
+
+    def test_instrumentation_counts_scanned_not_kept_rows(self, instrumentation, tmp_path, offline_links):
+        path = tmp_path / 'tags.csv'
+        path.write_text('userId,movieId,tag,timestamp\n' + ''.join(f"{i},{i},tag {i},0\n" for i in range(1, 101))
+                        + 'broken\n' * 5)
+        tags = Tags(str(path), strict=False, sample=Sampler('users', fraction=0.3))
+        assert len(tags.tags) < 100 and len(tags.get_rejects()) == 5
+        assert instrumentation.snapshot()['Tags.__init__']['rows_scanned'] == 105
+        followed = Tags(str(path), follow=True, strict=False)
+        assert instrumentation.snapshot()['Tags.__init__']['rows_scanned'] == 210
+        assert followed.refresh() == 0
+        assert instrumentation.snapshot()['Tags.refresh']['rows_scanned'] == 105
+        Links(offline_links, None, id_range=(2, 3))
+        assert instrumentation.snapshot()['Links.__init__']['rows_scanned'] == 3
+
+    def test_instrumentation_cache_hit_scans_no_rows(self, instrumentation, result_cache, sample_csv_file):
+        movies = Ratings.Movies(Ratings(sample_csv_file))
+        movies.dist_by_year()
+        stats = instrumentation.snapshot()['Ratings.Movies.dist_by_year']
+        assert (stats['rows_scanned'], stats['cache_hits']) == (7, 0)
+        movies.dist_by_year()
+        stats = instrumentation.snapshot()['Ratings.Movies.dist_by_year']
+        assert (stats['calls'], stats['rows_scanned'], stats['cache_hits']) == (2, 7, 1)
+
+    def test_instrumentation_nested_http(self, instrumentation, result_cache, offline_links):
+        links = Links(offline_links, 3, backoff=0)
+        links._Links__session = self.FakeSession({
+            '0114709': [self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113497': [self.FakeResponse(503), self.FakeResponse(200, self.IMDB_PAGE)],
+            '0113228': [self.FakeResponse(404)],
+        })
+        links.longest(1)
+        links.longest(1)
+        snapshot = instrumentation.snapshot()
+        assert snapshot['Links.get_imdb_table']['http_requests'] == 4
+        assert snapshot['Links.longest']['http_requests'] == 4
+        assert snapshot['Links.longest']['bytes_read'] == 2 * len(self.IMDB_PAGE)
+        assert snapshot['Links.longest']['cache_misses'] == 2
+        assert snapshot['Links.longest']['cache_hits'] == 1
+        assert snapshot['Links.get_imdb_table']['calls'] == 1
+
+    # MovieLensCatalog tests
+    @pytest.fixture
+    def dataset_dir(self, tmp_path):
+        files = {
+            'movies.csv': """movieId,title,genres
+1,Toy Story (1995),Adventure|Animation|Children|Comedy|Fantasy
+2,Jumanji (1995),Adventure|Children|Fantasy
+3,"American President, The (1995)",Comedy|Drama|Romance
+4,Heat (1995),Action|Crime|Thriller
+5,Fargo (1996),Comedy|Crime|Drama|Thriller
+""",
+            'ratings.csv': """userId,movieId,rating,timestamp
+1,1,4.0,964982703
+1,3,4.0,964981247
+1,4,5.0,964982224
+2,1,3.0,1009200000
+2,2,2.5,1009200100
+2,5,5.0,1009200200
+3,1,4.5,1104537600
+3,4,3.5,1104537700
+3,5,4.0,1104537800
+4,3,1.0,1262304000
+""",
+            'tags.csv': """userId,movieId,tag,timestamp
+1,1,pixar,1139045764
+1,4,atmospheric,1139045765
+2,4,atmospheric,1139045766
+2,5,dark comedy,1139045767
+3,5,atmospheric,1139045768
+3,1,funny,1139045769
+""",
+            'links.csv': """movieId,imdbId,tmdbId
+1,0114709,862
+2,0113497,8844
+3,0112346,9087
+4,0113277,949
+5,0116282,275
+""",
+        }
+        for name, content in files.items():
+            (tmp_path / name).write_text(content, encoding='utf-8')
+        return str(tmp_path)
+
+    def test_catalog_loads_once(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        assert catalog.loaded() == []
+        ratings = catalog.ratings()
+        assert catalog.loaded() == ['movies', 'ratings']
+        assert catalog.ratings() is ratings
+        assert catalog.movies() is catalog.movies()
+        assert catalog.titles()[3] == 'American President, The (1995)'
+        assert ratings.data_joined[0]['title'] is catalog.movies().movies[0]['title']
+        assert catalog.title('4') == 'Heat (1995)'
+        assert [catalog.title(movie_id) for movie_id in catalog.tags().movie_by_tag('atmospheric')] == \
+            ['Heat (1995)', 'Fargo (1996)']
+        assert sorted(catalog.links().get_ids_dict()) == [1, 2, 3, 4, 5]
+        standalone = Ratings(catalog.paths['ratings'], catalog.paths['movies'])
+        assert standalone.data_joined == ratings.data_joined
+
+    def test_catalog_unknown_dataset(self, dataset_dir):
+        with pytest.raises(ValueError):
+            MovieLensCatalog(dataset_dir, reviews='reviews.csv')
+
+    # Report CLI tests
+    @pytest.fixture
+    def report_spec(self, dataset_dir):
+        spec = {'datasets': dataset_dir, 'analyses': [
+            {'dataset': 'movies', 'method': 'dist_by_release'},
+            {'name': 'median', 'dataset': 'ratings.movies', 'method': 'top_by_ratings', 'args': [2],
+             'kwargs': {'metric': 'median'}},
+            {'dataset': 'ratings.users', 'method': 'users_distribution'},
+            {'dataset': 'tags', 'method': 'most_popular', 'args': [1]},
+        ]}
+        path = os.path.join(dataset_dir, 'spec.json')
+        with open(path, 'w') as f:
+            json.dump(spec, f)
+        return path
+
+    @pytest.mark.parametrize('executor', ['process', 'thread'])
+    def test_report_cli_json(self, report_spec, dataset_dir, executor):
+        out = os.path.join(dataset_dir, 'report.json')
+        assert main(['report', report_spec, '--out', out, '--workers', '2', '--executor', executor]) == 0
+        with open(out) as f:
+            bundle = json.load(f)
+        assert sorted(bundle['load_seconds']) == ['movies', 'ratings', 'tags']
+        assert [analysis['name'] for analysis in bundle['analyses']] == \
+            ['movies.dist_by_release', 'median', 'ratings.users.users_distribution', 'tags.most_popular']
+        assert bundle['analyses'][0]['result'] == {'1995': 4, '1996': 1}
+        assert bundle['analyses'][1]['result'] == {'Fargo (1996)': 4.5, 'Heat (1995)': 4.25}
+        assert bundle['analyses'][3]['result'] == {'atmospheric': 3}
+        assert all(analysis['seconds'] >= 0 and analysis['error'] is None for analysis in bundle['analyses'])
+
+    def test_report_cli_csv(self, report_spec, dataset_dir):
+        out = os.path.join(dataset_dir, 'report.csv')
+        assert main(['report', report_spec, '--out', out, '--executor', 'thread']) == 0
+        with open(out, newline='') as f:
+            rows = list(csv.DictReader(f))
+        assert rows[0]['name'] == 'movies.dist_by_release'
+        assert (rows[0]['key'], rows[0]['value']) == ('1995', '4')
+        assert rows[-1]['value'] == '3'
+
+    def test_report_csv_rows_for_every_analysis(self, tmp_path):
+        analyses = [{'name': name, 'dataset': 'movies', 'method': 'm', 'seconds': 0.0, 'error': error, 'result': result}
+                    for name, error, result in [('failed', 'ValueError: bad', None), ('empty', None, {}),
+                                                ('scalar', None, 4.5), ('text', None, 'Heat'), ('list', None, ['a', 'b'])]]
+        out = str(tmp_path / 'report.csv')
+        write_report({'analyses': analyses}, out, 'csv')
+        with open(out, newline='') as f:
+            rows = [(row['name'], row['error'], row['key'], row['value']) for row in csv.DictReader(f)]
+        assert rows == [('failed', 'ValueError: bad', '', ''), ('empty', '', '', ''), ('scalar', '', '', '4.5'),
+                        ('text', '', '', 'Heat'), ('list', '', '0', 'a'), ('list', '', '1', 'b')]
+
+    def test_report_spec_validation(self, dataset_dir):
+        path = os.path.join(dataset_dir, 'bad_spec.json')
+        with open(path, 'w') as f:
+            json.dump({'analyses': [{'dataset': 'movies', 'method': '_rows_scanned'}]}, f)
+        with pytest.raises(ValueError):
+            load_report_spec(path)
+
+    # ResultCache tests
+    @pytest.fixture
+    def result_cache(self):
+        RESULT_CACHE.clear()
+        RESULT_CACHE.enable()
+        yield RESULT_CACHE
+        RESULT_CACHE.disable()
+        RESULT_CACHE.clear()
+
+    def test_result_cache_disabled_by_default(self, movies_instance):
+        first = movies_instance.dist_by_rating()
+        movies_instance.parent.data_joined[0]['rating'] = 0.5
+        assert movies_instance.dist_by_rating() != first
+        assert RESULT_CACHE.stats()['size'] == 0
+
+    def test_result_cache_returns_deep_copies(self, result_cache, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        view = catalog.ratings().Movies(catalog.ratings())
+        first = view.top_by_ratings_per_group(1, by='year')
+        next(iter(first.values())).clear()
+        assert all(view.top_by_ratings_per_group(1, by='year').values())
+        assert result_cache.stats()['hits'] == 1
+
+    def test_result_cache_hits_and_invalidation(self, result_cache, movies_instance):
+        before = RESULT_CACHE.stats()
+        first = movies_instance.dist_by_rating()
+        first[5.0] = -1
+        second = movies_instance.dist_by_rating()
+        assert second[5.0] == 2
+        after = RESULT_CACHE.stats()
+        assert after['misses'] - before['misses'] == 1
+        assert after['hits'] - before['hits'] == 1
+        movies_instance.parent.data_joined.append(dict(movies_instance.parent.data_joined[0]))
+        assert movies_instance.dist_by_rating()[5.0] == 3
+        assert RESULT_CACHE.stats()['misses'] - before['misses'] == 2
+
+    def test_result_cache_lru_eviction(self):
+        cache = ResultCache(maxsize=2, enabled=True)
+        calls = []
+
+        class Dataset:
+            def data_version(self):
+                return 1
+
+            @cache.memoize
+            def square(self, x):
+                calls.append(x)
+                return x * x
+
+        data = Dataset()
+        assert [data.square(1), data.square(2), data.square(1), data.square(3), data.square(2)] == [1, 4, 1, 9, 4]
+        assert calls == [1, 2, 3, 2]
+        assert cache.stats() == {'hits': 1, 'misses': 4, 'evictions': 2, 'size': 2, 'maxsize': 2}
+        with pytest.raises(TypeError):
+            data.square([1])
+        assert cache.stats()['misses'] == 4
+
+    # Arrow / Parquet tests
+    @pytest.mark.parametrize('extension', ['parquet', 'arrow'])
+    def test_columnar_round_trip(self, dataset_dir, metadata_jsonl, offline_links, extension):
+        pytest.importorskip('pyarrow')
+        catalog = MovieLensCatalog(dataset_dir)
+        movies, tags, ratings = catalog.movies(), catalog.tags(), catalog.ratings()
+        links = Links(offline_links, 3, metadata_file=metadata_jsonl)
+        for name, dataset in (('movies', movies), ('tags', tags), ('ratings', ratings), ('links', links)):
+            dataset.save(os.path.join(dataset_dir, f"{name}.{extension}"))
+        assert Movies.load(os.path.join(dataset_dir, f"movies.{extension}")).movies == movies.movies
+        assert Tags.load(os.path.join(dataset_dir, f"tags.{extension}")).tags == tags.tags
+        loaded = Ratings.load(os.path.join(dataset_dir, f"ratings.{extension}"))
+        assert loaded.data_joined == ratings.data_joined
+        assert loaded.Movies(loaded).top_by_ratings(3) == ratings.Movies(ratings).top_by_ratings(3)
+        loaded_links = Links.load(os.path.join(dataset_dir, f"links.{extension}"))
+        assert loaded_links.get_ids_dict() == links.get_ids_dict()
+        assert loaded_links.get_state()['parsed'] == links.get_state()['parsed']
+        table = read_table(os.path.join(dataset_dir, f"ratings.{extension}"), ['movieId', 'rating'])
+        assert table.column_names == ['movieId', 'rating']
+        assert str(table.schema.field('rating').type) == 'double'
+
+    def test_convert_csv(self, dataset_dir):
+        pytest.importorskip('pyarrow')
+        path = os.path.join(dataset_dir, 'ratings.parquet')
+        assert convert_csv(os.path.join(dataset_dir, 'ratings.csv'), path, 'ratings') == 10
+        catalog = MovieLensCatalog(dataset_dir)
+        loaded = Ratings.load(path, catalog.titles())
+        assert loaded.data_joined == catalog.ratings().data_joined
+        with pytest.raises(ValueError):
+            convert_csv(os.path.join(dataset_dir, 'movies.csv'), path, 'movies')
+
+    # SQLiteBackend tests
+    def test_sqlite_backend_matches_in_memory(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        backend = catalog.sqlite()
+        assert catalog.sqlite() is backend
+        movies, tags, ratings = catalog.movies(), catalog.tags(), catalog.ratings().Movies(catalog.ratings())
+        for year in (1995, 1996, 2000):
+            assert backend.get_movies_by_year(year) == movies.get_movies_by_year(year)
+        for tag in ('atmospheric', 'a', 'missing'):
+            assert backend.movie_by_tag(tag) == tags.movie_by_tag(tag)
+        assert backend.most_popular(3) == tags.most_popular(3)
+        for n in (1, 3, 5):
+            assert backend.top_by_num_of_ratings(n) == ratings.top_by_num_of_ratings(n)
+            assert backend.top_by_ratings(n) == ratings.top_by_ratings(n)
+            assert backend.top_by_ratings(n, 'median') == ratings.top_by_ratings(n, 'median')
+        assert backend.top_by_ratings(6) == {}
+
+    def test_sqlite_backend_shared_file(self, dataset_dir):
+        path = os.path.join(dataset_dir, 'movielens.db')
+        writer = SQLiteBackend(path)
+        assert writer.load_dir(dataset_dir) == {'movies': 5, 'ratings': 10, 'tags': 6, 'links': 5}
+        reader = SQLiteBackend(path)
+        assert reader.get_movies_by_year(1996) == ['Fargo (1996)']
+        writer.close()
+        reader.close()
+
+    # Sketch tests
+    def test_sketches_accuracy(self):
+        rng = random.Random(7)
+        hll = HyperLogLog(0.02)
+        items = [rng.randint(1, 30000) for _ in range(40000)]
+        for item in items:
+            hll.add(item)
+        assert abs(hll.count() - len(set(items))) <= 3 * hll.error * len(set(items))
+        other = HyperLogLog(0.02)
+        for item in range(50000, 55000):
+            other.add(item)
+        assert abs(hll.merge(other).count() - len(set(items)) - 5000) <= 3 * hll.error * (len(set(items)) + 5000)
+        hitters = HeavyHitters(20, epsilon=0.001)
+        stream = [int(rng.paretovariate(1.2)) for _ in range(40000)]
+        for item in stream:
+            hitters.add(item)
+        exact = Counter(stream).most_common(5)
+        assert [item for item, _ in hitters.top(5)] == [item for item, _ in exact]
+        for (item, estimate), (_, count) in zip(hitters.top(5), exact):
+            assert count <= estimate <= count + hitters.sketch.epsilon * hitters.sketch.total
+        kll = KLLSketch(200)
+        values = [rng.random() for _ in range(50000)]
+        for value in values:
+            kll.add(value)
+        values.sort()
+        for q in (0.1, 0.5, 0.9):
+            rank = values.index(kll.quantile(q)) / len(values)
+            assert abs(rank - q) <= 2 * kll.error
+        assert sum(len(compactor) for compactor in kll.compactors) < 4 * kll.k
+
+    def test_approximate_loaders(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        ratings = ApproximateRatings(catalog.paths['ratings'], movie_titles=catalog.titles())
+        assert ratings.count == 10
+        assert ratings.distinct_users() == 4
+        assert ratings.distinct_movies() == 5
+        assert ratings.top_by_num_of_ratings(1) == {'Toy Story (1995)': 3}
+        assert ratings.quantile(0.5) == 4.0
+        assert set(ratings.error_bounds()) == {'distinct_relative_error', 'counts', 'counts_confidence',
+                                               'quantile_rank_error'}
+        tags = ApproximateTags(catalog.paths['tags'])
+        assert tags.most_popular(1) == {'atmospheric': 3}
+        assert tags.distinct_tags() == 4
+
+    # Follow mode tests
+    def test_follow_ratings(self, dataset_dir):
+        path = os.path.join(dataset_dir, 'ratings.csv')
+        ratings = Ratings(path, os.path.join(dataset_dir, 'movies.csv'), follow=True)
+        movies = ratings.Movies(ratings)
+        assert ratings.refresh() == 0
+        assert movies.top_by_num_of_ratings(1) == {'Toy Story (1995)': 3}
+        version = ratings.data_version()
+        with open(path, 'a') as file:
+            file.write('4,2,3.0,1262304100\n4,2,4.0,1262304200\n5,2,')
+        assert ratings.refresh() == 2
+        assert ratings.data_version() != version
+        assert movies.dist_by_year()[2010] == 3
+        with open(path, 'a') as file:
+            file.write('5.0,1262304300\n')
+        assert ratings.refresh() == 1
+        assert movies.top_by_num_of_ratings(1) == {'Jumanji (1995)': 4}
+        with open(path, 'a') as file:
+            file.write('broken\n')
+        with pytest.raises(ValueError, match='line 15'):
+            ratings.refresh()
+        assert len(ratings.data_joined) == 13
+        with open(path, 'w') as file:
+            file.write('userId,movieId,rating,timestamp\n1,1,4.0,964982703\n')
+        assert ratings.refresh() == 1
+        assert len(ratings.data_joined) == 1
+        with pytest.raises(ValueError):
+            Ratings.from_rows([]).refresh()
+
+    def test_follow_tags(self, dataset_dir):
+        path = os.path.join(dataset_dir, 'tags.csv')
+        tags = Tags(path, follow=True)
+        assert tags.most_popular(1) == {'atmospheric': 3}
+        with open(path, 'a') as file:
+            file.write('4,1,pixar,1139045770\n4,2,pixar,1139045771\n4,3,pixar,1139045772\n4,3,pixar,1139045773\n')
+        assert tags.refresh() == 4
+        assert tags.most_popular(1) == {'pixar': 5}
+        assert tags.refresh() == 0
+        replacement = os.path.join(dataset_dir, 'tags.new.csv')
+        with open(path) as source, open(replacement, 'w') as file:
+            file.write(source.read().replace('pixar', 'cgi') + '4,4,cgi,1139045774\n')
+        os.replace(replacement, path)
+        assert tags.refresh() == 11
+        assert tags.most_popular(1) == {'cgi': 6}
+
+    def test_follow_ratings_checks_header(self, dataset_dir):
+        path = os.path.join(dataset_dir, 'ratings.csv')
+        with open(path, 'w') as file:
+            file.write('userId,movieId,timestamp,rating\n1,1,964982703,4.0\n')
+        ratings = Ratings(path, os.path.join(dataset_dir, 'movies.csv'), follow=True)
+        assert ratings.data_joined == []
+        with pytest.raises(ValueError, match='Invalid file structure'):
+            ratings.refresh()
+
+    # Lenient loading tests
+    def test_lenient_ratings_and_tags(self, dataset_dir):
+        ratings_path = os.path.join(dataset_dir, 'ratings.csv')
+        with open(ratings_path, 'a') as file:
+            file.write('5,1,oops,1262304000\n5,2\n5,3,4.0,1262304100\n')
+        movies_path = os.path.join(dataset_dir, 'movies.csv')
+        assert Ratings(ratings_path, movies_path).data_joined == []
+        rejects_file = os.path.join(dataset_dir, 'rejects.jsonl')
+        ratings = Ratings(ratings_path, movies_path, strict=False, rejects_file=rejects_file)
+        assert len(ratings.data_joined) == 11
+        assert [reject['line'] for reject in ratings.get_rejects()] == [12, 13]
+        with open(rejects_file) as file:
+            assert [json.loads(line)['row'] for line in file] == ['5,1,oops,1262304000', '5,2']
+        assert Ratings(ratings_path, movies_path, strict=False, max_errors=1).data_joined == []
+        assert Ratings(ratings_path, movies_path, strict=False, max_error_rate=0.1).data_joined == []
+        assert len(Ratings(ratings_path, movies_path, strict=False, max_error_rate=0.2).data_joined) == 11
+        followed = Ratings(ratings_path, movies_path, follow=True, strict=False)
+        with open(ratings_path, 'a') as file:
+            file.write('bad\n5,4,2.0,1262304200\n')
+        assert followed.refresh() == 1
+        assert [reject['line'] for reject in followed.get_rejects()] == [12, 13, 15]
+        with open(ratings_path, 'w') as file:
+            file.write('userId,movieId,rating,timestamp\n1,1,4.0,964982703\nbad\n1,2,4.0,964982703\n')
+        budgeted = Ratings(ratings_path, movies_path, follow=True, strict=False, max_errors=1)
+        assert len(budgeted.data_joined) == 2
+        with open(ratings_path, 'w') as file:
+            file.write('userId,movieId,rating,timestamp\nbad\n1,3,4.0,964982703\n')
+        assert budgeted.refresh() == 1
+        assert [reject['line'] for reject in budgeted.get_rejects()] == [2]
+        tags_path = os.path.join(dataset_dir, 'tags.csv')
+        with open(tags_path, 'a') as file:
+            file.write('4,1,broken\n4,2,ok,1139045770\n')
+        tags = Tags(tags_path, strict=False)
+        assert len(tags.tags) == 7
+        with open(tags_path, 'a') as file:
+            file.write('garbage\n' * 50)
+        assert Tags(tags_path, strict=False, max_errors=5).tags == []
+        assert Tags(tags_path).tags == []
+        assert tags.get_rejects()[0]['line'] == 8
+        assert Tags(tags_path).get_rejects() == []
+
+    def test_lenient_links_budget(self, tmp_path):
+        path = tmp_path / 'links.csv'
+        path.write_text('movieId,imdbId,tmdbId\n1,0114709,862\nx,1,2\n3,0113228,15602\n,,\n', encoding='utf-8')
+        rejects_file = str(tmp_path / 'rejects.jsonl')
+        links = Links(str(path), strict=False, rejects_file=rejects_file)
+        assert [reject['line'] for reject in links.get_rejects()] == [3, 5]
+        with open(rejects_file) as file:
+            assert len(file.readlines()) == 2
+        with open(rejects_file, 'w') as file:
+            file.write('keep me\n')
+        Links(str(path), 1, rejects_file=rejects_file)
+        with open(rejects_file) as file:
+            assert file.read() == 'keep me\n'
+        with pytest.raises(ValueError, match='budget'):
+            Links(str(path), strict=False, max_errors=1)
+        with pytest.raises(ValueError, match='budget'):
+            Links(str(path), strict=False, max_error_rate=0.25)
+
+    # Cube tests
+    def test_ratings_cube(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        cube = catalog.cube()
+        assert catalog.cube() is cube
+        assert cube.cell(measure='count') == 10
+        assert cube.cell(genre='Thriller', measure='count') == 4
+        assert cube.cell(genre='Thriller') == 4.38
+        assert cube.cell(genre='Thriller', release_year=(1990, 1995)) == 4.25
+        assert cube.cell(genre='Western') is None
+        movies = catalog.ratings().Movies(catalog.ratings())
+        assert cube.rollup('rating', measure='count') == movies.dist_by_rating()
+        assert cube.rollup('rating_year', measure='count') == movies.dist_by_year()
+        assert cube.query('release_year', measure='count', bins={'release_year': 10}) == {1990: 10}
+        assert cube.query(('genre', 'release_year'), genre=['Crime', 'Fantasy'], measure='count') == {
+            ('Crime', 1995): 2, ('Crime', 1996): 2, ('Fantasy', 1995): 4}
+        assert cube.query('genre', rating=(4.5, 5.0), measure='count')['Thriller'] == 2
+        assert cube.query('director') == {}
+        assert cube.query(measure='median') == {}
+
+    # Tag join index tests
+    def test_tag_rating_index(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        index = catalog.tag_index()
+        assert index.movies('atmospheric') == [4, 5]
+        assert index.movies('dark', contains=True) == [5]
+        assert [int(movie_id) for movie_id in catalog.tags().movie_by_tag('a')] == index.movies('a', contains=True)
+        assert index.top_rated('atmospheric') == {'Fargo (1996)': 4.5, 'Heat (1995)': 4.25}
+        assert index.top_rated('atmospheric', n=1) == {'Fargo (1996)': 4.5}
+        assert index.top_rated('pixar', min_ratings=4) == {}
+        assert index.top_rated('pixar', min_ratings=3) == {'Toy Story (1995)': 3.83}
+        assert index.most_rated('a', contains=True) == {'Toy Story (1995)': 3, 'Fargo (1996)': 2, 'Heat (1995)': 2}
+        assert index.top_rated('unknown') == {}
+
+    # Compressed input tests
+    def test_compressed_inputs(self, dataset_dir, tmp_path):
+        archive = tmp_path / 'ml-latest-small.zip'
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as file:
+            for name in MovieLensCatalog.FILES.values():
+                file.write(os.path.join(dataset_dir, name), f"ml-latest-small/{name}")
+        for name in ('ratings.csv', 'movies.csv'):
+            with open(os.path.join(dataset_dir, name), 'rb') as source, gzip.open(tmp_path / f"{name}.gz", 'wb') as target:
+                target.write(source.read())
+        plain = MovieLensCatalog(dataset_dir)
+        zipped = MovieLensCatalog(str(archive))
+        assert zipped.paths['ratings'] == os.path.join(str(archive), 'ratings.csv')
+        assert zipped.movies().movies == plain.movies().movies
+        assert zipped.ratings().data_joined == plain.ratings().data_joined
+        assert zipped.tags().tags == plain.tags().tags
+        assert zipped.links().get_ids_dict() == plain.links().get_ids_dict()
+        gzipped = Ratings(str(tmp_path / 'ratings.csv.gz'), str(tmp_path / 'movies.csv.gz'))
+        assert gzipped.data_joined == plain.ratings().data_joined
+        with open_text(f"{archive}/ml-latest-small/tags.csv") as file:
+            assert file.readline() == 'userId,movieId,tag,timestamp\n'
+        with pytest.raises(FileNotFoundError):
+            open_text(f"{archive}/missing.csv")
+        with pytest.raises(ValueError, match='uncompressed'):
+            Ratings(str(tmp_path / 'ratings.csv.gz'), follow=True).refresh()
+
+    def test_zstandard_input(self, dataset_dir, tmp_path):
+        pytest.importorskip('zstandard')
+        path = tmp_path / 'tags.csv.zst'
+        with open(os.path.join(dataset_dir, 'tags.csv'), 'rb') as source:
+            path.write_bytes(zstandard.ZstdCompressor().compress(source.read()))
+        assert Tags(str(path)).tags == Tags(os.path.join(dataset_dir, 'tags.csv')).tags
+
+    # Grouped top-n tests
+    def test_top_per_group(self):
+        triples = [('a', 'x', 1), ('a', 'y', 3), ('b', 'z', 2), ('a', 'w', 3), ('a', 'v', 2)]
+        assert _top_per_group(triples, 2) == {'a': [('y', 3), ('w', 3)], 'b': [('z', 2)]}
+        with pytest.raises(ValueError):
+            _top_per_group(triples, 0)
+
+    def test_grouped_top_n(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        movies, tags, ratings = catalog.movies(), catalog.tags(), catalog.ratings()
+        view = ratings.Movies(ratings)
+        per_genre = view.top_by_ratings_per_group(2, by='genre', movies=movies)
+        assert per_genre['Thriller'] == {'Fargo (1996)': 4.5, 'Heat (1995)': 4.25}
+        assert per_genre['Fantasy'] == {'Toy Story (1995)': 3.83, 'Jumanji (1995)': 2.5}
+        by_year = view.top_by_ratings_per_group(1, by='year')
+        assert sorted(by_year) == sorted(view.dist_by_year())
+        for year, top in by_year.items():
+            rows = [row for row in ratings.data_joined if datetime.fromtimestamp(row['timestamp']).year == year]
+            assert top == Ratings.Movies(Ratings.from_rows(rows)).top_by_ratings(1)
+        assert view.top_by_num_of_ratings_per_group(1, by='release_year', movies=movies) == {
+            1995: {'Toy Story (1995)': 3}, 1996: {'Fargo (1996)': 2}}
+        assert view.top_by_ratings_per_group(1, by='genre') == {}
+        assert view.top_by_ratings_per_group(5, by='genre', movies=movies, min_ratings=3) == {
+            genre: {'Toy Story (1995)': 3.83} for genre in ('Adventure', 'Animation', 'Children', 'Comedy', 'Fantasy')}
+        assert tags.most_popular_per_group(1, by='release_year', movies=movies) == {
+            1995: {'atmospheric': 2}, 1996: {'dark comedy': 1}}
+        assert tags.most_popular_per_group(1, by='movieId')[4] == {'atmospheric': 2}
+        assert movies.most_genres_per_group(1) == {1995: {'Toy Story (1995)': 5}, 1996: {'Fargo (1996)': 4}}
+        assert movies.most_genres_per_group(1, by='genre')['Crime'] == {'Fargo (1996)': 4}
+
+    def test_grouped_top_n_cache_keys_on_movies_version(self, result_cache, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        movies, tags = catalog.movies(), catalog.tags()
+        before = RESULT_CACHE.stats()
+        first = tags.most_popular_per_group(1, by='genre', movies=movies)
+        assert tags.most_popular_per_group(1, by='genre', movies=movies) == first
+        assert RESULT_CACHE.stats()['hits'] - before['hits'] == 1
+        movies.movies.append({'movieId': '999', 'title': 'Heat 2 (2026)', 'genres': 'Crime'})
+        assert tags.most_popular_per_group(1, by='genre', movies=movies) == first
+        assert RESULT_CACHE.stats()['misses'] - before['misses'] == 2
+
+    # Query server tests
+    @staticmethod
+    async def http(reader, writer, request:str, body:bytes = b''):
+        writer.write(request.encode() + f"\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while (line := await reader.readline()) != b'\r\n':
+            name, _, value = line.decode().partition(':')
+            headers[name.lower()] = value.strip()
+        payload = await reader.readexactly(int(headers['content-length']))
+        return status, json.loads(payload) if headers['content-type'] == 'application/json' else payload.decode()
+
+    def test_query_server(self, dataset_dir):
+        catalog = MovieLensCatalog(dataset_dir)
+        server = QueryServer(catalog, workers=2, max_body=64)
+        server.preload()
+        assert catalog.loaded() == ['movies', 'ratings', 'tags']
+        assert 'top_by_ratings' in server.methods['ratings.movies']
+        assert 'save' not in server.methods['tags'] and 'refresh' not in server.methods['tags']
+
+        async def scenario():
+            listening = await server.start('127.0.0.1', 0)
+            port = listening.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                status, response = await self.http(reader, writer, "GET /ratings.movies/top_by_ratings?n=2&metric=median HTTP/1.1")
+                assert status == 200
+                assert response['result'] == {'Fargo (1996)': 4.5, 'Heat (1995)': 4.25}
+                status, response = await self.http(reader, writer, "POST /tags/most_popular HTTP/1.1",
+                                                   json.dumps({'args': [1]}).encode())
+                assert (status, response['result']) == (200, {'atmospheric': 3})
+                assert (await self.http(reader, writer, "GET /tags/save HTTP/1.1"))[0] == 404
+                assert (await self.http(reader, writer, "GET /ratings.movies/top_by_ratings?x=1 HTTP/1.1"))[0] == 400
+                assert (await self.http(reader, writer, "DELETE /health HTTP/1.1"))[0] == 405
+                status, response = await self.http(reader, writer, "GET /health HTTP/1.1")
+                assert response['status'] == 'ok'
+                status, response = await self.http(
+                    reader, writer, "GET /ratings.movies/top_by_ratings_per_group?n=1&by=genre HTTP/1.1")
+                assert (status, response['result']['Crime']) == (200, {'Fargo (1996)': 4.5})
+                assert (await self.http(reader, writer, "GET /tags/most_popular_per_group?n=1&movies=1 HTTP/1.1"))[0] == 400
+                for request, expected in ((b"POST /tags/most_popular HTTP/1.1\r\nContent-Length: ten\r\n\r\n", 400),
+                                          (b"POST /tags/most_popular HTTP/1.1\r\nContent-Length: 1000\r\n\r\n", 413)):
+                    raw_reader, raw_writer = await asyncio.open_connection('127.0.0.1', port)
+                    raw_writer.write(request)
+                    assert int((await raw_reader.readline()).split()[1]) == expected
+                    raw_writer.close()
+                results = await asyncio.gather(*(asyncio.open_connection('127.0.0.1', port) for _ in range(4)))
+                answers = await asyncio.gather(*(self.http(r, w, "GET /movies/dist_by_genres HTTP/1.1")
+                                                 for r, w in results))
+                assert [status for status, _ in answers] == [200] * 4
+                assert all(response['result'] == answers[0][1]['result'] for _, response in answers)
+                for _, w in results:
+                    w.close()
+            finally:
+                writer.close()
+                await server.close()
+        asyncio.run(scenario())
+        assert server.query('tags', 'most_popular', [1, 2])[0] == 400
+
+    # Sampling tests
+    def test_sampler(self):
+        lines = [f"{i % 50},{i},4.0,0\n" for i in range(10000)]
+        assert [num for num, _ in Sampler().sample(lines)] == list(range(2, 1002))
+        assert len(list(Sampler('first', None).sample(lines))) == 10000
+        reservoir = list(Sampler('reservoir', 500, seed=1).sample(lines))
+        assert len(reservoir) == 500 and reservoir == sorted(reservoir)
+        assert reservoir == list(Sampler('reservoir', 500, seed=1).sample(lines))
+        assert 4000 < sum(num for num, _ in reservoir) / 500 < 6000
+        assert len(list(Sampler('reservoir', 500).sample(lines[:10]))) == 10
+        fraction = list(Sampler('fraction', fraction=0.1, seed=3).sample(lines))
+        assert 800 < len(fraction) < 1200
+        users = Sampler('users', fraction=0.2, seed=5)
+        kept = {line.split(',')[0] for _, line in users.sample(lines)}
+        assert 0 < len(kept) < 25
+        assert sum(1 for _, line in users.sample(lines) if line.split(',')[0] in kept) == 200 * len(kept)
+        stratified = [line.split(',')[0] for _, line in Sampler('stratified', fraction=0.1, seed=5,
+                                                                  fractions={0: 0.5}).sample(lines)]
+        assert Counter(stratified) == {str(user): 100 if user == 0 else 20 for user in range(50)}
+        movies = list(Sampler('stratified', fraction=0.1, seed=5, key='movieId').sample(lines))
+        assert 800 < len(movies) < 1200
+        with pytest.raises(ValueError):
+            Sampler('systematic')
+        with pytest.raises(ValueError):
+            Sampler('fraction', fraction=0)
+        with pytest.raises(ValueError):
+            Sampler('stratified', fractions={1: 2.0})
+        with pytest.raises(ValueError):
+            Sampler('stratified', key='rating')
+
+    def test_sampled_loaders(self, dataset_dir):
+        sample = Sampler('users', fraction=0.5, seed=2)
+        catalog = MovieLensCatalog(dataset_dir, sample=sample)
+        users = {row['userId'] for row in catalog.ratings().data_joined}
+        assert users == {user for user in range(1, 5) if sample.keeps_user(user)}
+        assert {int(tag['userId']) for tag in catalog.tags().tags} == {user for user in range(1, 4) if sample.keeps_user(user)}
+        ratings = Ratings(catalog.paths['ratings'], movie_titles=catalog.titles(), sample=Sampler('reservoir', 3))
+        assert len(ratings.data_joined) == 3
+        assert [row['timestamp'] for row in ratings.data_joined] == sorted(row['timestamp'] for row in ratings.data_joined)
+        assert len(Tags(catalog.paths['tags'], sample=Sampler('first', 2)).tags) == 2
+
+    def test_sampled_follow(self, dataset_dir):
+        sample = Sampler('users', fraction=0.5, seed=2)
+        path = os.path.join(dataset_dir, 'ratings.csv')
+        followed = Ratings(path, os.path.join(dataset_dir, 'movies.csv'), follow=True, sample=sample)
+        stratified = Ratings(path, os.path.join(dataset_dir, 'movies.csv'), follow=True,
+                             sample=Sampler('stratified', fraction=0.5))
+        with open(path, 'a') as file:
+            file.write(''.join(f"{user},1,4.0,1262304000\n" for user in range(5, 25)))
+            file.write("30,1,4.0,1262304000\n" * 20)
+        followed.refresh()
+        assert {row['userId'] for row in followed.data_joined} == {user for user in [*range(1, 25), 30]
+                                                                   if sample.keeps_user(user)}
+        stratified.refresh()
+        assert sum(1 for row in stratified.data_joined if row['userId'] == 30) == 10
+        with pytest.raises(ValueError):
+            Tags(os.path.join(dataset_dir, 'tags.csv'), follow=True, sample=Sampler('reservoir', 3))
+
+    # Partial state tests
+    @pytest.fixture
+    def shards(self, tmp_path):
+        rng = random.Random(11)
+        movies = tmp_path / 'movies.csv'
+        movies.write_text('movieId,title,genres\n' + ''.join(
+            f"{movie_id},Movie {movie_id % 50} ({1990 + movie_id % 20}),Drama\n" for movie_id in range(1, 70)))
+        pairs = rng.sample([(user, movie) for user in range(1, 41) for movie in range(1, 80)], 2500)
+        lines = [f"{user},{movie},{rng.randint(1, 10) / 2},{rng.randint(789652009, 1700000000)}\n" for user, movie in pairs]
+        tag_lines = [f"{rng.randint(1, 40)},{rng.randint(1, 80)},{rng.choice(['funny', 'dark', 'dark comedy', 'twist'])},0\n"
+                     for _ in range(300)]
+        paths = {'movies': str(movies), 'ratings': [], 'tags': []}
+        for i in range(3):
+            for name, header, rows in (('ratings', 'userId,movieId,rating,timestamp\n', lines),
+                                       ('tags', 'userId,movieId,tag,timestamp\n', tag_lines)):
+                path = tmp_path / f"{name}_{i}.csv"
+                path.write_text(header + ''.join(rows[len(rows) * i // 3:len(rows) * (i + 1) // 3]))
+                paths[name].append(str(path))
+        for name, header, rows in (('ratings', 'userId,movieId,rating,timestamp\n', lines),
+                                   ('tags', 'userId,movieId,tag,timestamp\n', tag_lines)):
+            (tmp_path / f"{name}.csv").write_text(header + ''.join(rows))
+            paths[f"{name}_whole"] = str(tmp_path / f"{name}.csv")
+        return paths
+
+    def test_histogram_stat(self):
+        for ratings in ([4.0], [1.0, 5.0], [0.5, 3.0, 3.0, 4.5], [2.0, 2.0, 3.5, 5.0, 5.0]):
+            histogram = dict(Counter(ratings))
+            assert _histogram_stat(histogram, 'median') == Ratings.Movies.median(ratings)
+            assert _histogram_stat(histogram, 'average') == sum(ratings) / len(ratings)
+            mean = sum(ratings) / len(ratings)
+            assert _histogram_stat(histogram, 'variance') == pytest.approx(sum((r - mean) ** 2 for r in ratings) / len(ratings))
+        with pytest.raises(ValueError):
+            _histogram_stat({4.0: 1}, 'mode')
+
+    def test_partial_states_merge_exactly(self, shards):
+        with ProcessPoolExecutor(max_workers=3) as pool:
+            ratings_states = list(pool.map(partial_state, ['ratings'] * 3, shards['ratings'], [shards['movies']] * 3))
+            tags_states = list(pool.map(partial_state, ['tags'] * 3, shards['tags']))
+        merged = RatingsState.merge_all(RatingsState.from_bytes(data) for data in ratings_states)
+        whole = Ratings(shards['ratings_whole'], shards['movies'], sample=Sampler('first', None))
+        assert len(whole.data_joined) == 2500
+        movies, users = whole.Movies(whole), whole.Users(whole)
+        for name, args in (('dist_by_year', []), ('dist_by_rating', []), ('top_by_num_of_ratings', [10]),
+                           ('top_by_ratings', [10]), ('top_by_ratings', [10, 'median']),
+                           ('top_controversial', [10]), ('most_active_user_by_coverage', []),
+                           ('percent_of_max_ratings_per_movie', [10]), ('percent_of_max_ratings_per_movie', [])):
+            result, expected = getattr(merged, name)(*args), getattr(movies, name)(*args)
+            assert result == expected
+            if isinstance(expected, dict):
+                assert list(result) == list(expected)
+        for name, args in (('users_distribution', []), ('users_rating_distribution', []),
+                           ('users_rating_distribution', ['median']), ('top_n_users_by_variance', [5])):
+            assert list(getattr(merged, name)(*args).items()) == list(getattr(users, name)(*args).items())
+        tags_merged = TagsState.merge_all(TagsState.from_bytes(data) for data in tags_states)
+        tags = Tags(shards['tags_whole'], sample=Sampler('first', None))
+        assert list(tags_merged.most_popular(3).items()) == list(tags.most_popular(3).items())
+        assert tags_merged.tags_with('dark') == tags.tags_with('dark')
+        assert tags_merged.movie_by_tag('dark') == tags.movie_by_tag('dark')
+        assert len(ratings_states[0]) < os.path.getsize(shards['ratings'][0])
+        with pytest.raises(ValueError):
+            partial_state('links', shards['ratings'][0])
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
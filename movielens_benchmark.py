@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from movielens_analysis import Movies, Tags, Ratings, Links, Sampler, RESULT_CACHE, open_text, zstandard
+
+
+SCALES = {
+    'tiny': {'movies': 200, 'users': 50, 'ratings': 2000, 'tags': 300},
+    '100k': {'movies': 9742, 'users': 610, 'ratings': 100836, 'tags': 3683},
+    '1m': {'movies': 3883, 'users': 6040, 'ratings': 1000209, 'tags': 20000},
+    '25m': {'movies': 62423, 'users': 162541, 'ratings': 25000095, 'tags': 1093360},
+}
+
+GENRES = ['Drama', 'Comedy', 'Thriller', 'Action', 'Romance', 'Adventure', 'Crime', 'Sci-Fi', 'Horror',
+          'Fantasy', 'Children', 'Animation', 'Mystery', 'Documentary', 'War', 'Musical', 'Western',
+          'IMAX', 'Film-Noir']
+# weights of the ratings 0.5 .. 5.0 in the MovieLens files
+RATING_WEIGHTS = [1.4, 2.9, 2.0, 7.5, 5.0, 19.9, 13.0, 26.6, 7.7, 14.0]
+WORDS = ['dark', 'comedy', 'funny', 'sci-fi', 'twist', 'ending', 'atmospheric', 'visually', 'appealing',
+         'thought-provoking', 'classic', 'cult', 'film', 'based', 'on', 'a', 'book', 'quirky', 'surreal',
+         'great', 'soundtrack', 'dystopia', 'time', 'travel', 'space', 'Netflix', 'queue', 'mindfuck']
+DIRECTORS = [f"Director {i}" for i in range(500)]
+# the movies whose IMDB pages the fetching cases download and parse, and the page markup around the parsed fields
+FETCHED_MOVIES = 100
+PAGE_FILLER = ''.join(f'<div class="ipc-block"><span>{word}</span><a href="/search/?q={word}">{word}</a></div>'
+                      for word in WORDS * 2)
+
+
+def zipf_weights(count:int, exponent:float = 1.1):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def chunks(total:int, size:int = 100000):
+    while total > 0:
+        yield min(size, total)
+        total -= size
+
+
+def generate(data_dir:str, scale:str = '100k', seed:int = 42):
+    """
+    The function writes synthetic movies.csv, ratings.csv, tags.csv, links.csv and a metadata.jsonl dump for
+    offline Links into data_dir. Movie popularity, user activity and tag usage follow Zipf distributions,
+    the ratings follow the MovieLens distribution. Existing files of the same scale and seed are reused.
+    Returns a dict with the paths.
+    """
+    sizes = SCALES[scale]
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    paths = {name: os.path.join(data_dir, f"{name}.csv") for name in ('movies', 'ratings', 'tags', 'links')}
+    paths['metadata'] = os.path.join(data_dir, 'metadata.jsonl')
+    stamp = os.path.join(data_dir, 'generated.json')
+    spec = {'scale': scale, 'seed': seed, 'sizes': sizes}
+    if os.path.exists(stamp) and all(os.path.exists(path) for path in paths.values()):
+        with open(stamp) as file:
+            if json.load(file) == spec:
+                return paths
+
+    movie_ids = list(range(1, sizes['movies'] + 1))
+    with open(paths['movies'], 'w', encoding='utf-8') as movies, \
+            open(paths['links'], 'w') as links, open(paths['metadata'], 'w') as metadata:
+        movies.write('movieId,title,genres\n')
+        links.write('movieId,imdbId,tmdbId\n')
+        for movie_id in movie_ids:
+            year = int(rng.triangular(1902, 2023, 2010))
+            title = f"Movie {movie_id} ({year})"
+            if rng.random() < 0.1:
+                title = f"\"Movie {movie_id}, The ({year})\""
+            if rng.random() < 0.01:
+                genres = '(no genres listed)'
+            else:
+                genres = '|'.join(sorted(set(rng.choices(GENRES, zipf_weights(len(GENRES)), k=rng.randint(1, 4)))))
+            movies.write(f"{movie_id},{title},{genres}\n")
+            imdb_id = f"{100000 + movie_id:07d}"
+            links.write(f"{movie_id},{imdb_id},{200000 + movie_id}\n")
+            budget = round(rng.lognormvariate(16.5, 1.2), -3) if rng.random() < 0.8 else None
+            gross = round(budget * rng.lognormvariate(0.5, 1.0), 0) if budget and rng.random() < 0.9 else None
+            metadata.write(json.dumps({
+                'imdbId': f"tt{imdb_id}", 'Title': title.strip('"'), 'Director': rng.choice(DIRECTORS),
+                'Budget': budget, 'Cumulative Worldwide Gross': gross, 'Runtime': int(rng.gauss(105, 20)) or 90,
+                'Rating': f"{rng.uniform(2, 9):.1f}/10"}) + '\n')
+
+    movie_weights = zipf_weights(len(movie_ids))
+    user_weights = zipf_weights(sizes['users'], 0.8)
+    users = list(range(1, sizes['users'] + 1))
+    ratings_values = [r / 2 for r in range(1, 11)]
+    start, end = 789652009, 1700000000
+    with open(paths['ratings'], 'w') as ratings:
+        ratings.write('userId,movieId,rating,timestamp\n')
+        for size in chunks(sizes['ratings']):
+            rows = zip(sorted(rng.choices(users, user_weights, k=size)), rng.choices(movie_ids, movie_weights, k=size),
+                       rng.choices(ratings_values, RATING_WEIGHTS, k=size))
+            ratings.write(''.join(f"{user},{movie},{rating},{rng.randint(start, end)}\n"
+                                  for user, movie, rating in rows))
+
+    vocabulary = [' '.join(rng.sample(WORDS, rng.choice((1, 1, 1, 2, 2, 3, 5)))) for _ in range(2000)]
+    with open(paths['tags'], 'w') as tags:
+        tags.write('userId,movieId,tag,timestamp\n')
+        for size in chunks(sizes['tags']):
+            rows = zip(sorted(rng.choices(users, user_weights, k=size)), rng.choices(movie_ids, movie_weights, k=size),
+                       rng.choices(vocabulary, zipf_weights(len(vocabulary)), k=size))
+            tags.write(''.join(f"{user},{movie},{tag},{rng.randint(start, end)}\n" for user, movie, tag in rows))
+
+    with open(stamp, 'w') as file:
+        json.dump(spec, file)
+    return paths
+
+
+def render_page(movie:dict):
+    """
+    The function renders a record of the metadata dump as an IMDB title page which Links.parse_page understands.
+    """
+    hours, minutes = divmod(movie['Runtime'], 60)
+    runtime = ' '.join(part for part in (f"{hours} hour{'s' if hours > 1 else ''}" if hours else '',
+                                         f"{minutes} minutes" if minutes or not hours else '') if part)
+    fields = [('Runtime', runtime), ('IMDb RATING', movie['Rating'])]
+    if movie['Budget']:
+        fields.append(('Budget', f"${movie['Budget']:,.0f} (estimated)"))
+    if movie['Cumulative Worldwide Gross']:
+        fields.append(('Gross worldwide', f"${movie['Cumulative Worldwide Gross']:,.0f}"))
+    director_id = int(movie['Director'].split()[-1])
+    return (f'<html><h1>{movie["Title"]}</h1><a href="/name/nm{director_id:07d}/">{movie["Director"]}</a>'
+            + PAGE_FILLER + ''.join(f'<li>{name}<span>{value}</span></li>' for name, value in fields)
+            + '</html>').encode('utf-8')
+
+
+class OfflineResponse:
+    def __init__(self, status_code:int, content:bytes = b''):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {}
+
+
+class OfflineSession:
+    """
+    A stand-in for the requests.Session of Links which answers the IMDB title URLs with pages rendered
+    from the metadata dump (404 for unknown ids), so the fetch and parse pipeline runs without network.
+    """
+
+    def __init__(self, metadata_file:str):
+        with open(metadata_file) as file:
+            self.pages = {movie['imdbId']: render_page(movie) for movie in map(json.loads, file)}
+
+    def get(self, url:str, timeout:float = None):
+        page = self.pages.get(url.rstrip('/').rsplit('/', 1)[-1])
+        return OfflineResponse(200, page) if page is not None else OfflineResponse(404)
+
+
+def cases(paths:dict):
+    """
+    The function returns the list of benchmark cases (name, args, setup) where setup returns the callable to time.
+    Every loader and every public method of Movies, Tags, Ratings and Links is covered, Links runs offline
+    on the metadata dump. Ratings and Tags load whole files, not the default first 1000 lines.
+    The Links.fetch cases load the first FETCHED_MOVIES links on every call and fetch their pages
+    from an OfflineSession, so they time the downloading threads and the parsing of the pages.
+    """
+    loaded = {}
+
+    def instance(name):
+        if name not in loaded:
+            loaded[name] = loaders[name]()
+        return loaded[name]
+
+    loaders = {
+        'Movies': lambda: Movies(paths['movies']),
+        'Tags': lambda: Tags(paths['tags'], sample=Sampler('first', None)),
+        'Ratings': lambda: Ratings(paths['ratings'], paths['movies'], sample=Sampler('first', None)),
+        'Links': lambda: Links(paths['links'], None, metadata_file=paths['metadata'], parse_workers=0),
+    }
+    result = [(f"{name}.__init__", [], lambda name=name: loaders[name]) for name in loaders]
+    methods = {
+        'Movies': [('dist_by_release', []), ('dist_by_genres', []), ('most_genres', [10]),
+                   ('get_movies_by_year', [1999]), ('most_genres_per_group', [5])],
+        'Tags': [('most_words', [10]), ('longest', [10]), ('most_words_and_longest', [10]),
+                 ('most_popular', [10]), ('tags_with', ['funny']), ('movie_by_tag', ['funny']),
+                 ('most_popular_per_group', [5, 'year'])],
+        'Ratings.Movies': [('dist_by_year', []), ('dist_by_rating', []), ('top_by_num_of_ratings', [10]),
+                           ('top_by_ratings', [10, 'average']), ('top_by_ratings', [10, 'median']),
+                           ('top_controversial', [10]), ('most_active_user_by_coverage', []),
+                           ('percent_of_max_ratings_per_movie', [10]), ('top_by_ratings_per_group', [5, 'year']),
+                           ('top_by_num_of_ratings_per_group', [5, 'year'])],
+        'Ratings.Users': [('users_distribution', []), ('users_rating_distribution', ['average']),
+                          ('users_rating_distribution', ['median']), ('top_n_users_by_variance', [5])],
+        'Links': [('get_ids_dict', []), ('get_imdb_table', []), ('top_directors', [10]),
+                  ('most_expensive', [10]), ('most_profitable', [10]), ('longest', [10]),
+                  ('top_cost_per_minute', [10]), ('get_imdb_rating', [list(range(1, 101))])],
+    }
+    views = {
+        'Ratings.Movies': lambda: instance('Ratings').Movies(instance('Ratings')),
+        'Ratings.Users': lambda: instance('Ratings').Users(instance('Ratings')),
+    }
+    for owner, calls in methods.items():
+        for method, args in calls:
+            def setup(owner=owner, method=method):
+                target = views[owner]() if owner in views else instance(owner)
+                return getattr(target, method)
+            result.append((f"{owner}.{method}", args, setup))
+
+    fetched = list(range(1, FETCHED_MOVIES + 1))
+    fetching = [('get_imdb', [fetched, ['Director', 'Budget', 'Runtime', 'Title']]),
+                ('iter_imdb', []), ('iter_imdb', [None, 0])]
+    for method, args in fetching:
+        def setup(method=method):
+            session = OfflineSession(paths['metadata'])
+
+            def fetch(*args):
+                links = Links(paths['links'], FETCHED_MOVIES, backoff=0)
+                links._Links__session = session
+                result = getattr(links, method)(*args)
+                return result if method == 'get_imdb' else list(result)
+            return fetch
+        result.append((f"Links.fetch.{method}", args, setup))
+    return result
+
+
+def run(paths:dict, repeat:int = 5, only:str = None):
+    """
+    The function times every case and returns a list of dicts {name, args, first, min, median, repeat}
+    with the times in seconds. The first call is reported separately, because it includes building cached data.
+    The result cache is cleared before every timed call, so memoized methods are measured, not cache lookups.
+    """
+    results = []
+    for name, args, setup in cases(paths):
+        if only and only not in name:
+            continue
+        function = setup()
+        timings = []
+        for _ in range(repeat):
+            RESULT_CACHE.clear()
+            started = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - started)
+        results.append({'name': name, 'args': args, 'first': timings[0], 'min': min(timings),
+                        'median': statistics.median(timings), 'repeat': repeat})
+    return results
+
+
+def compare(results:list, baseline:list, threshold:float = 1.2):
+    """
+    The function returns the cases which became slower than threshold times their median in baseline,
+    as a list of (name, args, baseline median, median).
+    """
+    before = {(row['name'], json.dumps(row['args'])): row['median'] for row in baseline}
+    slower = []
+    for row in results:
+        old = before.get((row['name'], json.dumps(row['args'])))
+        if old and row['median'] > old * threshold:
+            slower.append((row['name'], row['args'], old, row['median']))
+    return slower
+
+
+def compressed_copies(paths:dict):
+    """
+    The function writes .gz, .zip and, with the zstandard package, .zst copies of ratings.csv next to it
+    (existing copies are reused) and returns a dict {format: path for open_text}.
+    """
+    source = paths['ratings']
+    archive = os.path.splitext(source)[0] + '.zip'
+    copies = {'csv': source, 'gz': source + '.gz', 'zip': os.path.join(archive, os.path.basename(source))}
+    if not os.path.exists(copies['gz']):
+        with open(source, 'rb') as file, gzip.open(copies['gz'], 'wb', compresslevel=6) as target:
+            while chunk := file.read(1 << 20):
+                target.write(chunk)
+    if not os.path.exists(archive):
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as file:
+            file.write(source, os.path.basename(source))
+    if zstandard is not None:
+        copies['zst'] = source + '.zst'
+        if not os.path.exists(copies['zst']):
+            with open(source, 'rb') as file, open(copies['zst'], 'wb') as target:
+                zstandard.ZstdCompressor().copy_stream(file, target)
+    return copies
+
+
+def decompression(paths:dict, repeat:int = 3):
+    """
+    The function times reading every line of ratings.csv through open_text, plain and compressed,
+    and returns a list of dicts {format, compressed_bytes, bytes, min, median, mb_per_s}
+    where mb_per_s is the throughput in MB of decompressed text per second.
+    """
+    results = []
+    size = os.path.getsize(paths['ratings'])
+    for name, path in compressed_copies(paths).items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            with open_text(path) as file:
+                for _ in file:
+                    pass
+            timings.append(time.perf_counter() - started)
+        stored = path if name != 'zip' else os.path.dirname(path)
+        results.append({'format': name, 'compressed_bytes': os.path.getsize(stored), 'bytes': size,
+                        'min': min(timings), 'median': statistics.median(timings),
+                        'mb_per_s': size / min(timings) / 1e6})
+    return results
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark movielens_analysis on synthetic MovieLens data")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='100k')
+    parser.add_argument('--data-dir', default=None, help="where to generate the data (default: ./bench_data/<scale>)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', default=None, help="run only the cases whose name contains this text")
+    parser.add_argument('--out', default=None, help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--baseline', default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.2)
+    parser.add_argument('--skip-decompression', action='store_true',
+                        help="do not measure the read throughput of compressed ratings")
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or os.path.join('bench_data', args.scale)
+    started = time.perf_counter()
+    paths = generate(data_dir, args.scale, args.seed)
+    report = {
+        'version': version(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'sizes': SCALES[args.scale],
+        'generate_seconds': time.perf_counter() - started,
+        'results': run(paths, args.repeat, args.only),
+    }
+    if not args.skip_decompression:
+        report['decompression'] = decompression(paths, min(args.repeat, 3))
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = compare(report['results'], json.load(file)['results'], args.threshold)
+        for name, call_args, old, new in slower:
+            print(f"SLOWER {name}{tuple(call_args)}: {old:.6f}s -> {new:.6f}s")
+        return 1 if slower else 0
+    return 0
+
+
+class Tests:
+    """Smoke tests of the benchmark on the tiny scale"""
+
+    @pytest.fixture(scope='class')
+    @classmethod
+    def paths(cls, tmp_path_factory):
+        return generate(str(tmp_path_factory.mktemp('bench')), 'tiny', seed=1)
+
+    def test_generate_reuses_files(self, paths):
+        stamp = os.path.getmtime(paths['ratings'])
+        assert generate(os.path.dirname(paths['ratings']), 'tiny', seed=1) == paths
+        assert os.path.getmtime(paths['ratings']) == stamp
+
+    def test_cases_load_whole_files(self, paths):
+        loaders = {name: setup() for name, _, setup in cases(paths) if name.endswith('__init__')}
+        assert set(loaders) == {'Movies.__init__', 'Tags.__init__', 'Ratings.__init__', 'Links.__init__'}
+        assert len(loaders['Ratings.__init__']().data_joined) == SCALES['tiny']['ratings']
+        assert len(loaders['Tags.__init__']().tags) == SCALES['tiny']['tags']
+
+    def test_offline_fetch_cases(self, paths):
+        fetches = {json.dumps([name, args]): setup() for name, args, setup in cases(paths)
+                   if name.startswith('Links.fetch.')}
+        assert len(fetches) == 3
+        offline = Links(paths['links'], FETCHED_MOVIES, metadata_file=paths['metadata'], parse_workers=0)
+        fields = ['Director', 'Budget', 'Runtime', 'Title']
+        for key, fetch in fetches.items():
+            name, args = json.loads(key)
+            if name == 'Links.fetch.get_imdb':
+                assert fetch(*args) == offline.get_imdb(args[0], fields)
+            else:
+                assert sorted(movie_id for movie_id, _ in fetch(*args)) == list(range(1, FETCHED_MOVIES + 1))
+
+    def test_run_and_compare(self, paths):
+        results = run(paths, repeat=2, only='Ratings.Movies.dist_by')
+        assert [row['name'] for row in results] == ['Ratings.Movies.dist_by_year', 'Ratings.Movies.dist_by_rating']
+        assert all(row['repeat'] == 2 and 0 < row['min'] <= row['median'] for row in results)
+        assert compare(results, results) == []
+        baseline = [dict(row, median=row['median'] / 10) for row in results]
+        assert [name for name, _, _, _ in compare(results, baseline, 1.5)] == [row['name'] for row in results]
+        assert compare(results, []) == []
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())